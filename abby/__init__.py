@@ -5,6 +5,7 @@
 Abby is a framework to build side-channel models and evaluate them.
 """
 
+import abby.acquisition as acquisition
 import abby.emulator as emulator
 import abby.evaluation as evaluation
 import abby.firmware as firmware
@@ -21,6 +22,7 @@ except ImportError:
 
 # See https://www.python.org/dev/peps/pep-0008/#module-level-dunder-names
 __all__ = [
+    "acquisition",
     "evaluation",
     "firmware",
     "logger",
@@ -0,0 +1,515 @@
+# Copyright (C) 2020-2021 
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Acquisition engines built on top of :mod:`abby.oscilloscope`.
+
+The oscilloscope should never wait for the host. While a trace is captured,
+previous traces are processed and written to disk by worker threads. With
+several boards, :class:`Orchestrator` runs one worker per rig and merges their
+traces in a single :class:`TraceStore`.
+"""
+
+import csv
+import logging
+import pathlib
+import queue
+import threading
+from time import perf_counter
+
+import numpy as np
+
+from abby.oscilloscope import LatencyStats
+from abby.processing import RawTrace
+
+# Local logger
+log = logging.getLogger(__name__)
+
+# Marks the end of a queue
+_STOP = object()
+
+
+def save_numpy(destination, trace):
+    """Save a trace in Numpy format
+
+    Raw traces are saved with :meth:`abby.processing.RawTrace.save` in a
+    ``.npz`` file next to destination.
+
+    :param destination: path of the file to write
+    :type destination: str or pathlib.Path
+    :param trace: trace to save
+    :type trace: np.ndarray or RawTrace
+    """
+    if isinstance(trace, RawTrace):
+        trace.save(pathlib.Path(destination).with_suffix(".npz"))
+        return
+    np.save(destination, trace)
+
+
+def is_saved(destination):
+    """Check if :func:`save_numpy` saved a trace at destination
+
+    :param destination: path given to :func:`save_numpy`
+    :type destination: str or pathlib.Path
+    :return: True if a trace or a raw trace was saved
+    :rtype: bool
+    """
+    path = pathlib.Path(destination)
+    return path.is_file() or path.with_suffix(".npz").is_file()
+
+
+def load_numpy(path):
+    """Load a trace saved with :func:`save_numpy`
+
+    :param path: path given to :func:`save_numpy`
+    :type path: str or pathlib.Path
+    :return: trace, raw if saved in a ``.npz`` file next to path
+    :rtype: np.ndarray or RawTrace
+    """
+    raw_path = pathlib.Path(path).with_suffix(".npz")
+    if raw_path.is_file():
+        return RawTrace.load(raw_path)
+    return np.load(path)
+
+
+class AcquisitionPipeline:
+    """Overlap trace capture, processing and disk writes.
+
+    The calling thread drives the oscilloscope and arms it again right after
+    each download. Captured traces go through a bounded queue to ``workers``
+    processing threads, then through another bounded queue to a writer thread.
+    When a queue is full, capture waits: memory use stays bounded even if the
+    host is slower than the oscilloscope.
+
+    For example::
+
+        >>> def process(trace, clock):
+        ...     cycles = abby.processing.find_cycles(clock)
+        ...     return abby.processing.downsample_cycles(trace, cycles)
+        >>> pipeline = AcquisitionPipeline(scope, serial, process=process)
+        >>> pipeline.run((text, 17, f"{text.hex()}.npy") for text in texts)
+        >>> print(pipeline.report())
+    """
+
+    stages = ["capture", "process", "write"]
+
+    def __init__(
+        self,
+        scope,
+        serial,
+        process=None,
+        save=save_numpy,
+        workers=2,
+        queue_size=8,
+        average=1,
+        pipelined=True,
+    ):
+        """Initialize acquisition pipeline
+
+        :param scope: oscilloscope to acquire traces with
+        :type scope: abby.oscilloscope.Oscilloscope
+        :param serial: serial device connected to the target
+        :type serial: serial.Serial
+        :param process: function taking trace and clock and returning the
+            trace to save, defaults to saving raw trace
+        :type process: callable, optional
+        :param save: function taking destination and trace, defaults to
+            :func:`save_numpy`
+        :type save: callable, optional
+        :param workers: number of processing threads, defaults to 2
+        :type workers: int, optional
+        :param queue_size: maximum traces waiting in each queue, defaults to 8
+        :type queue_size: int, optional
+        :param average: amount of acquisitions to average, defaults to 1
+        :type average: int, optional
+        :param pipelined: arm again right after download, defaults to True
+        :type pipelined: bool, optional
+        """
+        self.scope = scope
+        self.serial = serial
+        self.process = process
+        self.save = save
+        self.workers = workers
+        self.queue_size = queue_size
+        self.average = average
+        self.pipelined = pipelined
+        self.stats = {stage: LatencyStats() for stage in self.stages}
+        self.elapsed = 0.0
+        self._error = None
+        self._lock = threading.Lock()
+
+    def _fail(self, error):
+        """Record first worker error so that capture stops."""
+        if self._error is None:
+            self._error = error
+
+    def _process_worker(self, in_queue, out_queue):
+        """Process captured traces until stop marker."""
+        while True:
+            item = in_queue.get()
+            if item is _STOP:
+                break
+            if self._error is not None:
+                continue  # drain queue so that capture never blocks
+            destination, trace, clock = item
+            try:
+                t = perf_counter()
+                if self.process is not None:
+                    trace = self.process(trace, clock)
+                with self._lock:
+                    self.stats["process"].add(perf_counter() - t)
+                out_queue.put((destination, trace))
+            except Exception as e:
+                self._fail(e)
+
+    def _write_worker(self, in_queue):
+        """Write processed traces until stop marker."""
+        while True:
+            item = in_queue.get()
+            if item is _STOP:
+                break
+            if self._error is not None:
+                continue
+            destination, trace = item
+            try:
+                t = perf_counter()
+                self.save(destination, trace)
+                self.stats["write"].add(perf_counter() - t)
+            except Exception as e:
+                self._fail(e)
+
+    def run(self, jobs):
+        """Acquire, process and save a trace for each job
+
+        :param jobs: input data, expected output length and destination for
+            each trace
+        :type jobs: iterable of (bytes, int, str)
+        :raises Exception: first error raised by a worker
+        :return: number of acquired traces
+        :rtype: int
+        """
+        process_queue = queue.Queue(self.queue_size)
+        write_queue = queue.Queue(self.queue_size)
+        process_threads = [
+            threading.Thread(
+                target=self._process_worker, args=(process_queue, write_queue)
+            )
+            for _ in range(self.workers)
+        ]
+        write_thread = threading.Thread(target=self._write_worker, args=(write_queue,))
+        for thread in process_threads + [write_thread]:
+            thread.start()
+
+        self._error = None
+        start = perf_counter()
+        count = 0
+        try:
+            for input_txt, output_len, destination in jobs:
+                if self._error is not None:
+                    break
+                t = perf_counter()
+                _, trace, clock = self.scope.run_and_acquire(
+                    input_txt,
+                    output_len,
+                    self.serial,
+                    average=self.average,
+                    pipelined=self.pipelined,
+                )
+                self.stats["capture"].add(perf_counter() - t)
+                process_queue.put((destination, trace, clock))
+                count += 1
+        finally:
+            # Stop workers in order, after queued traces are handled
+            for _ in process_threads:
+                process_queue.put(_STOP)
+            for thread in process_threads:
+                thread.join()
+            write_queue.put(_STOP)
+            write_thread.join()
+            self.elapsed += perf_counter() - start
+
+            # Do not leave an arming for settings of next acquisitions
+            self.scope.disarm()
+
+        if self._error is not None:
+            raise self._error
+        return count
+
+    def throughput(self, stage):
+        """Get traces per second handled by a stage since creation
+
+        :param stage: ``capture``, ``process`` or ``write``
+        :type stage: str
+        :return: throughput in traces per second
+        :rtype: float
+        """
+        return self.stats[stage].count / self.elapsed if self.elapsed else 0.0
+
+    def report(self):
+        """Summarize throughput and busy time of each stage
+
+        A stage busy close to 100% of the time is the bottleneck. Processing
+        busy time is summed over all workers.
+
+        :return: one line per stage
+        :rtype: str
+        """
+        lines = []
+        for stage in self.stages:
+            busy = self.stats[stage].total / self.elapsed if self.elapsed else 0.0
+            lines.append(
+                f"{stage}: {self.throughput(stage):.1f} traces/s, "
+                f"busy {busy:.0%}, {self.stats[stage]}"
+            )
+        return "\n".join(lines)
+
+
+class TraceStore:
+    """Folder of traces with an index shared by concurrent writers.
+
+    Each trace is saved with :func:`save_numpy` and gets a row in
+    ``index.csv`` with its name, length and metadata such as the rig which
+    acquired it.
+    """
+
+    fields = ["name", "length", "rig"]
+
+    def __init__(self, path, save=save_numpy):
+        """Open trace store, creating folder and index if missing
+
+        :param path: destination folder
+        :type path: str or pathlib.Path
+        :param save: function taking destination and trace, defaults to
+            :func:`save_numpy`
+        :type save: callable, optional
+        """
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.save = save
+        self._lock = threading.Lock()
+        index_path = self.path / "index.csv"
+        new = not index_path.is_file()
+        self._index = open(index_path, "a", newline="")
+        self._writer = csv.DictWriter(self._index, self.fields)
+        if new:
+            self._writer.writeheader()
+
+    def __enter__(self):
+        """For use with context manager.
+
+        :return: trace store
+        :rtype: TraceStore
+        """
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        """Called on context close."""
+        self.close()
+
+    def close(self):
+        """Close index file"""
+        self._index.close()
+
+    def __contains__(self, name):
+        """Check if a trace file exists in store
+
+        Raw traces saved by :func:`save_numpy` are found in their ``.npz``
+        file.
+
+        :param name: trace file name
+        :type name: str
+        :rtype: bool
+        """
+        return is_saved(self.path / name)
+
+    def put(self, name, trace, rig=None):
+        """Save a trace and add it to index
+
+        :param name: trace file name, relative to store folder
+        :type name: str
+        :param trace: trace to save
+        :type trace: np.ndarray or RawTrace
+        :param rig: name of the rig which acquired the trace, defaults to None
+        :type rig: str, optional
+        """
+        self.save(self.path / name, trace)
+        with self._lock:
+            self._writer.writerow({"name": name, "length": len(trace), "rig": rig})
+            self._index.flush()
+
+
+class Rig:
+    """Oscilloscope and serial device connected to one target board."""
+
+    def __init__(self, name, scope, serial):
+        """Initialize rig
+
+        :param name: name of the rig used in logs and trace index
+        :type name: str
+        :param scope: oscilloscope probing the board
+        :type scope: abby.oscilloscope.Oscilloscope
+        :param serial: serial device connected to the board
+        :type serial: serial.Serial
+        """
+        self.name = name
+        self.scope = scope
+        self.serial = serial
+        self.count = 0
+        self.failures = 0
+        self.dropped = False
+        self.stats = LatencyStats()
+
+    def __str__(self):
+        return self.name
+
+
+class Orchestrator:
+    """Shard acquisitions across several rigs acquiring in parallel.
+
+    Each rig has its own worker thread taking jobs from a shared queue, so
+    fast rigs do more acquisitions than slow ones. When an acquisition fails,
+    its job goes back to the queue for any rig to retry. A rig failing
+    ``max_failures`` times in a row is dropped while others keep going.
+
+    For example::
+
+        >>> rigs = [Rig("a", PS3000a(...), Serial("/dev/ttyUSB0")),
+        ...         Rig("b", PS3000a(...), Serial("/dev/ttyUSB1"))]
+        >>> with TraceStore("traces") as store:
+        ...     orchestrator = Orchestrator(rigs, store, process=process)
+        ...     orchestrator.run((text, 17, f"{text.hex()}.npy") for text in texts)
+    """
+
+    def __init__(
+        self,
+        rigs,
+        store,
+        process=None,
+        average=1,
+        pipelined=True,
+        max_failures=3,
+        max_attempts=3,
+    ):
+        """Initialize orchestrator
+
+        :param rigs: rigs to acquire with
+        :type rigs: [Rig]
+        :param store: trace store receiving traces of all rigs
+        :type store: TraceStore
+        :param process: function taking trace and clock and returning the
+            trace to save, defaults to saving raw trace
+        :type process: callable, optional
+        :param average: amount of acquisitions to average, defaults to 1
+        :type average: int, optional
+        :param pipelined: arm again right after download, defaults to True
+        :type pipelined: bool, optional
+        :param max_failures: consecutive failures before dropping a rig,
+            defaults to 3
+        :type max_failures: int, optional
+        :param max_attempts: attempts before giving up a job, defaults to 3
+        :type max_attempts: int, optional
+        """
+        self.rigs = rigs
+        self.store = store
+        self.process = process
+        self.average = average
+        self.pipelined = pipelined
+        self.max_failures = max_failures
+        self.max_attempts = max_attempts
+        self.failed = []
+        self._remaining = 0
+        self._lock = threading.Lock()
+
+    def _job_done(self):
+        """Count a job as handled, acquired or given up."""
+        with self._lock:
+            self._remaining -= 1
+
+    def _worker(self, rig, jobs):
+        """Acquire jobs with one rig until all are handled or rig fails."""
+        streak = 0
+        while self._remaining > 0:
+            try:
+                job, attempts = jobs.get(timeout=0.1)
+            except queue.Empty:
+                continue  # other rigs may still requeue jobs
+            input_txt, output_len, name = job
+            try:
+                t = perf_counter()
+                _, trace, clock = rig.scope.run_and_acquire(
+                    input_txt,
+                    output_len,
+                    rig.serial,
+                    average=self.average,
+                    pipelined=self.pipelined,
+                )
+                if self.process is not None:
+                    trace = self.process(trace, clock)
+                self.store.put(name, trace, rig=rig.name)
+                rig.stats.add(perf_counter() - t)
+            except Exception as e:
+                log.warning(f"Rig {rig} failed to acquire {name}: {e}")
+                rig.scope.disarm()  # rearm from scratch on next job
+                if attempts + 1 < self.max_attempts:
+                    jobs.put((job, attempts + 1))
+                else:
+                    log.error(f"Giving up {name} after {self.max_attempts} attempts")
+                    self.failed.append(job)
+                    self._job_done()
+                rig.failures += 1
+                streak += 1
+                if streak >= self.max_failures:
+                    log.error(f"Dropping rig {rig} after {streak} failures")
+                    rig.dropped = True
+                    return
+                continue
+            streak = 0
+            rig.count += 1
+            self._job_done()
+        rig.scope.disarm()
+
+    def run(self, jobs):
+        """Acquire, process and store a trace for each job
+
+        Jobs already in store are skipped.
+
+        :param jobs: input data, expected output length and trace file name
+            for each trace
+        :type jobs: iterable of (bytes, int, str)
+        :raises RuntimeError: if all rigs were dropped before the end
+        :return: number of acquired traces
+        :rtype: int
+        """
+        job_queue = queue.Queue()
+        for job in jobs:
+            if job[2] not in self.store:
+                job_queue.put((job, 0))
+        self._remaining = job_queue.qsize()
+        log.info(f"Acquiring {self._remaining} traces on {len(self.rigs)} rigs")
+
+        counts = [rig.count for rig in self.rigs]
+        threads = [
+            threading.Thread(target=self._worker, args=(rig, job_queue))
+            for rig in self.rigs
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self._remaining > 0:
+            raise RuntimeError(f"All rigs failed, {self._remaining} jobs left")
+        return sum(rig.count - c for rig, c in zip(self.rigs, counts))
+
+    def report(self):
+        """Summarize acquisitions and failures of each rig
+
+        :return: one line per rig
+        :rtype: str
+        """
+        return "\n".join(
+            f"{rig}: {rig.count} traces, {rig.failures} failures"
+            + (" (dropped)" if rig.dropped else "")
+            + f", {rig.stats}"
+            for rig in self.rigs
+        )
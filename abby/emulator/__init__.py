@@ -7,13 +7,20 @@ These execution traces are required to fit a model or do prediction.
 """
 
 from abby.emulator.base import Emulator
+from abby.emulator.cache import CachedEmulator
 from abby.emulator.jtrace import JTraceEmulator
+from abby.emulator.pool import EmulatorPool
 from abby.emulator.qemu import QEMUEmulator
-from abby.emulator.thumbulator import ThumbulatorEmulator
+from abby.emulator.thumbulator import ThumbulatorEmulator, ThumbulatorSession
+from abby.emulator.unicorn import UnicornEmulator
 
 __all__ = [
+    "CachedEmulator",
     "Emulator",
+    "EmulatorPool",
     "JTraceEmulator",
     "QEMUEmulator",
     "ThumbulatorEmulator",
+    "ThumbulatorSession",
+    "UnicornEmulator",
 ]
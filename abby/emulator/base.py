@@ -5,16 +5,39 @@
 Base emulator
 """
 
+import functools
 import logging
+import multiprocessing
+import multiprocessing.util
+
+import numpy as np
 
 # Local logger
 log = logging.getLogger(__name__)
 
+# Emulator of a worker process
+_worker_emulator = None
+
+
+def _init_worker(factory):
+    """Create emulator of a worker process, closed when worker exits."""
+    global _worker_emulator
+    _worker_emulator = factory()
+    multiprocessing.util.Finalize(None, _worker_emulator.close, exitpriority=10)
+
+
+def _run_worker_chunk(chunk, output_data_length):
+    """Run a chunk of inputs on emulator of worker process."""
+    return _worker_emulator._run_batch(chunk, output_data_length)
+
 
 class Emulator:
     """Common interface for emulators
 
     All emulators should inherit this base class.
+
+    Emulators record instructions executed between a write to trigger begin
+    address and a write to trigger end address, when they support it.
     """
 
     def run(self, input_data: bytes):
@@ -26,3 +49,174 @@ class Emulator:
         :rtype: (bytes, [[str or int]])
         """
         raise NotImplementedError()
+
+    def run_chunks(self, input_data: bytes, output_data_length: int, chunk_size=2**16):
+        """Run emulation, yielding execution trace chunks.
+
+        Output data is the return value of the generator, for example
+        ``output_data = yield from emulator.run_chunks(input_data, 17)``.
+        Emulators able to stream should override this method, by default the
+        whole execution trace is split once recorded.
+
+        :param input_data: input data to send to the serial port
+        :type input_data: bytes
+        :param output_data_length: expected length of output
+        :type output_data_length: int
+        :param chunk_size: instructions in each chunk, defaults to 65536
+        :type chunk_size: int, optional
+        :return: generator of execution trace chunks
+        :rtype: generator of pandas.DataFrame or np.ndarray
+        """
+        output_data, execution_trace = self.run(input_data, output_data_length)
+        rows = getattr(execution_trace, "iloc", execution_trace)
+        for start in range(0, len(execution_trace), chunk_size):
+            yield rows[start : start + chunk_size]
+        return output_data
+
+    @staticmethod
+    def crop_nop_chunks(chunks, padding=450):
+        """Crop NOP paddings of an execution trace while it is streamed
+
+        As :meth:`abby.emulator.ThumbulatorEmulator.crop_nop`, but without
+        the whole execution trace: rows are kept from the end of the first
+        run of at least ``padding`` NOP instructions to the beginning of the
+        next one. Shorter NOP runs are part of the code, only those are
+        held back until the next instruction.
+
+        :param chunks: execution trace chunks, see :meth:`run_chunks`
+        :type chunks: iterable of pandas.DataFrame or np.ndarray
+        :param padding: minimum length of NOP paddings, defaults to 450
+        :type padding: int, optional
+        :return: generator of cropped chunks
+        :rtype: generator of pandas.DataFrame or np.ndarray
+        """
+        started = False
+        nops = 0  # length of the current NOP run
+        pending = []  # NOP rows of previous chunks, maybe part of the code
+        for chunk in chunks:
+            is_nop = np.asarray(chunk["opcode"]) == 0x46C0
+            rows = getattr(chunk, "iloc", chunk)
+            bounds = [0, *(np.flatnonzero(np.diff(is_nop)) + 1), len(is_nop)]
+            lo = hi = 0  # rows of this chunk to keep
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                if is_nop[start]:
+                    nops += end - start
+                    if started and nops >= padding:
+                        if hi > lo:
+                            yield rows[lo:hi]
+                        return
+                    continue
+                if not started and nops >= padding:
+                    started = True
+                    lo = start
+                if started:
+                    yield from pending
+                    pending = []
+                    hi = end
+                nops = 0
+            if started:
+                if hi > lo:
+                    yield rows[lo:hi]
+                if hi < len(is_nop):
+                    pending.append(rows[max(hi, lo) :])
+
+    def _run_batch(self, inputs, output_data_length: int):
+        """Run emulation for each input data in this process.
+
+        Emulators keeping state between runs should override this method to
+        do a batch in one go.
+        """
+        return [self.run(input_data, output_data_length) for input_data in inputs]
+
+    def _factory(self):
+        """Get a picklable function creating an emulator like this one."""
+        raise NotImplementedError(
+            f"{type(self).__name__} needs a factory to run in worker processes"
+        )
+
+    def imap(
+        self, inputs, output_data_length: int, workers=1, chunksize=1, factory=None
+    ):
+        """Run emulation for each input data, yielding results in input order
+
+        With more than one worker, each worker process creates its own
+        emulator with ``factory`` and runs chunks of inputs.
+
+        :param inputs: input data to send to the serial port for each run
+        :type inputs: iterable of bytes
+        :param output_data_length: expected length of each output
+        :type output_data_length: int
+        :param workers: number of worker processes, defaults to 1 to run in
+            this process
+        :type workers: int, optional
+        :param chunksize: inputs sent to a worker at once, defaults to 1
+        :type chunksize: int, optional
+        :param factory: picklable function without arguments returning a new
+            emulator, defaults to one creating an emulator like this one
+        :type factory: callable, optional
+        :return: generator of output data and execution trace of each run
+        :rtype: generator of (bytes, [[str or int]])
+        """
+        inputs = list(inputs)
+        chunks = [inputs[i : i + chunksize] for i in range(0, len(inputs), chunksize)]
+        if workers == 1:
+            for chunk in chunks:
+                yield from self._run_batch(chunk, output_data_length)
+            return
+
+        factory = factory or self._factory()
+        run_chunk = functools.partial(
+            _run_worker_chunk, output_data_length=output_data_length
+        )
+        pool = multiprocessing.Pool(workers, _init_worker, (factory,))
+        try:
+            for results in pool.imap(run_chunk, chunks):
+                yield from results
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def run_many(
+        self, inputs, output_data_length: int, workers=1, chunksize=1, factory=None
+    ):
+        """Run emulation for each input data.
+
+        See :meth:`imap` to run inputs in worker processes.
+
+        :param inputs: input data to send to the serial port for each run
+        :type inputs: [bytes]
+        :param output_data_length: expected length of each output
+        :type output_data_length: int
+        :param workers: number of worker processes, defaults to 1 to run in
+            this process
+        :type workers: int, optional
+        :param chunksize: inputs sent to a worker at once, defaults to 1
+        :type chunksize: int, optional
+        :param factory: picklable function without arguments returning a new
+            emulator, defaults to one creating an emulator like this one
+        :type factory: callable, optional
+        :return: output data and execution trace of each run
+        :rtype: [(bytes, [[str or int]])]
+        """
+        if workers == 1:
+            return self._run_batch(list(inputs), output_data_length)
+        return list(self.imap(inputs, output_data_length, workers, chunksize, factory))
+
+    def save_state(self):
+        """Save emulator state to come back to it with :meth:`load_state`.
+
+        Emulators able to do it save their state while firmware waits for
+        input, so that each run starts from the same state.
+        """
+        raise NotImplementedError()
+
+    def load_state(self):
+        """Restore state saved with :meth:`save_state`."""
+        raise NotImplementedError()
+
+    def close(self):
+        """Release emulator resources."""
+        pass
@@ -0,0 +1,148 @@
+# Copyright (C) 2020-2021  
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Cache of execution traces shared between emulators runs.
+"""
+
+import hashlib
+import logging
+
+import numpy as np
+import pandas as pd
+
+from abby.emulator.base import Emulator
+from abby.processing import ProcessingCache
+
+# Local logger
+log = logging.getLogger(__name__)
+
+
+class CachedEmulator(Emulator):
+    """Emulator reusing execution traces of previous runs.
+
+    Results are stored in a :class:`abby.processing.ProcessingCache` keyed by
+    firmware content hash, emulator class and parameters, board and input
+    data, so the same cache folder can be shared by scripts and backends.
+    DataFrames are stored as NumPy records and converted back when loaded.
+
+    For example::
+
+        >>> qemu = QEMUEmulator(fw_path, board)
+        >>> emulator = CachedEmulator(qemu, "/tmp/abby_cache")
+        >>> output_data, execution_trace = emulator.run(input_data, 17)
+    """
+
+    def __init__(self, emulator, cache, board=None):
+        """Wrap an emulator.
+
+        :param emulator: emulator running inputs missing from cache
+        :type emulator: Emulator
+        :param cache: cache or folder to store execution traces in
+        :type cache: ProcessingCache or str or pathlib.Path
+        :param board: emulated board, defaults to emulator board if any
+        :type board: str, optional
+        """
+        self.emulator = emulator
+        if not isinstance(cache, ProcessingCache):
+            cache = ProcessingCache(cache)
+        self.cache = cache
+        self.board = board or getattr(emulator, "board", None)
+        with open(emulator.fw_path, "rb") as f:
+            self.fw_hash = hashlib.blake2b(f.read(), digest_size=20).hexdigest()
+        self.config = self._config(emulator)
+
+    @staticmethod
+    def _config(emulator) -> str:
+        """Describe emulator parameters changing execution traces.
+
+        Parameters are the ones given to a new emulator by its factory, plus
+        the emulator binaries and power model, but not firmware path as its
+        content is hashed.
+        """
+        try:
+            factory = emulator._factory()
+            args = [a for a in factory.args if a != emulator.fw_path]
+            params = [args, sorted(factory.keywords.items())]
+        except NotImplementedError:
+            params = []
+        for attribute in ["qemu_path", "plugin_path", "model_path"]:
+            if hasattr(emulator, attribute):
+                params.append((attribute, str(getattr(emulator, attribute))))
+        return repr(params)
+
+    def key(self, input_data: bytes, output_data_length: int) -> str:
+        """Compute cache key of a run.
+
+        :param input_data: input data to send to the serial port
+        :type input_data: bytes
+        :param output_data_length: expected length of output
+        :type output_data_length: int
+        :return: hexadecimal key
+        :rtype: str
+        """
+        return self.cache.key(
+            "abby.emulator.CachedEmulator",
+            self.fw_hash,
+            type(self.emulator).__name__,
+            self.config,
+            self.board,
+            bytes(input_data),
+            output_data_length,
+        )
+
+    @staticmethod
+    def _to_arrays(output_data, execution_trace):
+        """Convert a run result to arrays to store."""
+        output = np.frombuffer(bytes(output_data), dtype=np.uint8)
+        if not isinstance(execution_trace, pd.DataFrame):
+            return output, np.asarray(execution_trace), np.array(False)
+        columns = []
+        for _, column in execution_trace.items():
+            dtype = str if column.dtype.kind == "O" else None
+            columns.append(column.to_numpy(dtype))
+        records = np.rec.fromarrays(columns, names=list(execution_trace.columns))
+        return output, records.view(np.ndarray), np.array(True)
+
+    @staticmethod
+    def _from_arrays(output, records, is_dataframe):
+        """Convert stored arrays back to a run result."""
+        if not is_dataframe:
+            return output.tobytes(), records
+        df = pd.DataFrame.from_records(records)
+        for c in df.columns:
+            if df[c].dtype.kind == "U":
+                df[c] = df[c].astype(object)
+        return output.tobytes(), df
+
+    def _run_batch(self, inputs, output_data_length: int):
+        """Run emulation for inputs missing from cache."""
+        keys = [self.key(input_data, output_data_length) for input_data in inputs]
+        results = [self.cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        self.cache.record(hits=len(inputs) - len(missing), misses=len(missing))
+        if missing:
+            log.debug(f"Emulating {len(missing)} of {len(inputs)} inputs")
+            new_results = self.emulator.run_many(
+                [inputs[i] for i in missing], output_data_length
+            )
+            for i, result in zip(missing, new_results):
+                results[i] = self._to_arrays(*result)
+                self.cache.put(keys[i], results[i])
+        return [self._from_arrays(*result) for result in results]
+
+    def run(self, input_data: bytes, output_data_length: int):
+        """Run emulation or load execution trace from cache.
+
+        :param input_data: input data to send to the serial port
+        :type input_data: bytes
+        :param output_data_length: expected length of output
+        :type output_data_length: int
+        :return: output data and execution trace
+        :rtype: (bytes, [[str or int]])
+        """
+        return self._run_batch([input_data], output_data_length)[0]
+
+    def close(self):
+        """Close wrapped emulator."""
+        self.emulator.close()
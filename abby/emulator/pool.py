@@ -0,0 +1,161 @@
+# Copyright (C) 2020-2021  
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Pool of emulators running inputs in parallel.
+"""
+
+import collections
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Local logger
+log = logging.getLogger(__name__)
+
+
+class EmulatorPool:
+    """Spread inputs across several emulator instances.
+
+    Each instance runs in its own process, for example QEMU, so threads are
+    enough to keep all of them busy. Inputs are sent in chunks with
+    :meth:`abby.emulator.Emulator.run_many` and results are returned in
+    input order. An instance raising an error is closed and replaced by a new
+    one, then its chunk is run again. If it cannot be replaced, next chunk
+    tries to start a new one.
+
+    For example::
+
+        >>> factory = functools.partial(QEMUEmulator, fw_path, "stm32f0discovery")
+        >>> with EmulatorPool(factory, workers=8) as pool:
+        ...     for output, execution_trace in pool.imap(inputs, 17):
+        ...         ...
+    """
+
+    def __init__(self, factory, workers=None, max_restarts=3):
+        """Start emulators
+
+        :param factory: function without arguments returning a new emulator
+        :type factory: callable
+        :param workers: number of emulators, defaults to CPU count
+        :type workers: int, optional
+        :param max_restarts: restarts allowed for each chunk before raising
+            the error, defaults to 3
+        :type max_restarts: int, optional
+        :raises Exception: error of the factory, once started emulators are
+            closed
+        """
+        self.factory = factory
+        self.workers = workers or os.cpu_count()
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._idle = queue.Queue()
+        try:
+            for _ in range(self.workers):
+                self._idle.put(factory())
+        except Exception:
+            # Do not leak emulators started before the failing one
+            self.close()
+            raise
+
+    def __enter__(self):
+        """For use with context manager.
+
+        :return: emulator pool
+        :rtype: EmulatorPool
+        """
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        """Called on context close."""
+        self.close()
+
+    def close(self):
+        """Close all emulators"""
+        while not self._idle.empty():
+            emulator = self._idle.get()
+            if emulator is not None:
+                emulator.close()
+
+    def _run_chunk(self, chunk, output_data_length):
+        """Run a chunk of inputs on an idle emulator, restarting it on error."""
+        emulator = self._idle.get()
+        try:
+            for attempt in range(self.max_restarts + 1):
+                try:
+                    if emulator is None:
+                        emulator = self.factory()
+                    return emulator.run_many(chunk, output_data_length)
+                except Exception as e:
+                    if emulator is not None:
+                        self._close(emulator)
+                        emulator = None
+                    if attempt == self.max_restarts:
+                        raise
+                    log.warning(f"Restarting emulator after error: {e}")
+                    with self._lock:
+                        self.restarts += 1
+        finally:
+            # Only a healthy emulator is reused, otherwise next chunk starts one
+            self._idle.put(emulator)
+
+    @staticmethod
+    def _close(emulator):
+        """Close a failed emulator, ignoring errors as it is dropped."""
+        try:
+            emulator.close()
+        except Exception as e:
+            log.warning(f"Failed to close emulator: {e}")
+
+    def imap(self, inputs, output_data_length: int, chunksize=1):
+        """Run emulation for each input, yielding results in input order
+
+        At most two chunks per emulator are in flight, so inputs and results
+        are never all in memory.
+
+        :param inputs: input data to send to the serial port for each run
+        :type inputs: iterable of bytes
+        :param output_data_length: expected length of each output
+        :type output_data_length: int
+        :param chunksize: inputs sent to an emulator at once, defaults to 1
+        :type chunksize: int, optional
+        :raises Exception: error of an emulator failing after all restarts
+        :return: generator of output data and execution trace of each run
+        :rtype: generator of (bytes, [[str or int]])
+        """
+        with ThreadPoolExecutor(self.workers) as executor:
+            pending = collections.deque()
+            chunk = []
+            for input_data in inputs:
+                chunk.append(input_data)
+                if len(chunk) < chunksize:
+                    continue
+                pending.append(
+                    executor.submit(self._run_chunk, chunk, output_data_length)
+                )
+                chunk = []
+                if len(pending) > 2 * self.workers:
+                    yield from pending.popleft().result()
+            if chunk:
+                pending.append(
+                    executor.submit(self._run_chunk, chunk, output_data_length)
+                )
+            while pending:
+                yield from pending.popleft().result()
+
+    def run_many(self, inputs, output_data_length: int, chunksize=1):
+        """Run emulation for each input in parallel
+
+        :param inputs: input data to send to the serial port for each run
+        :type inputs: [bytes]
+        :param output_data_length: expected length of each output
+        :type output_data_length: int
+        :param chunksize: inputs sent to an emulator at once, defaults to 1
+        :type chunksize: int, optional
+        :return: output data and execution trace of each run
+        :rtype: [(bytes, [[str or int]])]
+        """
+        return list(self.imap(inputs, output_data_length, chunksize))
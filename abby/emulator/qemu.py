@@ -5,14 +5,19 @@
 QEMU emulator.
 """
 
+import functools
+import io
 import logging
 import os
 import socket
 import subprocess
 import tempfile
+from time import perf_counter, sleep
 
+import numpy as np
 import pandas as pd
 
+from abby.emulator import trace
 from abby.emulator.base import Emulator
 
 # Local logger
@@ -23,13 +28,37 @@ class QEMUEmulator(Emulator):
     """QEMU emulator.
 
     Require a patched version of QEMU with logcorestate TCG plugin.
+
+    QEMU keeps running between executions and the plugin appends to the
+    same CSV file. Once the trigger end address is written, the plugin ends
+    the rows of the execution with an :attr:`end_marker` line. Executions are
+    split on these markers and the file offset after the last parsed marker
+    is recorded so that only the rows of new executions are parsed.
+
+    With ``binary``, the plugin writes fixed-width records described in
+    :mod:`abby.emulator.trace` instead of CSV. Execution traces are then
+    memory mapped structured arrays, see
+    :func:`abby.emulator.trace.to_dataframe` to get a DataFrame. Executions
+    are then ended by a record with :data:`abby.emulator.trace.end_code`
+    instruction.
+
+    With ``snapshot``, the first input is run once as a warm-up, then a VM
+    snapshot is saved while firmware waits for next input and restored before
+    each run, including the first one. Runs are then independent, do not
+    depend on previous inputs and do not pay the boot time again.
     """
 
     qemu_path = "/home/sirena/abby/qemu_emulation/qemu/build/qemu-system-arm"
+
+    # Defaults to qemu-img next to qemu_path
+    qemu_img_path = None
     plugin_path = (
         "/home/sirena/abby/qemu_emulation/qemu/build/contrib/plugins/liblogcorestate.so"
     )
 
+    # Line written by the plugin after the CSV rows of each execution
+    end_marker = b"#end\n"
+
     # Board profiles store QEMU machine name and trigger addresses
     boards_profiles = {
         "microbit": ("bbcmicrobit", "1342178568", "1342178572"),
@@ -37,24 +66,75 @@ class QEMUEmulator(Emulator):
         "stm32f0discovery": ("disco_f051r8", "1073809424", "1073809424"),  # TODO
     }
 
-    def __init__(self, fw_path: str, board: str):
+    def __init__(
+        self,
+        fw_path: str,
+        board: str,
+        timeout=10.0,
+        binary=False,
+        port=None,
+        snapshot=False,
+        trigger_begin=None,
+        trigger_end=None,
+    ):
         """Initialize QEMU.
 
-        We start QEMU machine only once, then feed the input via TCP.
+        We start QEMU machine only once, then feed the input through its serial
+        port socket.
 
         :param fw_path: path to the firmware compiled file.
         :type fw_path: str
         :param board: Board to emulate.
         :type board: str
+        :param timeout: maximum time to wait for output data in seconds,
+            defaults to 10 s
+        :type timeout: float, optional
+        :param binary: record execution trace in binary format, defaults to
+            False
+        :type binary: bool, optional
+        :param port: TCP port of QEMU serial port, defaults to a Unix socket
+            in a private folder so that multiple instances can run on the
+            same host
+        :type port: int, optional
+        :param snapshot: restore a snapshot taken while firmware waits for
+            input before each run, defaults to False
+        :type snapshot: bool, optional
+        :param trigger_begin: address written to begin recording, defaults to
+            board profile address
+        :type trigger_begin: int, optional
+        :param trigger_end: address written to end recording, defaults to
+            board profile address
+        :type trigger_end: int, optional
+        :raises ConnectionError: if QEMU serial port is not reachable
         """
         # Get memory physical address of trigger begin and end (GPIO write)
         if board not in self.boards_profiles:
             raise NotImplementedError("unknown board profile")
-        machine, trigger_begin, trigger_end = self.boards_profiles[board]
+        machine, profile_begin, profile_end = self.boards_profiles[board]
+        trigger_begin = str(trigger_begin or profile_begin)
+        trigger_end = str(trigger_end or profile_end)
 
         # Init QEMU
         log.debug(f"Initializing QEMU machine {machine} with {fw_path}")
-        self.trace_path = os.path.join(tempfile.mkdtemp(), "execution.csv")
+        self.fw_path = fw_path
+        self.board = board
+        self.timeout = timeout
+        self.trigger_begin = trigger_begin
+        self.trigger_end = trigger_end
+        self.binary = binary
+        trace_name = "execution.bin" if binary else "execution.csv"
+        workspace = tempfile.mkdtemp()
+        self.trace_path = os.path.join(workspace, trace_name)
+        self.port = port
+        if port is None:
+            serial_address = os.path.join(workspace, "serial.sock")
+            serial_chardev = f"unix:{serial_address},server=on,wait=off"
+        else:
+            serial_address = port
+            serial_chardev = f"tcp:127.0.0.1:{port},server=on,wait=off"
+        plugin_args = [self.trace_path, trigger_begin, trigger_end, "3"]
+        if binary:
+            plugin_args.append("binary")
         cmd = [
             self.qemu_path,
             "-M",
@@ -62,19 +142,240 @@ class QEMUEmulator(Emulator):
             "-kernel",
             fw_path,
             "-serial",
-            "tcp::5678,server=on,wait=off",
+            serial_chardev,
             "-nographic",
             "-plugin",
-            f"{self.plugin_path},arg={self.trace_path},"
-            f"arg={trigger_begin},arg={trigger_end},arg=3",
+            ",".join([self.plugin_path] + [f"arg={arg}" for arg in plugin_args]),
             "-d",
             "plugin",
         ]
+
+        # Snapshots are stored in a qcow2 drive, VM is controlled by monitor
+        self.snapshot = snapshot
+        self._snapshot_saved = False
+        if snapshot:
+            drive_path = os.path.join(workspace, "snapshots.qcow2")
+            subprocess.run(
+                [self._qemu_img(), "create", "-f", "qcow2", drive_path, "1M"],
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+            monitor_address = os.path.join(workspace, "monitor.sock")
+            cmd += [
+                "-drive",
+                f"if=none,format=qcow2,file={drive_path}",
+                "-monitor",
+                f"unix:{monitor_address},server=on,wait=off",
+            ]
         self.proc = subprocess.Popen(cmd)
 
-        # Init socket
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect(("127.0.0.1", 5678))
+        # Init socket once QEMU listens
+        self.socket = self._connect(serial_address, timeout)
+        self.monitor = None
+        if snapshot:
+            self.monitor = self._connect(monitor_address, timeout)
+            self._read_prompt()
+
+        # Execution trace file is parsed from this offset
+        self._trace_offset = 0
+        self._columns = None
+
+    def _qemu_img(self) -> str:
+        """Get path of qemu-img, from the same build as QEMU by default."""
+        if self.qemu_img_path is not None:
+            return self.qemu_img_path
+        return os.path.join(os.path.dirname(self.qemu_path), "qemu-img")
+
+    def _connect(self, address, timeout: float) -> socket.socket:
+        """Connect to a QEMU TCP port or Unix socket, retrying while QEMU starts.
+
+        :param address: TCP port or Unix socket path to connect to
+        :type address: int or str
+        :param timeout: maximum time to wait in seconds
+        :type timeout: float
+        :raises ConnectionError: if QEMU exited or timeout expired
+        :return: connected socket
+        :rtype: socket.socket
+        """
+        deadline = perf_counter() + timeout
+        while True:
+            try:
+                if isinstance(address, int):
+                    return socket.create_connection(("127.0.0.1", address), timeout)
+                s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                s.settimeout(timeout)
+                try:
+                    s.connect(address)
+                except OSError:
+                    s.close()
+                    raise
+                return s
+            except (ConnectionRefusedError, FileNotFoundError) as e:
+                if self.proc.poll() is not None or perf_counter() > deadline:
+                    raise ConnectionError(f"QEMU not listening on {address}") from e
+                sleep(0.01)
+
+    def _read_prompt(self) -> str:
+        """Read QEMU monitor output until next prompt.
+
+        :raises ConnectionError: if QEMU closed the connection
+        :return: monitor output
+        :rtype: str
+        """
+        data = bytearray()
+        while not data.endswith(b"(qemu) "):
+            chunk = self.monitor.recv(4096)
+            if not chunk:
+                raise ConnectionError("QEMU closed monitor connection")
+            data += chunk
+        return data.decode(errors="replace")
+
+    def _monitor_command(self, command: str) -> str:
+        """Run a QEMU monitor command.
+
+        :param command: human monitor command
+        :type command: str
+        :raises RuntimeError: if QEMU reports an error
+        :return: command output
+        :rtype: str
+        """
+        self.monitor.sendall(command.encode() + b"\n")
+        output = self._read_prompt()
+        if "Error" in output:
+            raise RuntimeError(f"QEMU failed to run {command}: {output}")
+        return output
+
+    def save_state(self):
+        """Save a VM snapshot."""
+        log.debug("Saving QEMU snapshot")
+        self._monitor_command("savevm abby")
+        self._snapshot_saved = True
+
+    def load_state(self):
+        """Restore the VM snapshot."""
+        self._monitor_command("loadvm abby")
+
+    def _recv_exact(self, length: int) -> bytes:
+        """Receive exactly length bytes from QEMU serial port.
+
+        :param length: number of bytes to receive
+        :type length: int
+        :raises ConnectionError: if QEMU closed the connection
+        :return: received data
+        :rtype: bytes
+        """
+        data = bytearray()
+        while len(data) < length:
+            chunk = self.socket.recv(length - len(data))
+            if not chunk:
+                raise ConnectionError("QEMU closed serial connection")
+            data += chunk
+        return bytes(data)
+
+    def _read_header(self, f):
+        """Read CSV columns, written once at the beginning of the file."""
+        if self._columns is None:
+            header = f.readline()
+            self._columns = header.decode().strip().split(",")
+            self._trace_offset = len(header)
+
+    def _wait_trace(self, deadline: float):
+        """Wait for the plugin to write more of the execution trace.
+
+        :param deadline: time after which to stop waiting
+        :type deadline: float
+        :raises ConnectionError: if QEMU exited or deadline expired
+        """
+        if self.proc.poll() is not None or perf_counter() > deadline:
+            raise ConnectionError("QEMU did not end execution trace")
+        sleep(0.001)
+
+    def _read_run(self, block_size=2**20):
+        """Read CSV rows of next run block by block, up to its end marker.
+
+        Rows are only yielded once complete and the trace offset is moved
+        after the end marker, so rows flushed after the output was received
+        still belong to their run.
+
+        :param block_size: bytes read at once, defaults to 1 MiB
+        :type block_size: int, optional
+        :raises ConnectionError: if QEMU did not write the end marker in time
+        :return: generator of complete CSV rows
+        :rtype: generator of bytes
+        """
+        deadline = perf_counter() + self.timeout
+        with open(self.trace_path, "rb") as f:
+            self._read_header(f)
+            f.seek(self._trace_offset)
+            position = self._trace_offset
+            block = b""
+            while True:
+                data = f.read(block_size)
+                if not data:
+                    self._wait_trace(deadline)
+                    continue
+                block += data
+
+                # Block begins a line, rows never begin with "#"
+                marker = (b"\n" + block).find(b"\n" + self.end_marker)
+                if marker >= 0:
+                    self._trace_offset = position + marker + len(self.end_marker)
+                    if marker:
+                        yield block[:marker]
+                    return
+                cut = block.rfind(b"\n") + 1
+                if cut:
+                    yield block[:cut]
+                    block = block[cut:]
+                    position += cut
+
+    def _read_segments(self, runs: int):
+        """Parse execution trace of the next runs, one per run.
+
+        :param runs: number of runs
+        :type runs: int
+        :raises ConnectionError: if QEMU did not write end markers in time
+        :return: execution trace of each run
+        :rtype: [pandas.DataFrame] or [np.ndarray]
+        """
+        if self.binary:
+            return self._map_segments(runs)
+
+        dfs = []
+        for _ in range(runs):
+            segment = b"".join(self._read_run())
+            if segment.strip():
+                df = pd.read_csv(io.BytesIO(segment), names=self._columns)
+            else:
+                df = pd.DataFrame(columns=self._columns)
+            log.debug(f"Recorded {df.shape[0]} instructions")
+            dfs.append(df)
+        return dfs
+
+    def _map_segments(self, runs: int):
+        """Map binary records of the next runs, one array per run.
+
+        :param runs: number of runs
+        :type runs: int
+        :raises ConnectionError: if QEMU did not write end records in time
+        :return: execution trace records of each run
+        :rtype: [np.ndarray]
+        """
+        # Wait for end records, ignoring any partially written record
+        size = trace.record_dtype.itemsize
+        deadline = perf_counter() + self.timeout
+        while True:
+            count = (os.path.getsize(self.trace_path) - self._trace_offset) // size
+            records = trace.load(self.trace_path, self._trace_offset, count)
+            ends = np.flatnonzero(records["instr_stage3"] == trace.end_code)
+            if len(ends) >= runs:
+                break
+            self._wait_trace(deadline)
+        ends = ends[:runs]
+        self._trace_offset += (int(ends[-1]) + 1) * size
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        log.debug(f"Recorded {ends[-1] + 1 - runs} instructions in {runs} runs")
+        return [records[start:end] for start, end in zip(starts, ends)]
 
     def run(self, input_data: bytes, output_data_length: int):
         """Send input data and return output data and execution trace.
@@ -83,25 +384,127 @@ class QEMUEmulator(Emulator):
         :type input_data: bytes
         :param output_data_length: expected length of output
         :type output_data_length: int
+        :raises ConnectionError: if QEMU closed the connection
         :return: output data and execution trace
-        :rtype: (bytes, [[str or int]])
+        :rtype: (bytes, pandas.DataFrame or np.ndarray)
         """
-        # Send input_data to TCP socket and get output
+        return self._run_batch([input_data], output_data_length)[0]
+
+    def run_chunks(self, input_data: bytes, output_data_length: int, chunk_size=2**16):
+        """Send input data and parse execution trace chunk by chunk.
+
+        The trace file is read block by block, so the execution trace is
+        never whole in memory. Binary records are memory mapped.
+
+        :param input_data: input data to send to the serial port
+        :type input_data: bytes
+        :param output_data_length: expected length of output
+        :type output_data_length: int
+        :param chunk_size: instructions in each chunk, defaults to 65536
+        :type chunk_size: int, optional
+        :raises ConnectionError: if QEMU closed the connection
+        :return: generator of execution trace chunks
+        :rtype: generator of pandas.DataFrame or np.ndarray
+        """
+        output_data = self._send(input_data, output_data_length)
+        if self.binary:
+            records = self._map_segments(1)[0]
+            for start in range(0, len(records), chunk_size):
+                yield records[start : start + chunk_size]
+            return output_data
+
+        blocks = self._read_run(64 * chunk_size)
+        try:
+            for block in blocks:
+                yield from pd.read_csv(
+                    io.BytesIO(block), names=self._columns, chunksize=chunk_size
+                )
+        finally:
+            # Skip rows left when the stream is closed early, as when cropped
+            for _ in blocks:
+                pass
+        return output_data
+
+    def _factory(self):
+        """Get a function starting QEMU with the same parameters."""
+        return functools.partial(
+            QEMUEmulator,
+            self.fw_path,
+            self.board,
+            timeout=self.timeout,
+            binary=self.binary,
+            snapshot=self.snapshot,
+            trigger_begin=self.trigger_begin,
+            trigger_end=self.trigger_end,
+        )
+
+    def _run_batch(self, inputs, output_data_length: int):
+        """Send each input data and return outputs and execution traces.
+
+        Outputs are received first, then new rows are read at once and split
+        between runs on their end markers.
+
+        :param inputs: input data to send to the serial port for each run
+        :type inputs: [bytes]
+        :param output_data_length: expected length of each output
+        :type output_data_length: int
+        :raises ConnectionError: if QEMU closed the connection
+        :return: output data and execution trace of each run
+        :rtype: [(bytes, pandas.DataFrame or np.ndarray)]
+        """
+        outputs = [self._send(input_data, output_data_length) for input_data in inputs]
+        if not outputs:
+            return []
+        return list(zip(outputs, self._read_segments(len(outputs))))
+
+    def _warm_up(self, input_data: bytes, output_data_length: int):
+        """Run once, then save a snapshot while firmware waits for next input.
+
+        Once the first output is received, firmware finished booting and
+        its serial port is enabled, so restored runs neither boot again nor
+        lose input bytes.
+
+        :param input_data: input data to send to the serial port
+        :type input_data: bytes
+        :param output_data_length: expected length of output
+        :type output_data_length: int
+        :raises ConnectionError: if QEMU closed the connection
+        """
+        log.debug("Warming up QEMU before saving snapshot")
         self.socket.sendall(input_data)
-        output_data = b""
-        while True:
-            data = self.socket.recv(1024)
-            if data == "":
-                break
-            output_data += data
+        self._recv_exact(output_data_length)
 
-        # Load output CSV
-        df = pd.read_csv(self.trace_path)
-        log.debug(f"Recorded {df.shape[0]} instructions")
+        # Skip execution trace of warm-up run
+        self._read_segments(1)
+        self.save_state()
 
-        return output_data, df
+    def _send(self, input_data: bytes, output_data_length: int):
+        """Run on one input and get its output.
+
+        :param input_data: input data to send to the serial port
+        :type input_data: bytes
+        :param output_data_length: expected length of output
+        :type output_data_length: int
+        :raises ConnectionError: if QEMU closed the connection
+        :return: output data
+        :rtype: bytes
+        """
+        if self.snapshot and not self._snapshot_saved:
+            self._warm_up(input_data, output_data_length)
+        if self._snapshot_saved:
+            self.load_state()
+        self.socket.sendall(input_data)
+        return self._recv_exact(output_data_length)
+
+    def close(self):
+        """Close socket and kill QEMU."""
+        if getattr(self, "socket", None) is not None:
+            self.socket.close()
+        if getattr(self, "monitor", None) is not None:
+            self.monitor.close()
+        if getattr(self, "proc", None) is not None:
+            self.proc.terminate()
 
     def __del__(self):
         """Close socket and kill QEMU."""
-        self.socket.close()
-        self.proc.terminate()
+        self.close()
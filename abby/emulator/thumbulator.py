@@ -5,11 +5,14 @@
 Thumbulator wrapper to get an execution trace.
 """
 
+import functools
 import logging
 import tempfile
 
+import numpy as np
 import pandas as pd
 
+from abby.emulator import trace
 from abby.emulator.base import Emulator
 
 # Local logger
@@ -29,6 +32,11 @@ class ThumbulatorEmulator(Emulator):
     When using this emulator, some instruction related to GPIO might create
     unpredictable outputs. To circumvent this, we need a firmware compiled with
     ``ELMO`` flag.
+
+    When ``elmotrace`` provides ``run_buffer``, execution traces are read from
+    memory as :attr:`record_dtype` records, the binary trace records of
+    :mod:`abby.emulator.trace` followed by ELMO power. Otherwise ``elmotrace``
+    writes a CSV file which is parsed.
     """
 
     _features_32bits = [
@@ -48,7 +56,16 @@ class ThumbulatorEmulator(Emulator):
         "instr_stage1",
     ]
 
-    def __init__(self, fw_path):
+    # Binary trace records with ELMO power
+    record_dtype = np.dtype(
+        {
+            "names": list(trace.record_dtype.names) + ["power"],
+            "formats": [f for f, _ in trace.record_dtype.fields.values()] + ["<f4"],
+        },
+        align=True,
+    )
+
+    def __init__(self, fw_path, as_dataframe=True):
         """Initialize Thumbulator.
 
         We are currently using ELMO version of Thumbulator so we also get
@@ -56,14 +73,16 @@ class ThumbulatorEmulator(Emulator):
 
         :param fw_path: path to the firmware compiled file.
         :type fw_path: str
-        :param flash_address: flashing address, defaults to 0x0
-        :type flash_address: int, optional
+        :param as_dataframe: return execution traces as DataFrames instead of
+            records, defaults to True
+        :type as_dataframe: bool, optional
         """
         # FIXME: show error when file is missing
         self.model_path = (
             "/media/lab/HDD/Abby/trained_models/stm32f0308_discovery/elmo.txt"
         )
         self.fw_path = fw_path
+        self.as_dataframe = as_dataframe
 
         # Build dtypes
         self.dtypes = {
@@ -79,11 +98,42 @@ class ThumbulatorEmulator(Emulator):
         :param input_data: input data to send to the serial port
         :type input_data: bytes
         :return: output data and execution trace
-        :rtype: (bytes, [[str or int]])
+        :rtype: (bytes, pandas.DataFrame or np.ndarray)
         """
         import elmotrace
 
         log.debug(f"Running ELMO on {self.fw_path}")
+        if not hasattr(elmotrace, "run_buffer"):
+            output_data, df = self._run_csv(input_data, output_data_length)
+            if self.as_dataframe:
+                return output_data, df
+            return output_data, trace.from_dataframe(df, self.record_dtype)
+
+        output_data, buffer = elmotrace.run_buffer(
+            str(self.fw_path),
+            str(self.model_path),
+            input_data,
+            output_data_length,
+        )
+        return output_data, self._from_buffer(buffer)
+
+    def _from_buffer(self, buffer):
+        """Get execution trace from elmotrace records buffer."""
+        # First record has previous data not defined
+        records = np.frombuffer(buffer, dtype=self.record_dtype)[1:]
+        log.debug(f"Thumbulator recorded {len(records)} instructions")
+        if self.as_dataframe:
+            return trace.to_dataframe(records)
+        return records
+
+    def _factory(self):
+        """Get a function loading the same firmware."""
+        return functools.partial(type(self), self.fw_path, self.as_dataframe)
+
+    def _run_csv(self, input_data: bytes, output_data_length: int):
+        """Run emulation with execution trace written to a CSV file."""
+        import elmotrace
+
         with tempfile.NamedTemporaryFile() as f:
             output_data = elmotrace.run(
                 str(self.fw_path),
@@ -111,13 +161,20 @@ class ThumbulatorEmulator(Emulator):
         """Truncate data surrounded by NOP instructions.
 
         Search for operand code `0x46C0` = NOP around the trace and crop without
-        including them.
+        including them. Records are cropped with a slice, without copy.
 
         :param df: execution trace to crop
-        :type df: pandas.DataFrame
+        :type df: pandas.DataFrame or np.ndarray
         :return: cropped execution trace
-        :rtype: pandas.DataFrame
+        :rtype: pandas.DataFrame or np.ndarray
         """
+        if isinstance(df, np.ndarray):
+            middle_index = len(df) // 2
+            nop_indexes = np.flatnonzero(df["opcode"] == 0x46C0)
+            crop_start = nop_indexes[nop_indexes < middle_index].max()
+            crop_end = nop_indexes[nop_indexes > middle_index].min()
+            return df[crop_start + 1 : crop_end]
+
         middle_index = len(df) // 2
         nop_indexes = df.index[df["opcode"] == 0x46C0]
         crop_start = max(nop_indexes[nop_indexes < middle_index])
@@ -125,3 +182,64 @@ class ThumbulatorEmulator(Emulator):
         df = df.truncate(crop_start + 1, crop_end - 1)
         df = df.reset_index().drop("index", axis=1)
         return df
+
+
+class ThumbulatorSession(ThumbulatorEmulator):
+    """Thumbulator keeping firmware and ELMO power model loaded.
+
+    ``ThumbulatorEmulator`` loads firmware and power model on each run. This
+    class opens an ``elmotrace.Session`` loading them once; the session
+    resets CPU and RAM before each input so runs are independent.
+
+    For example::
+
+        >>> with ThumbulatorSession(fw_path) as session:
+        ...     results = session.run_many(inputs, 17)
+    """
+
+    def __init__(self, fw_path, as_dataframe=True):
+        """Load firmware and power model.
+
+        :param fw_path: path to the firmware compiled file.
+        :type fw_path: str
+        :param as_dataframe: return execution traces as DataFrames instead of
+            records, defaults to True
+        :type as_dataframe: bool, optional
+        :raises ImportError: if elmotrace does not support sessions
+        """
+        super().__init__(fw_path, as_dataframe)
+        import elmotrace
+
+        if not hasattr(elmotrace, "Session"):
+            raise ImportError("You need to install elmotrace with session support.")
+        log.debug(f"Loading {self.fw_path} in ELMO session")
+        self.session = elmotrace.Session(str(self.fw_path), str(self.model_path))
+
+    def __enter__(self):
+        """For use with context manager.
+
+        :return: Thumbulator session
+        :rtype: ThumbulatorSession
+        """
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        """Called on context close."""
+        self.close()
+
+    def close(self):
+        """Release firmware and power model."""
+        self.session.close()
+
+    def run(self, input_data: bytes, output_data_length: int):
+        """Run emulation from reset state.
+
+        :param input_data: input data to send to the serial port
+        :type input_data: bytes
+        :param output_data_length: expected length of output
+        :type output_data_length: int
+        :return: output data and execution trace
+        :rtype: (bytes, pandas.DataFrame or np.ndarray)
+        """
+        output_data, buffer = self.session.run(input_data, output_data_length)
+        return output_data, self._from_buffer(buffer)
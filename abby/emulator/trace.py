@@ -0,0 +1,293 @@
+# Copyright (C) 2020-2021  
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Execution traces in a fixed-width binary format.
+
+Emulators write one record per executed instruction, with instructions as
+codes from :data:`instructions` and values as unsigned integers, following
+this C structure in little-endian:
+
+..  code-block:: c
+
+    struct record {
+        uint8_t instr_stage3;  // code in instructions vocabulary
+        uint8_t instr_stage2;
+        uint8_t instr_stage1;
+        uint8_t padding;
+        uint16_t opcode;
+        uint16_t padding;
+        uint32_t op1_value_current;
+        uint32_t op2_value_current;
+        uint32_t op1_value_previous;
+        uint32_t op2_value_previous;
+        uint32_t readbus_value_previous;
+        uint32_t readbus_value_current;
+        uint32_t writebus_value_previous;
+        uint32_t writebus_value_current;
+    };
+
+Records are loaded without parsing with :func:`load` or :func:`from_bytes`.
+A DataFrame is only built when requested with :func:`to_dataframe`.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Instructions vocabulary, code 0 is for no instruction. New instructions are
+# appended so that codes of existing traces do not change.
+instructions = (
+    "",
+    "ADC",
+    "ADD#imm",
+    "ADDS",
+    "ANDS",
+    "ASRS",
+    "B",
+    "BCC",
+    "BCS",
+    "BEQ",
+    "BICS",
+    "BL",
+    "BNE",
+    "BX",
+    "CMP",
+    "CMPS",
+    "CPY",
+    "EORS",
+    "LDR",
+    "LDRB",
+    "LDRH",
+    "LSLS",
+    "LSLS#imm",
+    "LSRS",
+    "LSRS#imm",
+    "MOV",
+    "MOVS",
+    "MULS",
+    "MVNS",
+    "NEGS",
+    "NOP",
+    "ORRS",
+    "POP",
+    "PUSH",
+    "REV",
+    "SBC",
+    "STR",
+    "STRB",
+    "STRH",
+    "SUB",
+    "SUBS",
+    "UXTB",
+    "UXTH",
+    # Remaining ELMO instructions
+    "ADD",
+    "ADDS#imm",
+    "CMNS",
+    "CMP#imm",
+    "MOVS#imm",
+    "REV16",
+    "REVSH",
+    "RORS",
+    "SUBS#imm",
+    "SXTB",
+    "SXTH",
+    "TST",
+    # Remaining Cortex-M0 instructions
+    "BGE",
+    "BGT",
+    "BHI",
+    "BLE",
+    "BLS",
+    "BLT",
+    "BMI",
+    "BPL",
+    "BVC",
+    "BVS",
+    "BLX",
+    "LDM",
+    "LDRSB",
+    "LDRSH",
+    "STM",
+    "BKPT",
+    "CPSID",
+    "CPSIE",
+    "DMB",
+    "DSB",
+    "ISB",
+    "MRS",
+    "MSR",
+    "SEV",
+    "SVC",
+    "UDF",
+    "WFE",
+    "WFI",
+    "YIELD",
+)
+
+instruction_fields = ["instr_stage3", "instr_stage2", "instr_stage1"]
+
+value_fields = [
+    "op1_value_current",
+    "op2_value_current",
+    "op1_value_previous",
+    "op2_value_previous",
+    "readbus_value_previous",
+    "readbus_value_current",
+    "writebus_value_previous",
+    "writebus_value_current",
+]
+
+# Same layout as the C structure, with padding
+record_dtype = np.dtype(
+    {
+        "names": instruction_fields + ["opcode"] + value_fields,
+        "formats": ["u1"] * 3 + ["<u2"] + ["<u4"] * 8,
+    },
+    align=True,
+)
+
+# Code of the record written after the last instruction of each run
+end_code = 0xFF
+
+_codes = {name: code for code, name in enumerate(instructions)}
+
+_conditional_branches = "BCC BCS BEQ BGE BGT BHI BLE BLS BLT BMI BNE BPL BVC BVS"
+
+# Cortex-M0 cycles of instructions taking more than one, at most: branches
+# are taken and multiple loads and stores move 8 registers (and PC for POP)
+instruction_cycles = {
+    **{name: 2 for name in ["LDR", "LDRB", "LDRH", "LDRSB", "LDRSH"]},
+    **{name: 2 for name in ["STR", "STRB", "STRH"]},
+    **{name: 3 for name in _conditional_branches.split()},
+    **{name: 4 for name in ["DMB", "DSB", "ISB", "MRS", "MSR"]},
+    "B": 3,
+    "BX": 3,
+    "BLX": 3,
+    "BL": 4,
+    "LDM": 9,
+    "STM": 9,
+    "PUSH": 9,
+    "POP": 12,
+}
+
+
+def encode_instructions(names) -> np.ndarray:
+    """Get vocabulary codes of instructions, 0 for empty names
+
+    :param names: instructions names
+    :type names: [str]
+    :raises ValueError: if an instruction is not in vocabulary
+    :return: instructions codes
+    :rtype: np.ndarray
+    """
+    names = list(names)
+    unknown = set(names).difference(_codes)
+    if unknown:
+        raise ValueError(f"Instructions not in vocabulary: {sorted(unknown)}")
+    return np.array([_codes[name] for name in names], dtype=np.uint8)
+
+
+def cycle_count(execution_trace) -> int:
+    """Get an upper bound of Cortex-M0 cycles of an execution
+
+    See :data:`instruction_cycles`.
+
+    :param execution_trace: records or DataFrame of executed instructions
+    :type execution_trace: np.ndarray or pandas.DataFrame
+    :return: cycle count
+    :rtype: int
+    """
+    names = execution_trace["instr_stage3"]
+    if isinstance(execution_trace, np.ndarray):
+        names = decode_instructions(names)
+    return sum(instruction_cycles.get(name, 1) for name in names)
+
+
+def decode_instructions(codes) -> np.ndarray:
+    """Get instructions names from vocabulary codes
+
+    :param codes: instructions codes
+    :type codes: [int] or np.ndarray
+    :return: instructions names
+    :rtype: np.ndarray
+    """
+    return np.array(instructions, dtype=object)[np.asarray(codes)]
+
+
+def from_bytes(data) -> np.ndarray:
+    """Get records from binary data without copy
+
+    :param data: binary records
+    :type data: bytes
+    :raises ValueError: if data is not a whole number of records
+    :return: execution trace records
+    :rtype: np.ndarray
+    """
+    return np.frombuffer(data, dtype=record_dtype)
+
+
+def load(path, offset=0, count=-1) -> np.ndarray:
+    """Map records from a binary file
+
+    :param path: binary execution trace file
+    :type path: str or pathlib.Path
+    :param offset: offset of first record in bytes, defaults to 0
+    :type offset: int, optional
+    :param count: number of records, defaults to all following records
+    :type count: int, optional
+    :return: read-only execution trace records
+    :rtype: np.ndarray
+    """
+    if count < 0:
+        with open(path, "rb") as f:
+            count = (f.seek(0, 2) - offset) // record_dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=record_dtype)
+    return np.memmap(path, dtype=record_dtype, mode="r", offset=offset, shape=count)
+
+
+def to_dataframe(records) -> pd.DataFrame:
+    """Build a DataFrame with instructions names from records
+
+    Value columns are views of the records fields, without copy, so they are
+    read-only for memory mapped records. Instructions are decoded to names.
+
+    :param records: execution trace records
+    :type records: np.ndarray
+    :return: execution trace with the same columns as emulators CSV
+    :rtype: pandas.DataFrame
+    """
+    columns = {
+        name: (
+            decode_instructions(records[name])
+            if name in instruction_fields
+            else records[name]
+        )
+        for name in records.dtype.names
+    }
+    return pd.DataFrame(columns, copy=False)
+
+
+def from_dataframe(df, dtype=record_dtype) -> np.ndarray:
+    """Build records from an execution trace DataFrame
+
+    Missing columns are filled with zeros.
+
+    :param df: execution trace
+    :type df: pandas.DataFrame
+    :param dtype: records type, defaults to :data:`record_dtype`
+    :type dtype: np.dtype, optional
+    :raises ValueError: if an instruction is not in vocabulary
+    :return: execution trace records
+    :rtype: np.ndarray
+    """
+    records = np.zeros(len(df), dtype=dtype)
+    for name in dtype.names:
+        if name not in df.columns:
+            continue
+        if name in instruction_fields:
+            records[name] = encode_instructions(df[name].fillna(""))
+        else:
+            records[name] = df[name]
+    return records
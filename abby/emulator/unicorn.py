@@ -0,0 +1,477 @@
+# Copyright (C) 2020-2021  
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Unicorn wrapper to get an execution trace without external emulator.
+"""
+
+import functools
+import logging
+import struct
+
+import numpy as np
+
+from abby.emulator import trace
+from abby.emulator.base import Emulator
+
+# Local logger
+log = logging.getLogger(__name__)
+
+# Capstone mnemonics with a different name in instructions vocabulary
+_aliases = {
+    "ADCS": "ADC",
+    "ADR": "ADD#imm",
+    "BHS": "BCS",
+    "BLO": "BCC",
+    "CMN": "CMNS",
+    "CMP": "CMPS",
+    "RSBS": "NEGS",
+    "SBCS": "SBC",
+}
+
+
+def _instruction_name(mnemonic: str, immediate: bool) -> str:
+    """Get vocabulary name of a Capstone Thumb mnemonic.
+
+    :param mnemonic: Capstone mnemonic, with optional width suffix
+    :type mnemonic: str
+    :param immediate: whether last operand is an immediate value
+    :type immediate: bool
+    :return: instruction name
+    :rtype: str
+    """
+    name = mnemonic.split(".")[0].upper()
+    if immediate and f"{name}#imm" in trace.instructions:
+        return f"{name}#imm"
+    return _aliases.get(name, name)
+
+
+def read_firmware(fw_path) -> list:
+    """Read loadable segments of an ELF or raw binary firmware
+
+    Raw binaries are returned as one segment at address 0, ELF segments are
+    placed at their load address.
+
+    :param fw_path: path to the firmware compiled file
+    :type fw_path: str or pathlib.Path
+    :raises ValueError: if ELF file is not a 32-bit little-endian ELF
+    :return: address and data of each segment
+    :rtype: [(int, bytes)]
+    """
+    with open(fw_path, "rb") as f:
+        data = f.read()
+    if not data.startswith(b"\x7fELF"):
+        return [(0, data)]
+    if data[4:6] != b"\x01\x01":
+        raise ValueError(f"{fw_path} is not a 32-bit little-endian ELF")
+
+    (phoff,) = struct.unpack_from("<I", data, 0x1C)
+    phentsize, phnum = struct.unpack_from("<HH", data, 0x2A)
+    segments = []
+    for i in range(phnum):
+        p_type, offset, _, paddr, filesz = struct.unpack_from(
+            "<5I", data, phoff + i * phentsize
+        )
+        if p_type == 1 and filesz > 0:  # PT_LOAD
+            segments.append((paddr, data[offset : offset + filesz]))
+    return segments
+
+
+class UnicornEmulator(Emulator):
+    """Unicorn emulator for Cortex-M0 running inside Python process.
+
+    Firmware must be compiled with ``ELMO`` flag: input bytes are read from,
+    output bytes and triggers are written to ELMO memory mapped addresses.
+    Instructions are only recorded between a write to trigger begin address
+    and a write to trigger end address. When both are the same address, as
+    for ELMO trigger, a non-zero value begins and zero ends recording.
+
+    With ``crop_nop``, NOP instructions padding the code between triggers
+    are not recorded either, recording starts after the first run of at
+    least ``padding`` NOP instructions and stops at the next one, as with
+    :meth:`abby.emulator.Emulator.crop_nop_chunks`. Shorter NOP runs are part
+    of the code and are recorded.
+
+    Execution traces are records described in :mod:`abby.emulator.trace`,
+    with the same features as Thumbulator, see
+    :func:`abby.emulator.trace.to_dataframe` to get a DataFrame. Pipeline
+    stages are deduced from executed instructions order: ``instr_stage3`` is
+    the executed instruction, ``instr_stage2`` and ``instr_stage1`` the two
+    next ones.
+
+    The same engine is reused for all runs, CPU and RAM are restored to their
+    reset state before each run.
+    """
+
+    output_address = 0xE0000000
+    trigger_address = 0xE0000004
+    nop_opcode = 0x46C0
+    input_address = 0xE1000004
+    end_address = 0xF0000000
+
+    def __init__(
+        self,
+        fw_path,
+        flash_address=None,
+        flash_size=0x100000,
+        ram_address=0x20000000,
+        ram_size=0x10000,
+        max_instructions=10**7,
+        trigger_begin=None,
+        trigger_end=None,
+        crop_nop=False,
+        padding=450,
+    ):
+        """Load firmware and reset CPU.
+
+        :param fw_path: path to the firmware compiled file, ELF or binary
+        :type fw_path: str
+        :param flash_address: address of vector table, defaults to lowest
+            segment address
+        :type flash_address: int, optional
+        :param flash_size: size of flash memory, defaults to 1 MiB
+        :type flash_size: int, optional
+        :param ram_address: address of RAM, defaults to 0x20000000
+        :type ram_address: int, optional
+        :param ram_size: size of RAM, defaults to 64 KiB
+        :type ram_size: int, optional
+        :param max_instructions: instructions limit of a run, defaults to 1e7
+        :type max_instructions: int, optional
+        :param trigger_begin: address written to begin recording, defaults to
+            ELMO trigger address
+        :type trigger_begin: int, optional
+        :param trigger_end: address written to end recording, defaults to
+            ELMO trigger address
+        :type trigger_end: int, optional
+        :param crop_nop: do not record NOP padding, defaults to False
+        :type crop_nop: bool, optional
+        :param padding: minimum length of NOP paddings, defaults to 450
+        :type padding: int, optional
+        """
+        try:
+            import capstone
+            import unicorn
+            from unicorn import arm_const
+        except ImportError as e:
+            raise ImportError(
+                "You need to install unicorn and capstone modules."
+            ) from e
+
+        self.fw_path = fw_path
+        self.flash_size = flash_size
+        self.ram_address = ram_address
+        self.ram_size = ram_size
+        self.max_instructions = max_instructions
+        self.trigger_begin = trigger_begin or self.trigger_address
+        self.trigger_end = trigger_end or self.trigger_address
+        self.crop_nop = crop_nop
+        self.padding = padding
+
+        # Map memories and load firmware
+        segments = read_firmware(fw_path)
+        if flash_address is None:
+            flash_address = min(address for address, _ in segments) & ~0xFFF
+        self.flash_address = flash_address
+        self.uc = unicorn.Uc(unicorn.UC_ARCH_ARM, unicorn.UC_MODE_THUMB)
+        self.uc.ctl_set_cpu_model(arm_const.UC_CPU_ARM_CORTEX_M0)
+        self.uc.mem_map(flash_address, flash_size)
+        self.uc.mem_map(ram_address, ram_size)
+        for address, data in segments:
+            self.uc.mem_write(address, data)
+
+        # ELMO peripherals
+        peripherals = [
+            (self.output_address, 0x100000, self._read_zero, self._write_peripheral),
+            (self.input_address & ~0xFFF, 0x1000, self._read_input, self._write_ignore),
+            (self.end_address, 0x1000, self._read_zero, self._write_end),
+        ]
+        for address, size, read, write in peripherals:
+            self.uc.mmio_map(address, size, read, None, write, None)
+
+        # Record instructions and bus values
+        self.uc.hook_add(unicorn.UC_HOOK_CODE, self._hook_code)
+        for begin, size in [(flash_address, flash_size), (ram_address, ram_size)]:
+            self.uc.hook_add(
+                unicorn.UC_HOOK_MEM_READ, self._hook_read, None, begin, begin + size - 1
+            )
+        self.uc.hook_add(unicorn.UC_HOOK_MEM_WRITE, self._hook_write)
+        self._cs = capstone.Cs(
+            capstone.CS_ARCH_ARM, capstone.CS_MODE_THUMB | capstone.CS_MODE_MCLASS
+        )
+        self._cs.detail = True
+        self._decoded = {}
+        self._records = np.zeros(2**16, dtype=trace.record_dtype)
+
+        # Reset from vector table
+        sp, pc = struct.unpack("<II", self.uc.mem_read(flash_address, 8))
+        self.uc.reg_write(arm_const.UC_ARM_REG_SP, sp)
+        self.uc.reg_write(arm_const.UC_ARM_REG_PC, pc)
+        self._pc_register = arm_const.UC_ARM_REG_PC
+        self.save_state()
+
+    def _factory(self):
+        """Get a function loading the same firmware with same parameters."""
+        return functools.partial(
+            UnicornEmulator,
+            self.fw_path,
+            flash_address=self.flash_address,
+            flash_size=self.flash_size,
+            ram_address=self.ram_address,
+            ram_size=self.ram_size,
+            max_instructions=self.max_instructions,
+            trigger_begin=self.trigger_begin,
+            trigger_end=self.trigger_end,
+            crop_nop=self.crop_nop,
+            padding=self.padding,
+        )
+
+    def save_state(self):
+        """Save CPU context and RAM content."""
+        self._state = (
+            self.uc.context_save(),
+            bytes(self.uc.mem_read(self.ram_address, self.ram_size)),
+        )
+
+    def load_state(self):
+        """Restore CPU context and RAM content."""
+        context, ram = self._state
+        self.uc.context_restore(context)
+        self.uc.mem_write(self.ram_address, ram)
+
+    def _decode(self, address: int, size: int):
+        """Decode instruction once, returning its code, opcode and operands.
+
+        Operands are Unicorn register identifiers, or None with a constant.
+        Only the two last operands are kept, as ALU inputs.
+        """
+        from capstone import arm_const as cs_arm
+        from unicorn import arm_const as uc_arm
+
+        code = bytes(self.uc.mem_read(address, size))
+        insn = next(self._cs.disasm(code, address, 1), None)
+        if insn is None:
+            return 0, int.from_bytes(code[:2], "little"), []
+
+        def register(reg):
+            return getattr(uc_arm, f"UC_ARM_REG_{insn.reg_name(reg).upper()}")
+
+        operands = []
+        for op in insn.operands:
+            if op.type == cs_arm.ARM_OP_REG:
+                operands.append((register(op.reg), 0))
+            elif op.type == cs_arm.ARM_OP_IMM:
+                operands.append((None, op.imm & 0xFFFFFFFF))
+            elif op.type == cs_arm.ARM_OP_MEM:
+                operands.append((register(op.mem.base), 0))
+                if op.mem.index:
+                    operands.append((register(op.mem.index), 0))
+                else:
+                    operands.append((None, op.mem.disp & 0xFFFFFFFF))
+
+        opcode = int.from_bytes(code[:2], "little")
+        immediate = bool(insn.operands) and insn.operands[-1].type == cs_arm.ARM_OP_IMM
+        name = _instruction_name(insn.mnemonic, immediate)
+        if opcode == self.nop_opcode:
+            name = "NOP"
+        try:
+            instruction = trace.encode_instructions([name])[0]
+        except ValueError:
+            log.warning(f"Instruction {insn.mnemonic} not in vocabulary")
+            instruction = 0
+
+        decoded = instruction, opcode, operands[-2:]
+        self._decoded[address] = decoded
+        return decoded
+
+    def _finish_record(self):
+        """Set bus values of last recorded instruction once executed."""
+        self._records["readbus_value_current"][self._count - 1] = self._readbus
+        self._records["writebus_value_current"][self._count - 1] = self._writebus
+        self._pending = False
+
+    def _hook_code(self, uc, address, size, user_data):
+        """Record instruction about to be executed."""
+        if self._pending:
+            self._finish_record()
+        if not self._triggered:
+            return
+        instruction, opcode, operands = self._decoded.get(address) or self._decode(
+            address, size
+        )
+
+        # Window is 0 before code, 1 in code between paddings and 2 after code.
+        # NOP instructions of the code are recorded, and held back from
+        # chunks, until their run is long enough to be the second padding.
+        if self.crop_nop:
+            if self._window == 2:
+                return
+            if opcode == self.nop_opcode:
+                self._nops += 1
+                if self._window == 0:
+                    return
+                if self._nops >= self.padding:
+                    self._count -= self._nops - 1
+                    self._nops = 0
+                    self._window = 2
+                    return
+            else:
+                if self._window == 0 and self._nops < self.padding:
+                    self._nops = 0
+                    return
+                self._window = 1
+                self._nops = 0
+
+        if self._count == len(self._records):
+            self._records = np.resize(self._records, 2 * self._count)
+        values = [v if reg is None else uc.reg_read(reg) for reg, v in operands]
+        values = [0] * (2 - len(values)) + values
+        row = self._records[self._count]
+        row["instr_stage3"] = instruction
+        row["opcode"] = opcode
+        row["op1_value_current"] = values[0]
+        row["op2_value_current"] = values[1]
+        self._count += 1
+        self._pending = True
+
+    def _hook_read(self, uc, access, address, size, value, user_data):
+        """Latch value read from memory."""
+        self._readbus = int.from_bytes(uc.mem_read(address, size), "little")
+
+    def _hook_write(self, uc, access, address, size, value, user_data):
+        """Latch value written to memory and begin or end recording."""
+        self._writebus = value & 0xFFFFFFFF
+        if address == self.trigger_begin and (value or address != self.trigger_end):
+            self._triggered = True
+        elif address == self.trigger_end:
+            self._triggered = False
+
+    def _read_zero(self, uc, offset, size, user_data):
+        """Read unused peripheral."""
+        self._readbus = 0
+        return 0
+
+    def _read_input(self, uc, offset, size, user_data):
+        """Read next input byte."""
+        value = 0
+        if self._input:
+            value, self._input = self._input[0], self._input[1:]
+        else:
+            log.warning("Firmware read more input than given")
+        self._readbus = value
+        return value
+
+    def _write_ignore(self, uc, offset, size, value, user_data):
+        """Write to unused peripheral."""
+        pass
+
+    def _write_peripheral(self, uc, offset, size, value, user_data):
+        """Write output byte."""
+        if offset == 0:
+            self._output.append(value & 0xFF)
+
+    def _write_end(self, uc, offset, size, value, user_data):
+        """End program."""
+        self._ended = True
+        uc.emu_stop()
+
+    @staticmethod
+    def _complete(records, previous, following):
+        """Deduce pipeline and previous values of recorded instructions.
+
+        :param records: records to complete in place
+        :type records: np.ndarray
+        :param previous: record preceding records, if any
+        :type previous: np.void or None
+        :param following: instructions codes of up to two next records
+        :type following: np.ndarray
+        """
+        stages = np.zeros(len(records) + 2, dtype=np.uint8)
+        stages[: len(records)] = records["instr_stage3"]
+        stages[len(records) : len(records) + len(following)] = following
+        records["instr_stage2"] = stages[1 : len(records) + 1]
+        records["instr_stage1"] = stages[2:]
+        for name in ["op1_value", "op2_value", "readbus_value", "writebus_value"]:
+            records[f"{name}_previous"][1:] = records[f"{name}_current"][:-1]
+            if previous is not None and len(records):
+                records[f"{name}_previous"][0] = previous[f"{name}_current"]
+
+    def run_chunks(self, input_data: bytes, output_data_length: int, chunk_size=2**16):
+        """Run emulation from reset state, yielding execution trace chunks.
+
+        Engine runs ``chunk_size`` instructions at a time and full chunks are
+        yielded as soon as recorded, so memory does not grow with execution
+        length. Output data is the return value of the generator.
+
+        :param input_data: input data read by firmware
+        :type input_data: bytes
+        :param output_data_length: expected length of output
+        :type output_data_length: int
+        :param chunk_size: records in each chunk, defaults to 65536
+        :type chunk_size: int, optional
+        :raises RuntimeError: if firmware does not end
+        :return: generator of execution trace records
+        :rtype: generator of np.ndarray
+        """
+        self.load_state()
+        self._input = bytes(input_data)
+        self._output = bytearray()
+        self._triggered = False
+        self._window = 0
+        self._nops = 0
+        self._ended = False
+        self._pending = False
+        self._count = 0
+        self._readbus = 0
+        self._writebus = 0
+
+        previous = None
+        executed = 0
+        while not self._ended:
+            if executed >= self.max_instructions:
+                raise RuntimeError(
+                    f"Firmware did not end after {self.max_instructions} instructions"
+                )
+            step = min(chunk_size, self.max_instructions - executed)
+            pc = self.uc.reg_read(self._pc_register)
+            self.uc.emu_start(pc | 1, 0, count=step)
+            executed += step
+
+            # Last record is still pending, pipeline needs two next ones and
+            # NOP instructions may still be padding
+            while self._count - self._nops >= chunk_size + 3:
+                following = self._records["instr_stage3"][chunk_size : chunk_size + 2]
+                chunk = self._records[:chunk_size].copy()
+                self._complete(chunk, previous, following)
+                previous = chunk[-1]
+                self._count -= chunk_size
+                self._records[: self._count] = self._records[
+                    chunk_size : chunk_size + self._count
+                ]
+                yield chunk
+
+        if self._pending:
+            self._finish_record()
+        if self._count:
+            chunk = self._records[: self._count].copy()
+            self._complete(chunk, previous, [])
+            yield chunk
+        return bytes(self._output[:output_data_length])
+
+    def run(self, input_data: bytes, output_data_length: int):
+        """Run emulation from reset state.
+
+        :param input_data: input data read by firmware
+        :type input_data: bytes
+        :param output_data_length: expected length of output
+        :type output_data_length: int
+        :raises RuntimeError: if firmware does not end
+        :return: output data and execution trace records
+        :rtype: (bytes, np.ndarray)
+        """
+        stream = self.run_chunks(input_data, output_data_length, self.max_instructions)
+        records = np.zeros(0, dtype=trace.record_dtype)
+        for chunk in stream:
+            records = np.concatenate([records, chunk]) if len(records) else chunk
+        log.debug(f"Unicorn recorded {len(records)} instructions")
+
+        return bytes(self._output[:output_data_length]), records
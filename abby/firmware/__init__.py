@@ -90,6 +90,7 @@ def pio_run(
     elmo=False,
     qemu=False,
     debug=False,
+    upload_port=None,
 ) -> pathlib.Path:
     """Run one PlatformIO environment and return path to built firmware.
 
@@ -114,6 +115,9 @@ def pio_run(
     :type qemu: bool, optional
     :param debug: outputs compilation logs, defaults to False
     :type debug: bool, optional
+    :param upload_port: port of the board to upload to, defaults to the first
+        board found
+    :type upload_port: str, optional
     :raises ImportError: when PlatformIO is missing
     :return: path to built firmware
     :rtype: pathlib.Path
@@ -152,6 +156,8 @@ def pio_run(
         args += ["-s"]
     if upload:
         args += ["-t", "upload"]
+        if upload_port is not None:
+            args += ["--upload-port", upload_port]
 
     # Import PlatformIO
     try:
@@ -6,6 +6,8 @@ You may use :data:`abby.firmware.blockcipher.blockciphers` to get the list of
 available ciphers.
 """
 
+import os
+
 
 class BlockCipher:
     """Base class for all block ciphers
@@ -21,6 +23,11 @@ class BlockCipher:
     # Corresponding PlatformIO environment
     name = ""
 
+    # Upper bound of CPU cycles between NOP paddings, None if unknown
+    # It can be measured on a full acquisition by counting cycles left by
+    # abby.processing.crop_cycles, or by emulation with measure_cycle_count
+    cycle_count = None
+
     def get_input_length(self):
         """Get total input length
 
@@ -29,6 +36,43 @@ class BlockCipher:
         """
         return self.key_length + self.iv_length + self.mask_length + self.msg_length
 
+    def get_cycle_count(self):
+        """Get expected CPU cycles of one execution, without NOP paddings
+
+        :return: upper bound of cycle count, None if unknown
+        :rtype: int or None
+        """
+        return self.cycle_count
+
+    def measure_cycle_count(self, emulator, runs=8, padding=450):
+        """Measure expected CPU cycles by emulating executions
+
+        Emulator runs a firmware of this block cipher on random inputs and
+        records NOP paddings, which are cropped with
+        :meth:`abby.emulator.Emulator.crop_nop_chunks`, so that any emulator
+        gives the same count. The longest execution is kept as cycle count,
+        see :func:`abby.emulator.trace.cycle_count`.
+
+        :param emulator: emulator running this block cipher, without
+            cropping NOP paddings
+        :type emulator: abby.emulator.Emulator
+        :param runs: number of emulated executions, defaults to 8
+        :type runs: int, optional
+        :param padding: minimum length of NOP paddings, defaults to 450
+        :type padding: int, optional
+        :return: upper bound of cycle count
+        :rtype: int
+        """
+        from abby.emulator import Emulator, trace
+
+        inputs = [b"\xae" + os.urandom(self.get_input_length()) for _ in range(runs)]
+        results = emulator.run_many(inputs, 1 + self.msg_length)
+        self.cycle_count = max(
+            sum(trace.cycle_count(c) for c in Emulator.crop_nop_chunks([t], padding))
+            for _, t in results
+        )
+        return self.cycle_count
+
     def __str__(self):
         """Return string representation
 
@@ -207,6 +251,18 @@ class GeneratedCode(BlockCipher):
     # Number of instructions generated
     count = 1000
 
+    def get_cycle_count(self):
+        """Get expected CPU cycles of one execution, without NOP paddings
+
+        Generated instructions take at most 2 cycles on Cortex-M0.
+
+        :return: upper bound of cycle count
+        :rtype: int
+        """
+        if self.cycle_count is not None:
+            return self.cycle_count
+        return 2 * self.count
+
 
 class Rabbit(BlockCipher):
     """Rabbit from https://bench.cr.yp.to/supercop.html
@@ -48,6 +48,25 @@ class Model:
         """
         raise NotImplementedError()
 
+    def predict_stream(self, chunks):
+        """Predict target for each chunk of features
+
+        Chunks are consumed one by one, for example from
+        :meth:`abby.emulator.Emulator.run_chunks`, so that whole execution
+        traces are never in memory. Records are converted to DataFrames.
+
+        :param chunks: features chunks to input to the model
+        :type chunks: iterable of pandas.DataFrame or np.ndarray
+        :return: generator of model prediction for each chunk
+        :rtype: generator of numpy.ndarray
+        """
+        from abby.emulator import trace
+
+        for features in chunks:
+            if isinstance(features, np.ndarray) and features.dtype.names:
+                features = trace.to_dataframe(features)
+            yield self.predict(features)
+
     def fit(self, data_files, test_size=0.2):
         """Fit model on target using provided data
 
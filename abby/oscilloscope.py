@@ -8,14 +8,182 @@ This module automates traces acquisition process.
 """
 
 import logging
-from time import sleep
+import math
+import queue
+import threading
+from time import perf_counter, sleep
 
 import numpy as np
 
+from abby.processing import CycleReducer, RawTrace, RunningAverage
+
 # Local logger
 log = logging.getLogger(__name__)
 
 
+class LatencyStats:
+    """Running statistics on measured durations, in seconds."""
+
+    def __init__(self):
+        """Initialize empty statistics"""
+        self.count = 0
+        self.total = 0.0
+        self.minimum = float("inf")
+        self.maximum = 0.0
+
+    def add(self, duration):
+        """Record a new duration
+
+        :param duration: measured duration in seconds
+        :type duration: float
+        """
+        self.count += 1
+        self.total += duration
+        self.minimum = min(self.minimum, duration)
+        self.maximum = max(self.maximum, duration)
+
+    @property
+    def mean(self):
+        """Mean duration in seconds, 0 if nothing was recorded
+
+        :return: mean duration
+        :rtype: float
+        """
+        return self.total / self.count if self.count else 0.0
+
+    def __str__(self):
+        """Return string representation
+
+        :return: statistics summary in milliseconds
+        :rtype: str
+        """
+        if not self.count:
+            return "no measure"
+        return (
+            f"{self.count} measures, mean {self.mean * 1e3:.3f} ms, "
+            f"min {self.minimum * 1e3:.3f} ms, max {self.maximum * 1e3:.3f} ms"
+        )
+
+
+# NOP instructions around each execution, see abby.firmware
+NOP_CYCLES = 1000
+
+
+def trigger_window(cycles, freq=8e6, sample_interval=4e-9, margin=0.1, pre_cycles=8):
+    """Compute the smallest acquisition window around an execution
+
+    The window starts ``pre_cycles`` before the trigger and covers the NOP
+    paddings and ``cycles`` cycles of execution, plus a relative ``margin``
+    for clock drift.
+
+    :param cycles: expected cycles of execution, without NOP paddings
+    :type cycles: int
+    :param freq: CPU clock frequency in Hz, defaults to 8 MHz
+    :type freq: float, optional
+    :param sample_interval: time interval between samples in seconds,
+        defaults to 4 ns
+    :type sample_interval: float, optional
+    :param margin: relative margin on execution duration, defaults to 10%
+    :type margin: float, optional
+    :param pre_cycles: cycles to keep before trigger, defaults to 8
+    :type pre_cycles: int, optional
+    :return: number of samples before and after trigger
+    :rtype: (int, int)
+    """
+    samples_per_cycle = 1 / (freq * sample_interval)
+    pre = math.ceil(pre_cycles * samples_per_cycle)
+    post = math.ceil((NOP_CYCLES + cycles) * (1 + margin) * samples_per_cycle)
+    return pre, post
+
+
+def frame_checksum(payload: bytes) -> int:
+    """Compute checksum of a serial frame payload
+
+    :param payload: frame payload
+    :type payload: bytes
+    :return: sum of payload bytes modulo 256
+    :rtype: int
+    """
+    return sum(payload) & 0xFF
+
+
+class RingBuffer:
+    """Fixed number of preallocated chunk slots between two threads.
+
+    A producer thread copies chunks into free slots with :meth:`fill` while
+    the consumer iterates over filled slots. Each slot is given back once the
+    consumer asks for the next chunk, so memory use is bounded whatever the
+    acquisition length. The producer blocks when all slots are in use, until
+    the consumer frees one or calls :meth:`stop`.
+    """
+
+    def __init__(self, slots, chunk_size, channels=2, dtype=np.float64):
+        """Allocate ring buffer
+
+        :param slots: number of chunks held at most
+        :type slots: int
+        :param chunk_size: maximum number of samples per chunk
+        :type chunk_size: int
+        :param channels: number of channels per chunk, defaults to 2
+        :type channels: int, optional
+        :param dtype: samples type, defaults to float64
+        :type dtype: np.dtype, optional
+        """
+        self.buffer = np.empty((slots, channels, chunk_size), dtype=dtype)
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        for i in range(slots):
+            self._free.put(i)
+        self._error = None
+        self._stopped = threading.Event()
+
+    def stop(self):
+        """Make the producer return before next chunk"""
+        self._stopped.set()
+        self._free.put(None)  # wake up producer waiting for a slot
+
+    def fill(self, chunks):
+        """Copy chunks into free slots until exhausted or stopped
+
+        Errors raised by chunks are raised again to the consumer.
+
+        :param chunks: chunks with one array per channel
+        :type chunks: iterable of tuple of np.ndarray
+        """
+        try:
+            for chunk in chunks:
+                i = self._free.get()
+                if i is None or self._stopped.is_set():
+                    break
+                length = len(chunk[0])
+                for channel, data in enumerate(chunk):
+                    self.buffer[i, channel, :length] = data
+                self._filled.put((i, length))
+        except Exception as e:
+            self._error = e
+        finally:
+            self._filled.put(None)
+
+    def __iter__(self):
+        """Iterate over filled chunks
+
+        Yielded chunks are views on the buffer, valid until next iteration.
+
+        :raises Exception: error raised while filling
+        :return: generator of chunks, one row per channel
+        :rtype: generator of np.ndarray
+        """
+        while True:
+            item = self._filled.get()
+            if item is None:
+                break
+            i, length = item
+            yield self.buffer[i, :, :length]
+            self._free.put(i)
+        if self._error is not None:
+            raise self._error
+
+
 class Oscilloscope:
     """Common interface for oscilloscope
 
@@ -27,11 +195,30 @@ class Oscilloscope:
     abstraction layer.
     """
 
+    # Number of triggers captured for each arming, see get_traces
+    segments = 1
+
     def __init__(self):
         """Initialize an oscilloscope"""
         log.info("Connecting")
         super().__init__()
 
+        # Oscilloscope was armed in advance by a pipelined acquisition
+        self._armed = False
+
+        # Time spent in arm()
+        self.arm_latency = LatencyStats()
+
+        # Serial reception settings, see _receive
+        self.receive_timeout = 1.0
+        self.framed = False
+        self._rx_buffer = bytearray()
+
+        # Averaging buffers reused between acquisitions
+        self._trace_average = RunningAverage()
+        self._clock_average = RunningAverage()
+        self.averaged = 0
+
     def __enter__(self):
         """For use with context manager.
 
@@ -53,6 +240,49 @@ class Oscilloscope:
         """Arm to acquire next trigger"""
         raise NotImplementedError()
 
+    def disarm(self):
+        """Forget arming left by a pipelined acquisition
+
+        Settings changes only apply from next arming, so every method
+        reconfiguring the oscilloscope calls this first and next acquisition
+        arms again.
+        """
+        self._armed = False
+
+    def set_trigger_window(self, cycles, freq=8e6, margin=0.1):
+        """Capture only around the expected execution
+
+        See :func:`trigger_window`.
+
+        :param cycles: expected cycles of execution, without NOP paddings
+        :type cycles: int
+        :param freq: CPU clock frequency in Hz, defaults to 8 MHz
+        :type freq: float, optional
+        :param margin: relative margin on execution duration, defaults to 10%
+        :type margin: float, optional
+        """
+        raise NotImplementedError()
+
+    def set_blockcipher(self, algorithm, freq=8e6, margin=0.1):
+        """Capture only around the execution of a block cipher
+
+        The acquisition window is unchanged if the block cipher cycle count
+        is unknown.
+
+        :param algorithm: block cipher running on target
+        :type algorithm: abby.firmware.blockcipher.BlockCipher
+        :param freq: CPU clock frequency in Hz, defaults to 8 MHz
+        :type freq: float, optional
+        :param margin: relative margin on execution duration, defaults to 10%
+        :type margin: float, optional
+        """
+        self.disarm()
+        cycles = algorithm.get_cycle_count()
+        if cycles is None:
+            log.warning(f"Unknown cycle count for {algorithm}, keeping window")
+            return
+        self.set_trigger_window(cycles, freq, margin)
+
     def get_trace(self, trigger_crop=True):
         """Download acquired data and return side channel trace
 
@@ -65,13 +295,125 @@ class Oscilloscope:
         """
         raise NotImplementedError()
 
-    def run_and_acquire(self, input_txt: bytes, output_len: int, serial, average=1):
+    def get_traces(self, trigger_crop=True):
+        """Download all segments acquired after one arming.
+
+        Traces will be numpy arrays with float64 samples, one segment per row.
+
+        :param trigger_crop: crop trace using trigger signal, defaults to True
+        :type trigger_crop: bool, optional
+        :return: acquired traces and clocks
+        :rtype: (np.ndarray, np.ndarray)
+        """
+        raise NotImplementedError()
+
+    def get_chunks(self, chunk_size):
+        """Download acquired data chunk by chunk
+
+        Chunks are float64 samples in volts. Only one chunk per channel needs
+        to be in memory, whatever the acquisition length.
+
+        :param chunk_size: number of samples per chunk
+        :type chunk_size: int
+        :return: generator of trace and clock chunks
+        :rtype: generator of (np.ndarray, np.ndarray)
+        """
+        raise NotImplementedError()
+
+    def _receive(self, serial, output_len: int) -> bytes:
+        """Receive output data from serial device.
+
+        Request all remaining bytes at once until ``output_len`` bytes are
+        received or ``receive_timeout`` is exceeded. Bytes are read into a
+        buffer reused between calls.
+
+        When ``framed`` is set, the device must send a frame made of the
+        payload length as 2 bytes little endian, the payload and then
+        :func:`frame_checksum` of the payload.
+
+        :param serial: serial device
+        :type serial: serial.Serial
+        :param output_len: size of the returned data to expect
+        :type output_len: int
+        :raises IndexError: if timeout when waiting for message
+        :raises ValueError: if frame length or checksum is wrong
+        :return: received message
+        :rtype: bytes
+        """
+        log.debug(f"Waiting for {output_len} bytes from serial")
+        if not self.framed:
+            return bytes(self._read_exact(serial, output_len))
+
+        length = int.from_bytes(self._read_exact(serial, 2), "little")
+        if length != output_len:
+            raise ValueError(f"Received frame of {length} bytes, not {output_len}")
+        frame = self._read_exact(serial, output_len + 1)
+        output_txt, checksum = bytes(frame[:-1]), frame[-1]
+        if frame_checksum(output_txt) != checksum:
+            raise ValueError(f"Wrong checksum for frame {output_txt.hex()}")
+        return output_txt
+
+    def _read_exact(self, serial, n: int) -> memoryview:
+        """Read exactly n bytes from serial device before deadline.
+
+        :param serial: serial device
+        :type serial: serial.Serial
+        :param n: number of bytes to read
+        :type n: int
+        :raises IndexError: if timeout when waiting for message
+        :return: view on received bytes, valid until next read
+        :rtype: memoryview
+        """
+        if len(self._rx_buffer) < n:
+            self._rx_buffer = bytearray(n)
+        view = memoryview(self._rx_buffer)[:n]
+
+        deadline = perf_counter() + self.receive_timeout
+        received = 0
+        while received < n:
+            data = serial.read(n - received)
+            view[received : received + len(data)] = data
+            received += len(data)
+            if received < n and perf_counter() > deadline:
+                raise IndexError(f"Timeout while receiving {received}-th byte")
+        return view
+
+    def _arm_timed(self):
+        """Arm if not already armed and record arming latency"""
+        if self._armed:
+            self._armed = False
+            return
+        t = perf_counter()
+        self.arm()
+        self.arm_latency.add(perf_counter() - t)
+
+    def run_and_acquire(
+        self,
+        input_txt: bytes,
+        output_len: int,
+        serial,
+        average=1,
+        pipelined=False,
+        target_stderr=None,
+    ):
         """Acquire a trace with clock while an algorithm is running
 
         Arm the oscilloscope, send input data to serial to trigger and then
         wait for returned serial data.
 
         Set ``average`` parameter to do multiple acquisitions and reduce noise.
+        Traces are averaged online in float32, cropped to the shortest trace.
+        Without averaging, traces are returned as downloaded, so raw traces
+        stay in ADC counts.
+        With ``target_stderr``, acquisitions stop before ``average`` as soon
+        as the standard error of the mean of every sample is below it.
+
+        With ``pipelined``, the oscilloscope is armed again right after each
+        download, so the next acquisition does not wait for arming while the
+        caller processes the returned trace.
+
+        Clock is None for oscilloscopes sampling synchronously with the target
+        clock, see :func:`abby.processing.regular_cycles`.
 
         :param input_txt: input data
         :type input_txt: bytes
@@ -81,54 +423,179 @@ class Oscilloscope:
         :type serial: serial.Serial
         :param average: amount of acquisitions to average, default to 1
         :type average: int, optional
+        :param pipelined: arm again after each download, default to False
+        :type pipelined: bool, optional
+        :param target_stderr: standard error to reach before stopping, default
+            to always doing ``average`` acquisitions
+        :type target_stderr: float, optional
         :raises IndexError: if timeout when waiting for message
         :return: received message and acquired trace and clock
         :rtype: (bytes, np.ndarray, np.ndarray)
         """
-        traces, clocks = [], []
+        self._trace_average.reset()
+        self._clock_average.reset()
         for _ in range(average):
             # Arm scope then send input_txt to trigger acquisition
-            log.debug(f"Arm picoscope and send input text: {input_txt.hex()}")
-            self.arm()
+            log.debug(f"Arm oscilloscope and send input text: {input_txt.hex()}")
+            self._arm_timed()
             serial.write(input_txt)
 
             # Receive output text
-            log.debug(f"Waiting for {output_len} bytes from serial")
-            output_txt = b""
-            for i in range(output_len):
-                try:
-                    b = serial.read(1)[0]
-                except IndexError as e:
-                    raise IndexError(f"Timeout while receiving {i}-th byte") from e
-                output_txt += bytes([b])
+            output_txt = self._receive(serial, output_len)
 
             # Download power trace from the oscilloscope
             trace, clock = self.get_trace()
-            traces.append(trace)
-            clocks.append(clock)
+
+            # Rearm now so that arming overlaps with caller processing
+            if pipelined:
+                self._arm_timed()
+                self._armed = True
+
+            if average == 1:
+                self.averaged = 1
+                return output_txt, trace, clock
+            self._trace_average.add(trace)
+            if clock is not None:
+                self._clock_average.add(clock)
+
+            # Stop early if the average is precise enough
+            if (
+                target_stderr is not None
+                and self._trace_average.count >= 2
+                and np.max(self._trace_average.stderr) < target_stderr
+            ):
+                break
 
         # Return average, crop to smallest trace
-        min_length = min([len(t) for t in traces])
-        traces = np.array([t[:min_length] for t in traces])
-        clocks = np.array([t[:min_length] for t in clocks])
-        return output_txt, np.average(traces, axis=0), np.average(clocks, axis=0)
+        self.averaged = self._trace_average.count
+        log.debug(f"Averaged {self.averaged} acquisitions")
+        if clock is None:
+            return output_txt, self._trace_average.mean.copy(), None
+        length = min(self._trace_average.length, self._clock_average.length)
+        trace = self._trace_average.mean[:length].copy()
+        clock = self._clock_average.mean[:length].copy()
+        return output_txt, trace, clock
+
+    def run_and_acquire_batch(self, inputs, output_len: int, serial):
+        """Acquire one trace per input with a single arming
+
+        The oscilloscope memory must be split in as many segments as inputs.
+        Arm the oscilloscope once, send each input and wait for its output,
+        then download all segments at once.
+
+        :param inputs: input data for each segment
+        :type inputs: [bytes]
+        :param output_len: size of the returned data to expect for each input
+        :type output_len: int
+        :param serial: serial device
+        :type serial: serial.Serial
+        :raises ValueError: if inputs count does not match segments count
+        :raises IndexError: if timeout when waiting for message
+        :return: received messages and acquired traces and clocks
+        :rtype: ([bytes], np.ndarray, np.ndarray)
+        """
+        if len(inputs) != self.segments:
+            raise ValueError(
+                f"Got {len(inputs)} inputs for {self.segments} memory segments"
+            )
+
+        log.debug(f"Arm oscilloscope for {self.segments} segments")
+        self._arm_timed()
+        outputs = []
+        for input_txt in inputs:
+            serial.write(input_txt)
+            outputs.append(self._receive(serial, output_len))
+
+        # Download all segments in one transfer
+        traces, clocks = self.get_traces()
+        return outputs, traces, clocks
+
+    def run_and_reduce(
+        self,
+        input_txt: bytes,
+        output_len: int,
+        serial,
+        chunk_size=2**16,
+        slots=8,
+        freq_estimated=8e6,
+        sample_rate=250e6,
+    ):
+        """Acquire a trace reduced to one sample per cycle, chunk by chunk
+
+        Chunks from :meth:`get_chunks` are pulled into a :class:`RingBuffer`
+        by a background thread while the target runs, and reduced with
+        :class:`abby.processing.CycleReducer` as they arrive. The
+        full-resolution trace never sits in host memory, which suits long
+        executions.
+
+        :param input_txt: input data to send
+        :type input_txt: bytes
+        :param output_len: size of the returned data to expect
+        :type output_len: int
+        :param serial: serial device
+        :type serial: serial.Serial
+        :param chunk_size: number of samples per chunk, defaults to 65536
+        :type chunk_size: int, optional
+        :param slots: number of chunks buffered at most, defaults to 8
+        :type slots: int, optional
+        :param freq_estimated: estimation of the clock frequency in Hz,
+            defaults to 8 MHz
+        :type freq_estimated: float, optional
+        :param sample_rate: trace sampling rate in Hz, defaults to 250 MHz
+        :type sample_rate: float, optional
+        :raises IndexError: if timeout when waiting for message
+        :return: received message and one sample per cycle
+        :rtype: (bytes, np.ndarray)
+        """
+        log.debug(f"Arm oscilloscope and send input text: {input_txt.hex()}")
+        self._arm_timed()
+        ring = RingBuffer(slots, chunk_size)
+        producer = threading.Thread(
+            target=ring.fill, args=(self.get_chunks(chunk_size),), daemon=True
+        )
+        producer.start()
+        try:
+            serial.write(input_txt)
+
+            # Reduce chunks while next ones are downloaded
+            reducer = CycleReducer(freq_estimated, sample_rate)
+            parts = [np.zeros(0)]
+            for trace, clock in ring:
+                parts.append(reducer.push(trace, clock))
+        finally:
+            # Do not leave the producer downloading if reduction failed
+            ring.stop()
+            producer.join()
+        log.debug(f"Reduced {reducer.cycles} cycles")
+
+        output_txt = self._receive(serial, output_len)
+        return output_txt, np.concatenate(parts)
 
 
 class Chipwhisperer(Oscilloscope):
     """Chipwhisperer Nano, Lite and Pro support.
 
+    Chipwhisperer samples synchronously with the clock it generates for the
+    target, so there is no clock channel: cycles are found with
+    :func:`abby.processing.regular_cycles` and :attr:`samples_per_cycle`.
+
     See <https://chipwhisperer.readthedocs.io/en/latest/api.html> for API
     documentation.
     """
 
-    def __init__(self, type=None, sn=None):
+    def __init__(self, type=None, sn=None, raw=False):
         """Initialize Chipwhisperer.
 
+        With ``raw``, traces are returned as :class:`abby.processing.RawTrace`
+        containing ADC counts.
+
         :param type: scope type to connect to. Types
             can be found in chipwhisperer.scopes module. Defaults to auto.
         :type type: ScopeTemplate, optional
         :param sn: serial number to connect to. Defaults to auto.
         :type sn: str, optional
+        :param raw: keep ADC counts, defaults to False
+        :type raw: bool, optional
         :raises ImportError: if chipwhisperer module is missing
         """
         try:
@@ -140,6 +607,8 @@ class Chipwhisperer(Oscilloscope):
         # Init OpenADC or CWNano with sane defaults
         self.scope = scope(type=type, sn=sn)
         self.scope.default_setup()
+        self.raw = raw
+        self._batch = None
 
     def close(self):
         """Close connection"""
@@ -149,26 +618,132 @@ class Chipwhisperer(Oscilloscope):
         """Arm to acquire next trigger"""
         self.scope.arm()
 
-    def get_trace(self):
-        """Download acquired data and return side channel trace
+    def set_trigger_window(self, cycles, freq=8e6, margin=0.1):
+        """Capture only around the expected execution
 
-        Trace will be a numpy array with float64 samples.
+        See :func:`trigger_window`. CW-Nano cannot capture before the
+        trigger, so only samples after it are captured.
 
-        :return: acquired trace
-        :rtype: np.ndarray
-        :raises TimeoutError: if acquisition timed out
+        :param cycles: expected cycles of execution, without NOP paddings
+        :type cycles: int
+        :param freq: CPU clock frequency in Hz, defaults to 8 MHz
+        :type freq: float, optional
+        :param margin: relative margin on execution duration, defaults to 10%
+        :type margin: float, optional
         """
-        # Wait for oscilloscope to be ready
+        self.disarm()
+        pre, post = trigger_window(cycles, freq, 1 / self.adc_freq, margin)
+        if hasattr(self.scope.adc, "presamples"):
+            self.scope.adc.presamples = pre
+        else:
+            pre = 0
+        self.scope.adc.samples = pre + post
+
+    @property
+    def adc_freq(self):
+        """ADC sampling frequency in Hz
+
+        CW-Nano sets it in ADC settings instead of clock settings.
+
+        :rtype: float
+        """
+        if hasattr(self.scope.clock, "adc_freq"):
+            return self.scope.clock.adc_freq
+        return self.scope.adc.clk_freq
+
+    @property
+    def _presamples(self):
+        """Samples captured before trigger, none on CW-Nano."""
+        return getattr(self.scope.adc, "presamples", 0)
+
+    @property
+    def samples_per_cycle(self):
+        """Samples per target clock cycle, from ADC and target clocks
+
+        :rtype: float
+        """
+        return self.adc_freq / self.scope.clock.clkgen_freq
+
+    def _capture(self):
+        """Wait for capture then download ADC counts or volts."""
         log.debug("Waiting for acquisition")
         timeout = self.scope.capture()
         if timeout:
             raise TimeoutError("Acquisition timed out.")
 
-        # Download data
         log.debug("Downloading traces")
-        trace = self.scope.get_last_trace()
+        return self.scope.get_last_trace(as_int=self.raw)
+
+    def _wrap(self, data):
+        """Wrap ADC counts in a RawTrace in raw mode."""
+        if not self.raw:
+            return data
+        # Chipwhisperer converts counts to [-0.5, 0.5[
+        bits = getattr(self.scope.adc, "bits_per_sample", 10)
+        return RawTrace(data, 1 / 2**bits, 0.5)
+
+    def get_trace(self, trigger_crop=True):
+        """Download acquired data and return side channel trace
+
+        Trace will be a numpy array with float64 samples, or ADC counts in
+        raw mode. There is no clock channel.
+
+        :param trigger_crop: crop samples before trigger, defaults to True
+        :type trigger_crop: bool, optional
+        :raises TimeoutError: if acquisition timed out
+        :return: acquired trace and None
+        :rtype: (np.ndarray or RawTrace, None)
+        """
+        start = self._presamples if trigger_crop else 0
+        return self._wrap(self._capture()[start:]), None
+
+    def run_and_acquire_batch(self, inputs, output_len: int, serial):
+        """Acquire one trace per input into a reused buffer
+
+        Chipwhisperer has no memory segments, so each input is acquired with
+        its own arming, but traces are copied into a 2-D buffer allocated
+        once and reused as long as batches are not larger. Returned traces
+        are overwritten by the next call, copy them to keep them.
+
+        :param inputs: input data for each trace
+        :type inputs: [bytes]
+        :param output_len: size of the returned data to expect for each input
+        :type output_len: int
+        :param serial: serial device
+        :type serial: serial.Serial
+        :raises TimeoutError: if acquisition timed out
+        :raises IndexError: if timeout when waiting for message
+        :raises ValueError: if traces of the batch differ in length
+        :return: received messages, acquired traces and None as clock
+        :rtype: ([bytes], np.ndarray or RawTrace, None)
+        """
+        if not inputs:
+            return [], np.empty((0, 0)), None
+
+        start = self._presamples
+        outputs = []
+        for i, input_txt in enumerate(inputs):
+            self._arm_timed()
+            serial.write(input_txt)
+            outputs.append(self._receive(serial, output_len))
+            data = self._capture()[start:]
 
-        return trace
+            # Allocate again only for a larger batch or different traces
+            if i == 0 and (
+                self._batch is None
+                or self._batch.shape[0] < len(inputs)
+                or self._batch.shape[1] != len(data)
+                or self._batch.dtype != data.dtype
+            ):
+                self._batch = np.empty((len(inputs), len(data)), dtype=data.dtype)
+            elif len(data) != self._batch.shape[1]:
+                raise ValueError(
+                    f"Trace {i} has {len(data)} samples instead of "
+                    f"{self._batch.shape[1]}"
+                )
+            self._batch[i] = data
+
+        return outputs, self._wrap(self._batch[: len(inputs)]), None
 
 
 class PS3000a(Oscilloscope):
@@ -179,10 +754,32 @@ class PS3000a(Oscilloscope):
     """
 
     def __init__(
-        self, signal_range=50e-3, clock_range=2.0, sample_interval=4e-9, duration=2e-3
+        self,
+        signal_range=50e-3,
+        clock_range=2.0,
+        sample_interval=4e-9,
+        duration=2e-3,
+        segments=1,
+        ready_timeout=10.0,
+        poll_interval=1e-4,
+        max_poll_interval=1e-2,
+        arm_delay=0.0,
+        raw=False,
+        sn=None,
     ):
         """Initialize Picoscope 3000a series
 
+        Use ``segments`` greater than one to capture that many triggers
+        back to back after each arming (rapid block mode), then download them
+        all with :meth:`get_traces`.
+
+        Capture completion is polled starting every ``poll_interval`` seconds,
+        doubling the interval up to ``max_poll_interval``.
+
+        With ``raw``, traces are returned as :class:`abby.processing.RawTrace`
+        containing int16 ADC counts, conversion to volts is left to the
+        caller.
+
         :param signal_range: range of channel A, defaults to 50 mV
         :type signal_range: float, optional
         :param clock_range: range of channel B, defaults to 2.0 V
@@ -190,9 +787,28 @@ class PS3000a(Oscilloscope):
         :param sample_interval: time interval between samples in seconds,
             defaults to 4 ns
         :type sample_interval: float, optional
-        :param sample_interval: time duration of the acquisition, defaults to
+        :param duration: time duration of the acquisition, defaults to
             2 ms
-        :type sample_interval: float, optional
+        :type duration: float, optional
+        :param segments: number of memory segments, defaults to 1
+        :type segments: int, optional
+        :param ready_timeout: maximum time to wait for a capture in seconds,
+            defaults to 10 s
+        :type ready_timeout: float, optional
+        :param poll_interval: first polling interval in seconds, defaults to
+            100 us
+        :type poll_interval: float, optional
+        :param max_poll_interval: maximum polling interval in seconds,
+            defaults to 10 ms
+        :type max_poll_interval: float, optional
+        :param arm_delay: extra time to wait after arming in seconds, defaults
+            to 0
+        :type arm_delay: float, optional
+        :param raw: keep ADC counts, defaults to False
+        :type raw: bool, optional
+        :param sn: serial number of the oscilloscope to open, defaults to the
+            first one found
+        :type sn: str, optional
         :raises ImportError: if picoscope module is missing
         """
         try:
@@ -201,7 +817,16 @@ class PS3000a(Oscilloscope):
             raise ImportError("You need to install picoscope module.") from e
 
         super().__init__()
-        self.ps = ps_PS3000a()
+        self.ps = ps_PS3000a(serialNumber=sn)
+        self.ready_timeout = ready_timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.arm_delay = arm_delay
+        self.raw = raw
+
+        # Time between the end of arming and the end of capture
+        self.wait_latency = LatencyStats()
+        self._arm_time = perf_counter()
 
         # Channel A is connected to the current probe
         # Channel B is connected to the clock
@@ -210,42 +835,436 @@ class PS3000a(Oscilloscope):
         self.ps.setChannel(channel="B", coupling="AC", VRange=clock_range)
         self.ps.setSimpleTrigger("External", threshold_V=1.0, timeout_ms=10000)
 
-        # One capture at a time and allocate all memory to this acquisition
-        self.ps.setNoOfCaptures(1)
-        self.ps.memorySegments(1)
+        # Split memory into segments, one capture for each
+        self.sample_interval = sample_interval
+        self.duration = duration
+        self._pre_samples = 0
+        self.set_segments(segments)
+
+    def set_segments(self, segments):
+        """Split oscilloscope memory to capture multiple triggers per arming.
+
+        Buffers for :meth:`get_traces` are allocated here once.
+
+        :param segments: number of memory segments and captures
+        :type segments: int
+        :raises ValueError: if acquisition duration does not fit in a segment
+        """
+        self.disarm()
+        self.ps.memorySegments(segments)
+        self.ps.setNoOfCaptures(segments)
+        self.segments = segments
 
         # Set sample interval and total acquisition time
-        self.ps.setSamplingInterval(sample_interval, duration)
+        _, samples, max_samples = self.ps.setSamplingInterval(
+            self.sample_interval, self.duration
+        )
+        if samples > max_samples:
+            raise ValueError(
+                f"{samples} samples do not fit in {segments} segments of "
+                f"{max_samples} samples"
+            )
+
+        # Preallocate raw and converted buffers for bulk downloads
+        self._raw = np.zeros((2, segments, samples), dtype=np.int16)
+        self._volts = np.zeros((2, segments, samples), dtype=np.float64)
 
     def close(self):
         """Close connection"""
         self.ps.close()
 
+    def disarm(self):
+        """Stop pending capture left by a pipelined acquisition"""
+        if self._armed:
+            self.ps.stop()
+        super().disarm()
+
     def arm(self):
         """Arm to acquire next trigger
 
-        Sleep 100ms to make sure the device armed.
+        The driver returns once the device waits for the trigger, so there is
+        no need to wait unless ``arm_delay`` was set.
         """
-        self.ps.runBlock()
+        pretrig = self._pre_samples * self.sample_interval / self.duration
+        self.ps.runBlock(pretrig=pretrig)
+        self._arm_time = perf_counter()
+
+        if self.arm_delay:
+            sleep(self.arm_delay)
+
+    def wait_ready(self):
+        """Poll the driver until the capture is done
 
-        # Wait a bit for arming process
-        sleep(0.1)
+        :raises TimeoutError: if capture is not done after ``ready_timeout``
+        """
+        log.debug("Waiting for acquisition")
+        deadline = perf_counter() + self.ready_timeout
+        interval = self.poll_interval
+        while not self.ps.isReady():
+            if perf_counter() > deadline:
+                raise TimeoutError("Acquisition timed out.")
+            sleep(interval)
+            interval = min(2 * interval, self.max_poll_interval)
+        self.wait_latency.add(perf_counter() - self._arm_time)
+
+    def set_trigger_window(self, cycles, freq=8e6, margin=0.1):
+        """Capture only around the expected execution
+
+        Acquisition duration is reduced to the window from
+        :func:`trigger_window` and buffers are allocated again.
+
+        :param cycles: expected cycles of execution, without NOP paddings
+        :type cycles: int
+        :param freq: CPU clock frequency in Hz, defaults to 8 MHz
+        :type freq: float, optional
+        :param margin: relative margin on execution duration, defaults to 10%
+        :type margin: float, optional
+        """
+        pre, post = trigger_window(cycles, freq, self.sample_interval, margin)
+        log.debug(f"Capturing {pre} samples before and {post} after trigger")
+        self._pre_samples = pre
+        self.duration = (pre + post) * self.sample_interval
+        self.set_segments(self.segments)
 
-    def get_trace(self):
+    def get_trace(self, trigger_crop=True):
         """Download acquired data and return side channel trace
 
-        Trace will be a numpy array with float64 samples.
+        Trace will be a numpy array with float64 samples, or int16 ADC counts
+        in raw mode.
 
+        :param trigger_crop: download only samples after trigger, defaults to
+            True
+        :type trigger_crop: bool, optional
         :return: acquired trace and clock
-        :rtype: (np.ndarray, np.ndarray)
+        :rtype: (np.ndarray, np.ndarray) or (RawTrace, RawTrace)
         """
         # Wait for oscilloscope to be ready
-        log.debug("Waiting for acquisition")
-        self.ps.waitReady()
+        self.wait_ready()
 
         # Download data from channel A and B
         log.debug("Downloading traces")
-        trace = self.ps.getDataV(channel="A")
-        clock = self.ps.getDataV(channel="B")
+        start = self._pre_samples if trigger_crop else 0
+        samples = self._raw.shape[2] - start
+        if self.raw:
+            return tuple(
+                RawTrace(
+                    self.ps.getDataRaw(c, numSamples=samples, startIndex=start)[0],
+                    **self.ps.getScaleAndOffset(c),
+                )
+                for c in ["A", "B"]
+            )
+        trace = self.ps.getDataV(channel="A", numSamples=samples, startIndex=start)
+        clock = self.ps.getDataV(channel="B", numSamples=samples, startIndex=start)
+
+        return trace, clock
+
+    def get_chunks(self, chunk_size):
+        """Download samples after trigger chunk by chunk
+
+        The 3000a driver has no streaming mode fast enough for 4 ns sampling,
+        so the block is captured in oscilloscope memory then downloaded in
+        chunks. The whole trace never needs to fit in host memory.
+
+        :param chunk_size: number of samples per chunk
+        :type chunk_size: int
+        :return: generator of trace and clock chunks
+        :rtype: generator of (np.ndarray, np.ndarray)
+        """
+        self.wait_ready()
+        samples = self._raw.shape[2]
+        for start in range(self._pre_samples, samples, chunk_size):
+            n = min(chunk_size, samples - start)
+            yield tuple(
+                self.ps.getDataV(channel=c, numSamples=n, startIndex=start)
+                for c in ["A", "B"]
+            )
+
+    def get_traces(self, trigger_crop=True):
+        """Download all segments acquired after one arming
+
+        Each channel is downloaded in one bulk transfer. Returned arrays are
+        reused by the next call, copy them to keep them.
+
+        :param trigger_crop: crop samples before trigger, defaults to True
+        :type trigger_crop: bool, optional
+        :return: acquired traces and clocks, one segment per row
+        :rtype: (np.ndarray, np.ndarray) or (RawTrace, RawTrace)
+        """
+        # Wait for oscilloscope to be ready
+        self.wait_ready()
+
+        # Download data from channel A and B
+        log.debug(f"Downloading {self.segments} segments")
+        start = self._pre_samples if trigger_crop else 0
+        results = []
+        for i, channel in enumerate(["A", "B"]):
+            self.ps.getDataRawBulk(channel=channel, data=self._raw[i])
+            if self.raw:
+                conversion = self.ps.getScaleAndOffset(channel)
+                results.append(RawTrace(self._raw[i, :, start:], **conversion))
+            else:
+                self.ps.rawToV(channel, self._raw[i], dataV=self._volts[i])
+                results.append(self._volts[i, :, start:])
+
+        return tuple(results)
+
+
+class LoopbackSerial:
+    """Serial device stand-in running an emulator instead of a target board.
+
+    Each write is sent to the emulator as one input. Emulator output data is
+    returned by following reads and its execution trace is passed to
+    listeners such as :class:`SimulatedScope`.
+    """
+
+    def __init__(self, emulator, output_len: int, latency=0.0, timeout=1.0):
+        """Initialize loopback serial device
 
+        :param emulator: emulator running the firmware
+        :type emulator: abby.emulator.Emulator
+        :param output_len: size of the output data returned by the firmware
+        :type output_len: int
+        :param latency: time spent in each read and write in seconds,
+            defaults to 0
+        :type latency: float, optional
+        :param timeout: kept for compatibility with serial.Serial, defaults to
+            1 s
+        :type timeout: float, optional
+        """
+        self.emulator = emulator
+        self.output_len = output_len
+        self.latency = latency
+        self.timeout = timeout
+        self.listeners = []
+        self._rx = bytearray()
+
+    def __enter__(self):
+        """For use with context manager.
+
+        :return: serial device
+        :rtype: LoopbackSerial
+        """
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        """Called on context close."""
+        self.close()
+
+    def close(self):
+        """Close serial device"""
+        self._rx.clear()
+
+    def write(self, data: bytes):
+        """Run emulator on input data
+
+        :param data: input data
+        :type data: bytes
+        :return: number of bytes written
+        :rtype: int
+        """
+        sleep(self.latency)
+        output_data, execution_trace = self.emulator.run(data, self.output_len)
+        self._rx += output_data
+        for listener in self.listeners:
+            listener(execution_trace)
+        return len(data)
+
+    def read(self, n=1) -> bytes:
+        """Read up to n bytes of emulator output
+
+        :param n: maximum number of bytes to read, defaults to 1
+        :type n: int, optional
+        :return: read bytes, shorter than n if output is exhausted
+        :rtype: bytes
+        """
+        sleep(self.latency)
+        data = bytes(self._rx[:n])
+        del self._rx[:n]
+        return data
+
+
+class SimulatedScope(Oscilloscope):
+    """Oscilloscope synthesizing traces from emulator execution traces.
+
+    The power of each instruction is predicted by a model then spread over
+    one clock cycle of samples. Cycle durations are randomized with clock
+    jitter, Gaussian noise is added and the execution starts after a trigger
+    delay. The clock channel is a sine wave falling through zero once per
+    cycle, like the real clock seen through :func:`abby.processing.find_cycles`.
+
+    Combined with :class:`LoopbackSerial`, the acquisition flow can be
+    profiled without any hardware::
+
+        >>> emulator = abby.emulator.QEMUEmulator(fw_path, "stm32f0discovery")
+        >>> serial = LoopbackSerial(emulator, output_len=17)
+        >>> scope = SimulatedScope(abby.model.HammingWeightModel())
+        >>> scope.attach(serial)
+        >>> _, trace, clock = scope.run_and_acquire(input_txt, 17, serial)
+    """
+
+    def __init__(
+        self,
+        model,
+        sample_interval=4e-9,
+        freq=8e6,
+        noise=1e-3,
+        jitter=0.01,
+        trigger_delay=0.0,
+        arm_delay=0.0,
+        download_delay=0.0,
+        seed=None,
+    ):
+        """Initialize simulated oscilloscope
+
+        :param model: model predicting power from execution traces
+        :type model: abby.model.Model
+        :param sample_interval: time interval between samples in seconds,
+            defaults to 4 ns
+        :type sample_interval: float, optional
+        :param freq: CPU clock frequency in Hz, defaults to 8 MHz
+        :type freq: float, optional
+        :param noise: standard deviation of added noise, defaults to 1e-3
+        :type noise: float, optional
+        :param jitter: relative standard deviation of cycle durations,
+            defaults to 1%
+        :type jitter: float, optional
+        :param trigger_delay: time before execution starts in seconds,
+            defaults to 0
+        :type trigger_delay: float, optional
+        :param arm_delay: time spent arming in seconds, defaults to 0
+        :type arm_delay: float, optional
+        :param download_delay: time spent downloading each trace in
+            seconds, defaults to 0
+        :type download_delay: float, optional
+        :param seed: random generator seed, defaults to system entropy
+        :type seed: int, optional
+        """
+        super().__init__()
+        self.model = model
+        self.sample_interval = sample_interval
+        self.freq = freq
+        self.noise = noise
+        self.jitter = jitter
+        self.trigger_delay = trigger_delay
+        self.arm_delay = arm_delay
+        self.download_delay = download_delay
+        self.rng = np.random.default_rng(seed)
+        self.ready_timeout = 1.0
+        self._capturing = False
+        self._power = None
+        self._executed = threading.Event()
+
+    def attach(self, serial):
+        """Capture executions happening on a loopback serial device
+
+        :param serial: loopback serial device to listen to
+        :type serial: LoopbackSerial
+        """
+        serial.listeners.append(self._on_execution)
+
+    def close(self):
+        """Close connection"""
+        self._capturing = False
+
+    def set_trigger_window(self, cycles, freq=8e6, margin=0.1):
+        """Only disarm as synthesized traces already span only the execution
+
+        :param cycles: expected cycles of execution, without NOP paddings
+        :type cycles: int
+        :param freq: CPU clock frequency in Hz, defaults to 8 MHz
+        :type freq: float, optional
+        :param margin: relative margin on execution duration, defaults to 10%
+        :type margin: float, optional
+        """
+        self.disarm()
+
+    def disarm(self):
+        """Stop capturing pending execution"""
+        self._capturing = False
+        super().disarm()
+
+    def arm(self):
+        """Arm to acquire next execution"""
+        sleep(self.arm_delay)
+        self._capturing = True
+        self._power = None
+        self._executed.clear()
+
+    def _on_execution(self, execution_trace):
+        """Record predicted power of an execution if armed."""
+        if self._capturing:
+            self._capturing = False
+            self._power = np.asarray(self.model.predict(execution_trace))
+            self._executed.set()
+
+    def synthesize(self, power):
+        """Synthesize a trace and clock from power of each cycle
+
+        :param power: power of each cycle
+        :type power: [float] or np.ndarray
+        :return: trace and clock
+        :rtype: (np.ndarray, np.ndarray)
+        """
+        power = np.asarray(power, dtype=np.float64)
+        bounds = self._cycle_bounds(len(power))
+        return self._synthesize_range(power, bounds, 0, int(np.ceil(bounds[-1])))
+
+    def _cycle_bounds(self, cycles):
+        """Cycle boundaries in samples with jitter and trigger delay."""
+        samples_per_cycle = 1 / (self.freq * self.sample_interval)
+        delay = int(round(self.trigger_delay / self.sample_interval))
+        durations = samples_per_cycle * (
+            1 + self.jitter * self.rng.standard_normal(cycles)
+        )
+        return delay + np.concatenate([[0], np.cumsum(np.maximum(durations, 1))])
+
+    def _synthesize_range(self, power, bounds, start, stop):
+        """Synthesize trace and clock samples from start to stop."""
+        # Power of the cycle containing each sample, zero before execution
+        t = np.arange(start, stop)
+        cycle = np.searchsorted(bounds, t, side="right") - 1
+        executing = (cycle >= 0) & (cycle < len(power))
+        trace = np.where(executing, power[np.clip(cycle, 0, len(power) - 1)], 0.0)
+        trace += self.noise * self.rng.standard_normal(len(t))
+
+        # Clock phase goes from 0 to 1 during each cycle
+        cycle = np.clip(cycle, 0, len(power) - 1)
+        phase = (t - bounds[cycle]) / (bounds[cycle + 1] - bounds[cycle])
+        clock = np.cos(2 * np.pi * phase)
         return trace, clock
+
+    def get_trace(self, trigger_crop=True):
+        """Synthesize the trace of the last execution after arming
+
+        :param trigger_crop: unused as traces start at trigger, defaults to
+            True
+        :type trigger_crop: bool, optional
+        :raises TimeoutError: if no execution happened since arming
+        :return: acquired trace and clock
+        :rtype: (np.ndarray, np.ndarray)
+        """
+        sleep(self.download_delay)
+        if self._power is None:
+            raise TimeoutError("Acquisition timed out.")
+        trace, clock = self.synthesize(self._power)
+        self._power = None
+        return trace, clock
+
+    def get_chunks(self, chunk_size):
+        """Synthesize the trace of the last execution chunk by chunk
+
+        :param chunk_size: number of samples per chunk
+        :type chunk_size: int
+        :raises TimeoutError: if no execution within ``ready_timeout``
+        :return: generator of trace and clock chunks
+        :rtype: generator of (np.ndarray, np.ndarray)
+        """
+        if not self._executed.wait(self.ready_timeout) or self._power is None:
+            raise TimeoutError("Acquisition timed out.")
+        power, self._power = self._power, None
+        bounds = self._cycle_bounds(len(power))
+        length = int(np.ceil(bounds[-1]))
+        for start in range(0, length, chunk_size):
+            sleep(self.download_delay * chunk_size / length)
+            stop = min(start + chunk_size, length)
+            yield self._synthesize_range(power, bounds, start, stop)
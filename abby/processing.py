@@ -5,7 +5,16 @@
 Trace processing tools.
 """
 
+import functools
+import hashlib
+import inspect
 import logging
+import os
+import pathlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
 
 import numpy as np
 from scipy import signal
@@ -14,6 +23,75 @@ from scipy import signal
 log = logging.getLogger(__name__)
 
 
+class RawTrace:
+    """Raw ADC samples with the conversion to volts.
+
+    Samples are kept as integer ADC counts, which are 4 times smaller than
+    float64 volts. Volts are ``data * scale - offset`` and are only computed
+    when needed, for example when NumPy converts this object to an array.
+    Reductions such as :func:`abby.processing.downsample_cycles` work
+    directly on counts.
+    """
+
+    def __init__(self, data, scale, offset=0.0):
+        """Wrap raw ADC samples.
+
+        :param data: ADC counts
+        :type data: np.ndarray
+        :param scale: volts per ADC count
+        :type scale: float
+        :param offset: offset subtracted after scaling, defaults to 0
+        :type offset: float, optional
+        """
+        self.data = data
+        self.scale = scale
+        self.offset = offset
+
+    def volts(self, dtype=np.float32):
+        """Convert samples to volts.
+
+        :param dtype: type of the returned array, defaults to float32
+        :type dtype: numpy.dtype, optional
+        :return: samples in volts
+        :rtype: np.ndarray
+        """
+        v = np.multiply(self.data, self.scale, dtype=dtype)
+        v -= self.offset
+        return v
+
+    def __array__(self, dtype=None, copy=None):
+        """Convert samples to volts when used as a NumPy array."""
+        return self.volts(np.float64 if dtype is None else dtype)
+
+    def __len__(self):
+        """Get number of samples."""
+        return len(self.data)
+
+    def __getitem__(self, index):
+        """Slice samples without converting them."""
+        return RawTrace(self.data[index], self.scale, self.offset)
+
+    def save(self, path):
+        """Save counts and conversion parameters to a NumPy ``.npz`` file.
+
+        :param path: destination file
+        :type path: str or pathlib.Path
+        """
+        np.savez(path, data=self.data, scale=self.scale, offset=self.offset)
+
+    @classmethod
+    def load(cls, path):
+        """Load a raw trace saved with :meth:`save`.
+
+        :param path: source file
+        :type path: str or pathlib.Path
+        :return: raw trace
+        :rtype: RawTrace
+        """
+        with np.load(path) as f:
+            return cls(f["data"], float(f["scale"]), float(f["offset"]))
+
+
 def crop_cycles(trace, threshold, samples_per_cycle=1):
     """Crop cycles at beginning and end of trace.
 
@@ -119,9 +197,764 @@ def find_cycles(clock: np.ndarray, freq_estimated=8e6, sample_rate=250e6):
     :rtype: numpy.ndarray
     """
     # Filter clock signal with second order high pass filter
-    sos = signal.butter(2, freq_estimated, "hp", fs=sample_rate, output="sos")
+    sos = butter_sos(2, freq_estimated, "highpass", sample_rate)
     clock = signal.sosfilt(sos, clock)
 
     # Get falling edges of clock signal
     cycles_indexes = np.where((clock[:-1] > 0) & (clock[1:] < 0))[0]
     return cycles_indexes
+
+
+def regular_cycles(length, samples_per_cycle, offset=0.0):
+    """Find CPU cycles of a trace sampled synchronously with CPU clock.
+
+    Without clock channel, for example with a Chipwhisperer sampling on the
+    clock it generates for the target, cycles have a constant duration.
+
+    :param length: number of samples in trace
+    :type length: int
+    :param samples_per_cycle: number of samples per cycle, may be fractional
+    :type samples_per_cycle: float
+    :param offset: index of first cycle beginning, defaults to 0
+    :type offset: float, optional
+    :return: indexes of cycles beginning, last one closing the last cycle
+    :rtype: numpy.ndarray
+    """
+    count = max(int((length - offset) // samples_per_cycle), 0)
+    return np.round(offset + samples_per_cycle * np.arange(count + 1)).astype(int)
+
+
+def downsample_cycles(trace, cycles_indexes):
+    """Keep the maximum sample of each CPU cycle.
+
+    The last index only closes the previous cycle, so the output contains
+    ``len(cycles_indexes) - 1`` samples.
+
+    A :class:`abby.processing.RawTrace` is reduced on ADC counts and only the
+    result is converted to volts.
+
+    :param trace: side-channel trace to process
+    :type trace: [float] or np.ndarray or RawTrace
+    :param cycles_indexes: indexes of cycles beginning, for example from
+        :func:`abby.processing.find_cycles`
+    :type cycles_indexes: [int] or np.ndarray
+    :return: one sample per cycle
+    :rtype: np.ndarray
+    """
+    cycles_indexes = np.asarray(cycles_indexes)
+    if len(cycles_indexes) < 2:
+        return np.zeros(0)
+    if isinstance(trace, RawTrace):
+        # Maximum of volts is the maximum or minimum of counts
+        reduce = np.maximum if trace.scale >= 0 else np.minimum
+        counts = reduce.reduceat(trace.data[: cycles_indexes[-1]], cycles_indexes[:-1])
+        return RawTrace(counts, trace.scale, trace.offset).volts()
+
+    trace = np.asarray(trace)
+    return np.maximum.reduceat(trace[: cycles_indexes[-1]], cycles_indexes[:-1])
+
+
+class CycleReducer:
+    """Find cycles and keep the maximum of each one, chunk by chunk.
+
+    Pushing consecutive chunks of a trace and its clock gives the same result
+    as :func:`find_cycles` then :func:`downsample_cycles` on the whole trace.
+    Only the samples of the current cycle are kept between chunks, so long
+    executions can be reduced without holding full-resolution traces.
+
+    For example::
+
+        >>> reducer = CycleReducer()
+        >>> trace = np.concatenate([reducer.push(t, c) for t, c in chunks])
+    """
+
+    def __init__(self, freq_estimated=8e6, sample_rate=250e6):
+        """Initialize cycle reducer
+
+        :param freq_estimated: estimation of the clock frequency in Hz, used
+            for high pass filtering, defaults to 8 MHz
+        :type freq_estimated: float, optional
+        :param sample_rate: trace sampling rate in Hz, defaults to 250 MHz
+        :type sample_rate: float, optional
+        """
+        self.sos = butter_sos(2, freq_estimated, "highpass", sample_rate)
+        self.reset()
+
+    def reset(self):
+        """Forget previous chunks to reduce a new trace"""
+        self._zi = np.zeros((self.sos.shape[0], 2))
+        self._last_clock = 0.0
+        self._tail = np.zeros(0)  # samples since last cycle beginning
+        self._started = False
+        self.cycles = 0
+
+    def push(self, trace, clock):
+        """Reduce cycles ending in this chunk
+
+        :param trace: next chunk of side-channel trace
+        :type trace: [float] or np.ndarray
+        :param clock: next chunk of clock signal, same length as trace
+        :type clock: [float] or np.ndarray
+        :return: one sample per cycle ending in this chunk
+        :rtype: np.ndarray
+        """
+        # Filter with state carried over from previous chunk
+        clock, self._zi = signal.sosfilt(self.sos, clock, zi=self._zi)
+        clock = np.concatenate([[self._last_clock], clock])
+        self._last_clock = clock[-1]
+
+        # Falling edges, relative to the sample before this chunk
+        edges = np.where((clock[:-1] > 0) & (clock[1:] < 0))[0]
+
+        # Samples from the last sample of previous chunk
+        trace = np.asarray(trace)
+        if self._started:
+            samples = np.concatenate([self._tail, trace])
+            edges += len(self._tail) - 1
+            starts = np.concatenate([[0], edges])
+        elif len(edges):
+            samples = np.concatenate([self._tail[-1:], trace])
+            starts = edges + len(self._tail[-1:]) - 1
+            self._started = True
+        else:
+            self._tail = trace[-1:]
+            return np.zeros(0)
+
+        self._tail = samples[starts[-1] :]
+        if len(starts) < 2:
+            return np.zeros(0)
+        self.cycles += len(starts) - 1
+        return np.maximum.reduceat(samples[: starts[-1]], starts[:-1])
+
+
+@functools.lru_cache(maxsize=None)
+def butter_sos(order, critical_freqs, btype, sample_rate):
+    """Design a Butterworth filter in second-order sections.
+
+    Results are cached so that processing many traces with the same
+    parameters does not design the same filter again.
+
+    :param order: order of the filter
+    :type order: int
+    :param critical_freqs: cutoff frequency in Hz, or ``(low, high)`` for band
+        filters
+    :type critical_freqs: float or (float, float)
+    :param btype: ``lowpass``, ``highpass``, ``bandpass`` or ``bandstop``
+    :type btype: str
+    :param sample_rate: trace sampling rate in Hz
+    :type sample_rate: float
+    :return: second-order sections, shared between calls so do not modify it
+    :rtype: np.ndarray
+    """
+    return signal.butter(order, critical_freqs, btype, fs=sample_rate, output="sos")
+
+
+@functools.lru_cache(maxsize=None)
+def notch_sos(freq, quality, sample_rate):
+    """Design a second order IIR notch filter in second-order sections.
+
+    Results are cached, see :func:`abby.processing.butter_sos`.
+
+    :param freq: frequency to remove in Hz
+    :type freq: float
+    :param quality: quality factor, higher is narrower
+    :type quality: float
+    :param sample_rate: trace sampling rate in Hz
+    :type sample_rate: float
+    :return: second-order sections, shared between calls so do not modify it
+    :rtype: np.ndarray
+    """
+    b, a = signal.iirnotch(freq, quality, fs=sample_rate)
+    return signal.tf2sos(b, a)
+
+
+class FilterBank:
+    """Set of named zero-phase filters applied on batches of traces.
+
+    Filters are stored as second-order sections and applied with
+    :func:`scipy.signal.sosfiltfilt` along axis 1 of a 2-D array of traces.
+    The batch is split in chunks of rows that are filtered concurrently in a
+    thread pool, SciPy releases the GIL while filtering.
+
+    For example::
+
+        >>> bank = abby.processing.FilterBank(sample_rate=250e6)
+        >>> bank.add_lowpass("lp", 20e6)
+        >>> bank.add_clock_harmonics(8e6, harmonics=2)
+        >>> bank.names
+        ['lp', 'clock_1', 'clock_2']
+        >>> filtered = bank.apply(traces, "lp")
+    """
+
+    def __init__(self, sample_rate=250e6, order=2, workers=None, chunk_size=64):
+        """Initialize an empty filter bank.
+
+        :param sample_rate: trace sampling rate in Hz, defaults to 250 MHz
+        :type sample_rate: float, optional
+        :param order: order of the Butterworth filters, defaults to 2
+        :type order: int, optional
+        :param workers: number of threads, defaults to
+            :class:`concurrent.futures.ThreadPoolExecutor` default
+        :type workers: int, optional
+        :param chunk_size: number of traces filtered by each task, defaults
+            to 64
+        :type chunk_size: int, optional
+        """
+        self.sample_rate = sample_rate
+        self.order = order
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.filters = {}
+
+    @property
+    def names(self):
+        """Names of the filters in the bank.
+
+        :return: filter names in insertion order
+        :rtype: [str]
+        """
+        return list(self.filters)
+
+    def add_lowpass(self, name, cutoff):
+        """Add a Butterworth low-pass filter.
+
+        :param name: name of the filter
+        :type name: str
+        :param cutoff: cutoff frequency in Hz
+        :type cutoff: float
+        """
+        self.filters[name] = butter_sos(
+            self.order, float(cutoff), "lowpass", self.sample_rate
+        )
+
+    def add_bandpass(self, name, low, high):
+        """Add a Butterworth band-pass filter.
+
+        :param name: name of the filter
+        :type name: str
+        :param low: lower cutoff frequency in Hz
+        :type low: float
+        :param high: higher cutoff frequency in Hz
+        :type high: float
+        """
+        self.filters[name] = butter_sos(
+            self.order, (float(low), float(high)), "bandpass", self.sample_rate
+        )
+
+    def add_notch(self, name, freq, quality=30.0):
+        """Add a notch filter, for example to remove mains hum or a clock.
+
+        :param name: name of the filter
+        :type name: str
+        :param freq: frequency to remove in Hz
+        :type freq: float
+        :param quality: quality factor, defaults to 30
+        :type quality: float, optional
+        """
+        self.filters[name] = notch_sos(float(freq), float(quality), self.sample_rate)
+
+    def add_clock_harmonics(self, freq=8e6, harmonics=3, bandwidth=0.2):
+        """Add one band-pass filter around each clock harmonic.
+
+        Filters are named ``clock_1`` to ``clock_<harmonics>``. Harmonics
+        above Nyquist frequency are skipped.
+
+        :param freq: clock frequency in Hz, defaults to 8 MHz
+        :type freq: float, optional
+        :param harmonics: number of harmonics, defaults to 3
+        :type harmonics: int, optional
+        :param bandwidth: width of each band relative to the clock frequency,
+            defaults to 0.2
+        :type bandwidth: float, optional
+        """
+        half_width = freq * bandwidth / 2
+        for n in range(1, harmonics + 1):
+            if n * freq + half_width >= self.sample_rate / 2:
+                log.warning(f"Harmonic {n} of {freq} Hz is above Nyquist, skipped")
+                break
+            self.add_bandpass(
+                f"clock_{n}", n * freq - half_width, n * freq + half_width
+            )
+
+    def apply(self, traces, name, out=None):
+        """Apply a zero-phase filter on a batch of traces.
+
+        :param traces: 2-D array of traces, one trace per row
+        :type traces: [[float]] or np.ndarray
+        :param name: name of the filter to apply
+        :type name: str
+        :param out: array to write filtered traces into, defaults to a new one
+        :type out: np.ndarray, optional
+        :raises KeyError: if the filter is not in the bank
+        :return: filtered traces
+        :rtype: np.ndarray
+        """
+        sos = self.filters[name]
+        traces = np.atleast_2d(traces)
+        if out is None:
+            out = np.empty(traces.shape, dtype=np.result_type(traces, np.float32))
+
+        def filter_chunk(start):
+            end = start + self.chunk_size
+            out[start:end] = signal.sosfiltfilt(sos, traces[start:end], axis=1)
+
+        starts = range(0, traces.shape[0], self.chunk_size)
+        with ThreadPoolExecutor(self.workers) as executor:
+            # Consume the iterator to re-raise exceptions from workers
+            list(executor.map(filter_chunk, starts))
+        return out
+
+    def apply_all(self, traces):
+        """Apply every filter of the bank on a batch of traces.
+
+        :param traces: 2-D array of traces, one trace per row
+        :type traces: [[float]] or np.ndarray
+        :return: filtered traces for each filter name
+        :rtype: {str: np.ndarray}
+        """
+        return {name: self.apply(traces, name) for name in self.filters}
+
+
+def resampling_factors(
+    sample_interval=4e-9, freq=8e6, samples_per_cycle=1, max_denominator=1000
+):
+    """Get polyphase up and down factors from scope to emulator cycle grid.
+
+    The emulator outputs ``samples_per_cycle`` values per CPU cycle while the
+    oscilloscope outputs one sample every ``sample_interval`` seconds.
+
+    :param sample_interval: time interval between acquired samples in seconds,
+        defaults to 4 ns
+    :type sample_interval: float, optional
+    :param freq: CPU clock frequency in Hz, defaults to 8 MHz
+    :type freq: float, optional
+    :param samples_per_cycle: number of samples for each cycle, defaults to 1
+    :type samples_per_cycle: int, optional
+    :param max_denominator: bound on the factors, the smaller the faster,
+        defaults to 1000
+    :type max_denominator: int, optional
+    :return: upsampling and downsampling factors
+    :rtype: (int, int)
+    """
+    ratio = Fraction(freq * samples_per_cycle * sample_interval)
+    ratio = ratio.limit_denominator(max_denominator)
+    return ratio.numerator, ratio.denominator
+
+
+def resample_traces(traces, sample_interval=4e-9, freq=8e6, samples_per_cycle=1):
+    """Resample a batch of acquired traces to the emulator cycle grid.
+
+    This applies :func:`scipy.signal.resample_poly` along axis 1 with factors
+    from :func:`abby.processing.resampling_factors`. Use
+    :class:`abby.processing.StreamingResampler` to get the same result chunk
+    by chunk.
+
+    :param traces: 2-D array of traces, one trace per row
+    :type traces: [[float]] or np.ndarray
+    :param sample_interval: time interval between acquired samples in seconds,
+        defaults to 4 ns
+    :type sample_interval: float, optional
+    :param freq: CPU clock frequency in Hz, defaults to 8 MHz
+    :type freq: float, optional
+    :param samples_per_cycle: number of samples for each cycle, defaults to 1
+    :type samples_per_cycle: int, optional
+    :return: resampled traces
+    :rtype: np.ndarray
+    """
+    up, down = resampling_factors(sample_interval, freq, samples_per_cycle)
+    return signal.resample_poly(np.atleast_2d(traces), up, down, axis=1)
+
+
+class StreamingResampler:
+    """Polyphase resampler processing traces chunk by chunk.
+
+    Concatenated outputs of :meth:`push` then :meth:`flush` are equal to
+    :func:`scipy.signal.resample_poly` applied on the whole traces, so chunk
+    boundaries do not create edge effects. Only the input samples still needed
+    by the anti-aliasing filter are kept between calls.
+
+    For example::
+
+        >>> resampler = abby.processing.StreamingResampler(4, 125)
+        >>> chunks = [resampler.push(c) for c in np.split(traces, 10, axis=1)]
+        >>> chunks.append(resampler.flush())
+        >>> resampled = np.concatenate(chunks, axis=1)
+    """
+
+    def __init__(self, up, down, window=("kaiser", 5.0)):
+        """Initialize resampler and design its anti-aliasing filter.
+
+        :param up: upsampling factor
+        :type up: int
+        :param down: downsampling factor
+        :type down: int
+        :param window: window used to design the FIR filter, defaults to
+            :func:`scipy.signal.resample_poly` default
+        :type window: str or tuple, optional
+        """
+        g = np.gcd(up, down)
+        self.up, self.down = up // g, down // g
+
+        # Same filter design as scipy.signal.resample_poly
+        max_rate = max(self.up, self.down)
+        if max_rate == 1:
+            self.half_len = 0
+            self.h = np.ones(1)
+        else:
+            self.half_len = 10 * max_rate
+            self.h = signal.firwin(2 * self.half_len + 1, 1.0 / max_rate, window=window)
+            self.h *= self.up
+
+        self._buffer = None
+        self._offset = 0  # input index of first buffered sample
+        self._received = 0  # count of received input samples
+        self._next = 0  # index of next output sample
+
+    def _compute(self, count):
+        """Compute ``count`` output samples from the buffer."""
+        # Upsampled index of the first tap of next output sample, relative to
+        # the buffer. Delay the filter so that it falls on a downsampling step.
+        first = self._next * self.down + self.half_len - self._offset * self.up
+        shift = -first % self.down
+        h = np.concatenate([np.zeros(shift), self.h])
+        y = signal.upfirdn(h, self._buffer, self.up, self.down, axis=1)
+        start = (first + shift) // self.down
+        y = y[:, start : start + count]
+        self._next += count
+
+        # Drop input samples that are no longer needed
+        needed = max(0, -(-(self._next * self.down - self.half_len) // self.up))
+        drop = min(needed - self._offset, self._buffer.shape[1])
+        if drop > 0:
+            self._buffer = self._buffer[:, drop:]
+            self._offset += drop
+        return y
+
+    def push(self, chunk):
+        """Add input samples and return every output sample already computable.
+
+        :param chunk: 2-D array of trace chunks, one trace per row
+        :type chunk: [[float]] or np.ndarray
+        :return: resampled chunk, may be empty
+        :rtype: np.ndarray
+        """
+        chunk = np.atleast_2d(chunk)
+        if self._buffer is None:
+            self._buffer = chunk
+        else:
+            self._buffer = np.concatenate([self._buffer, chunk], axis=1)
+        self._received += chunk.shape[1]
+
+        # Last output sample whose filter support is fully received
+        last = (self._received * self.up - 1 - self.half_len) // self.down
+        return self._compute(max(0, last + 1 - self._next))
+
+    def flush(self):
+        """Return remaining output samples considering zeros after the end.
+
+        :return: last resampled samples
+        :rtype: np.ndarray
+        """
+        if self._buffer is None:
+            return np.zeros((1, 0))
+        total = -(-self._received * self.up // self.down)
+        return self._compute(total - self._next)
+
+
+class ProcessingCache:
+    """Content-addressed disk cache for processing results.
+
+    Results are stored in ``path`` as NumPy ``.npz`` files named after a hash
+    of the function name, of the content of array and :class:`RawTrace`
+    arguments and of the other parameters. Arguments are bound to the
+    function signature first, so positional and keyword calls share results.
+    When the cache exceeds ``max_size`` bytes, least recently used results
+    are removed.
+
+    For example::
+
+        >>> cache = abby.processing.ProcessingCache("/tmp/abby_cache")
+        >>> cycles_indexes = cache(abby.processing.find_cycles, clock)
+        >>> find_cycles = cache.wrap(abby.processing.find_cycles)
+
+    Only functions returning a NumPy array, a :class:`RawTrace` or a tuple of
+    them can be cached.
+    """
+
+    def __init__(self, path, max_size=2**30):
+        """Open or create a cache folder.
+
+        :param path: folder to store results in
+        :type path: str or pathlib.Path
+        :param max_size: maximum size of the cache in bytes, defaults to 1 GiB
+        :type max_size: int, optional
+        """
+        self.path = pathlib.Path(path)
+        os.makedirs(self.path, exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = sum(f.stat().st_size for f in self.path.glob("*.npz"))
+        self._lock = threading.Lock()
+
+    def record(self, hits=0, misses=0):
+        """Count cache hits and misses, from any thread.
+
+        :param hits: number of hits to add, defaults to 0
+        :type hits: int, optional
+        :param misses: number of misses to add, defaults to 0
+        :type misses: int, optional
+        """
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    @staticmethod
+    def key(name, *args, **kwargs):
+        """Compute cache key from a function name and its arguments.
+
+        :param name: name of the cached function
+        :type name: str
+        :return: hexadecimal key
+        :rtype: str
+        """
+        h = hashlib.blake2b(name.encode(), digest_size=20)
+        named_args = [("", a) for a in args] + sorted(kwargs.items())
+        for arg_name, arg in named_args:
+            h.update(f"{arg_name}=".encode())
+            if isinstance(arg, RawTrace):
+                h.update(f"RawTrace({arg.scale!r}, {arg.offset!r})".encode())
+                arg = arg.data
+            if isinstance(arg, (list, np.ndarray)):
+                arr = np.ascontiguousarray(arg)
+                h.update(f"{arr.dtype.str}{arr.shape}".encode())
+                h.update(arr.view(np.uint8).reshape(-1).data)
+            else:
+                h.update(repr(arg).encode())
+        return h.hexdigest()
+
+    @staticmethod
+    def _pack(name, value) -> dict:
+        """Get arrays storing a result, RawTrace as its fields.
+
+        :raises TypeError: if value is not an array or a RawTrace
+        """
+        if isinstance(value, RawTrace):
+            return {
+                f"{name}.data": value.data,
+                f"{name}.scale": np.asarray(value.scale),
+                f"{name}.offset": np.asarray(value.offset),
+            }
+        if isinstance(value, np.ndarray):
+            return {name: value}
+        raise TypeError(f"Cannot cache {type(value).__name__} result")
+
+    @staticmethod
+    def _unpack(data, name):
+        """Get a result stored by :meth:`_pack`."""
+        if name in data:
+            return data[name]
+        return RawTrace(
+            data[f"{name}.data"],
+            data[f"{name}.scale"].item(),
+            data[f"{name}.offset"].item(),
+        )
+
+    def get(self, key):
+        """Load a result and mark it as recently used.
+
+        :param key: cache key
+        :type key: str
+        :return: stored result or None if missing
+        :rtype: np.ndarray or RawTrace or tuple or None
+        """
+        file = self.path / f"{key}.npz"
+        try:
+            with np.load(file) as data:
+                if "result" in data or "result.data" in data:
+                    result = self._unpack(data, "result")
+                else:
+                    count = len({name.split(".")[0] for name in data.files})
+                    result = tuple(
+                        self._unpack(data, f"result_{i}") for i in range(count)
+                    )
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(file)
+        except FileNotFoundError:
+            pass  # evicted by another process since loaded
+        return result
+
+    def put(self, key, result):
+        """Store a result then evict old results if the cache is too large.
+
+        :param key: cache key
+        :type key: str
+        :param result: result to store
+        :type result: np.ndarray or RawTrace or tuple
+        :raises TypeError: if result is not an array, a RawTrace or a tuple
+            of them
+        """
+        arrays = {}
+        if isinstance(result, tuple):
+            for i, r in enumerate(result):
+                if not isinstance(r, RawTrace):
+                    r = np.asarray(r)
+                arrays.update(self._pack(f"result_{i}", r))
+        else:
+            arrays = self._pack("result", result)
+
+        # Write to temporary file first so readers never see partial files
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        file = self.path / f"{key}.npz"
+        with self._lock:
+            if file.exists():
+                self._size -= file.stat().st_size
+            os.replace(tmp_path, file)
+            self._size += file.stat().st_size
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used results until cache fits in max_size."""
+        with self._lock:
+            if self._size <= self.max_size:
+                return
+            files = []
+            for f in self.path.glob("*.npz"):
+                try:
+                    stat = f.stat()
+                except FileNotFoundError:
+                    continue  # evicted by another process
+                files.append((stat.st_mtime, stat.st_size, f))
+            self._size = sum(size for _, size, _ in files)
+            for _, size, f in sorted(files, key=lambda x: x[0]):
+                if self._size <= self.max_size:
+                    break
+                log.debug(f"Evicting {f.name} from processing cache")
+                try:
+                    f.unlink()
+                except FileNotFoundError:
+                    pass  # already evicted by another process
+                self._size -= size
+
+    def __call__(self, func, *args, **kwargs):
+        """Call function or load its result if already computed.
+
+        :param func: function to call
+        :type func: callable
+        :return: function result
+        :rtype: np.ndarray or (np.ndarray)
+        """
+        bound = inspect.signature(func).bind(*args, **kwargs)
+        bound.apply_defaults()
+        name = f"{func.__module__}.{func.__qualname__}"
+        key = self.key(name, *bound.args, **bound.kwargs)
+        result = self.get(key)
+        if result is not None:
+            self.record(hits=1)
+            return result
+        self.record(misses=1)
+        result = func(*args, **kwargs)
+        self.put(key, result)
+        return result
+
+    def wrap(self, func):
+        """Get a cached version of a function.
+
+        :param func: function to wrap
+        :type func: callable
+        :return: function with the same signature using this cache
+        :rtype: callable
+        """
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return self(func, *args, **kwargs)
+
+        return wrapper
+
+
+class RunningAverage:
+    """Online mean and variance of traces with preallocated buffers.
+
+    Traces are accumulated with Welford's algorithm in float32 buffers that
+    are reused after :meth:`reset`, so repeated acquisitions are never stored.
+    When traces have different lengths, statistics are cropped to the
+    shortest trace.
+    """
+
+    def __init__(self, dtype=np.float32):
+        """Initialize an empty accumulator.
+
+        :param dtype: type of the buffers, defaults to float32
+        :type dtype: numpy.dtype, optional
+        """
+        self.dtype = dtype
+        self._mean = np.zeros(0, dtype=dtype)
+        self._m2 = np.zeros(0, dtype=dtype)
+        self._delta = np.zeros(0, dtype=dtype)
+        self.reset()
+
+    def reset(self):
+        """Forget accumulated traces but keep buffers."""
+        self.count = 0
+        self.length = 0
+
+    def add(self, trace):
+        """Accumulate a new trace.
+
+        :param trace: trace to accumulate
+        :type trace: [float] or np.ndarray
+        """
+        trace = np.asarray(trace)
+        if self.count == 0:
+            if len(trace) > len(self._mean):
+                self._mean = np.zeros(len(trace), dtype=self.dtype)
+                self._m2 = np.zeros(len(trace), dtype=self.dtype)
+                self._delta = np.zeros(len(trace), dtype=self.dtype)
+            self.length = len(trace)
+            self._mean[: self.length] = 0
+            self._m2[: self.length] = 0
+        self.length = min(self.length, len(trace))
+        self.count += 1
+
+        n = self.length
+        mean, m2, delta = self._mean[:n], self._m2[:n], self._delta[:n]
+        np.subtract(trace[:n], mean, out=delta)
+        mean += delta / self.count
+        # m2 += delta * (trace - mean), computed in place
+        np.multiply(delta, trace[:n] - mean, out=delta)
+        m2 += delta
+
+    @property
+    def mean(self):
+        """Mean of accumulated traces, a view on the internal buffer.
+
+        :return: mean trace
+        :rtype: np.ndarray
+        """
+        return self._mean[: self.length]
+
+    @property
+    def variance(self):
+        """Unbiased variance of each sample, infinite with less than 2 traces.
+
+        :return: variance trace
+        :rtype: np.ndarray
+        """
+        if self.count < 2:
+            return np.full(self.length, np.inf, dtype=self.dtype)
+        # Rounding errors can make m2 slightly negative
+        return np.maximum(self._m2[: self.length], 0) / (self.count - 1)
+
+    @property
+    def stderr(self):
+        """Standard error of the mean for each sample.
+
+        :return: standard error trace
+        :rtype: np.ndarray
+        """
+        return np.sqrt(self.variance / max(self.count, 1))
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+"""
+Measure acquisition throughput in traces per second.
+"""
+
+import argparse
+import logging
+import secrets
+from time import perf_counter
+
+from serial import Serial
+
+import abby
+
+log = logging.getLogger("abby")
+
+
+def benchmark(name, count, acquire):
+    """Run acquisitions then log and return traces per second."""
+    start = perf_counter()
+    acquire()
+    rate = count / (perf_counter() - start)
+    log.info(f"{name}: {rate:.1f} traces/s")
+    return rate
+
+
+def main(opt):
+    algo = opt.algorithm
+    if not opt.no_upload:
+        abby.firmware.pio_run(opt.board, algo, upload=True, debug=opt.debug)
+
+    # Same inputs for every run, only acquisition is measured
+    output_len = 1 + algo.msg_length  # +1 for header
+    inputs = [
+        b"\xAE" + secrets.token_bytes(algo.get_input_length()) for _ in range(opt.batch)
+    ]
+
+    if opt.scope == "chipwhisperer":
+        scope = abby.oscilloscope.Chipwhisperer(raw=opt.raw)
+    else:
+        scope = abby.oscilloscope.PS3000a(raw=opt.raw)
+
+    with scope, Serial(opt.serial, baudrate=115200, timeout=1) as ser:
+        scope.set_blockcipher(algo)
+
+        def single():
+            for i in range(opt.num):
+                input_text = inputs[i % opt.batch]
+                scope.run_and_acquire(input_text, output_len, ser, pipelined=True)
+
+        def batched():
+            for _ in range(opt.num // opt.batch):
+                scope.run_and_acquire_batch(inputs, output_len, ser)
+
+        benchmark("single", opt.num, single)
+
+        # Picoscope captures a batch in memory segments, reconfiguring
+        # stops the capture armed by last pipelined acquisition
+        if opt.scope == "ps3000a":
+            scope.set_segments(opt.batch)
+        else:
+            scope.disarm()
+        benchmark(f"batch of {opt.batch}", opt.num // opt.batch * opt.batch, batched)
+        log.info(f"Arming: {scope.arm_latency}")
+
+
+if __name__ == "__main__":
+    # Arguments parser
+    parser = argparse.ArgumentParser(
+        description="Measure acquisition throughput.",
+    )
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        default=False,
+        help="silent mode: hide info and warnings, overrides debug",
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        default=False,
+        help="debug mode: show debug messages",
+    )
+    parser.add_argument(
+        "-n",
+        "--num",
+        type=int,
+        default=1000,
+        help="amount of traces for each run, default to 1000",
+    )
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=100,
+        help="amount of traces per batch, default to 100",
+    )
+    parser.add_argument(
+        "-s",
+        "--scope",
+        choices=["chipwhisperer", "ps3000a"],
+        default="ps3000a",
+        help="oscilloscope to benchmark, default to ps3000a",
+    )
+    parser.add_argument(
+        "-b",
+        "--board",
+        required=True,
+        choices=abby.firmware.environments,
+        help="target device to flash",
+    )
+    parser.add_argument(
+        "-a",
+        "--algorithm",
+        default=abby.firmware.get_blockcipher("tinyaes"),
+        choices=abby.firmware.blockcipher.blockciphers,
+        type=abby.firmware.get_blockcipher,
+        help="algorithm to flash, default to tinyaes",
+    )
+    parser.add_argument(
+        "--serial",
+        default="/dev/ttyUSB0",
+        help="serial port of target, default to /dev/ttyUSB0",
+    )
+    parser.add_argument(
+        "--raw",
+        action="store_true",
+        default=False,
+        help="keep ADC counts instead of volts",
+    )
+    parser.add_argument(
+        "--no_upload",
+        action="store_true",
+        default=False,
+        help="benchmark firmware already on target",
+    )
+    options = parser.parse_args()
+    abby.logger.setup_logger("abby", options.quiet, options.debug)
+    main(options)
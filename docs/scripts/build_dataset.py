@@ -3,7 +3,9 @@
 """
 Build a dataset using acquisitions and side channel simulator data.
 
-Acquisition samples/cycle must match simulator.
+Acquisition samples/cycle must match simulator. Acquisitions that were not
+downsampled to one sample per cycle can be converted with
+`abby.processing.resample_traces`.
 """
 
 import argparse
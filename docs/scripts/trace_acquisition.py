@@ -5,6 +5,8 @@ Sample script to acquire traces.
 """
 
 import argparse
+import contextlib
+import logging
 import os
 import pathlib
 import secrets
@@ -16,79 +18,227 @@ from tqdm import tqdm
 
 import abby
 
+log = logging.getLogger("abby")
 
-def main(opt):
-    # Create destination folder if missing
-    dest = pathlib.Path(opt.output).absolute()
-    os.makedirs(dest, exist_ok=True)
 
-    with abby.oscilloscope.PS3000a() as ps:
-        for algo in tqdm(opt.algorithm):
-            # Build firmware for target then upload firmware to target board
+def input_texts(opt, algo):
+    """Yield input texts for selected algorithm, from file or random."""
+    for _ in tqdm(range(opt.num)):
+        # Input text contains all input data for selected algorithm
+        if opt.input is not None:
+            # Read input text from file
+            input_text = bytes.fromhex(opt.input.readline())
+            input_size = algo.get_input_length() + 1
+            if len(input_text) != input_size:
+                raise IndexError(
+                    f"\nInput text {input_text.hex()} does not "
+                    f"match size {input_size}"
+                )
+        else:
+            # Random input text
+            input_text = b"\xAE"  # start byte
+            input_text += secrets.token_bytes(algo.get_input_length())
+        yield input_text
+
+
+def measure_cycles(opt, algo):
+    """Measure cycles of algorithm on its emulated ELMO firmware if unknown.
+
+    Without Unicorn, the acquisition window of the algorithm is kept.
+    """
+    if opt.no_emulate_cycles or algo.get_cycle_count() is not None:
+        return
+    fw_path = abby.firmware.pio_run(opt.board, algo, elmo=True, debug=opt.debug)
+    try:
+        emulator = abby.emulator.UnicornEmulator(fw_path)
+    except ImportError as e:
+        log.warning(f"Cannot measure cycles of {algo}: {e}")
+        return
+    log.info(f"{algo} runs in {algo.measure_cycle_count(emulator)} cycles")
+
+
+def connect(opt, algo, scope):
+    """Flash target then open its serial port, or emulate it if simulating."""
+    if opt.simulate is None:
+        abby.firmware.pio_run(opt.board, algo, upload=True, debug=opt.debug)
+        return Serial("/dev/ttyUSB0", baudrate=115200, timeout=1)
+
+    # `qemu` parameter remove RCC initialization as emulation does not
+    # implement RCC
+    fw_path = abby.firmware.pio_run(opt.board, algo, qemu=True, debug=opt.debug)
+    emulator = abby.emulator.QEMUEmulator(fw_path, opt.board)
+    ser = abby.oscilloscope.LoopbackSerial(emulator, 1 + algo.msg_length)
+    scope.attach(ser)
+    return ser
+
+
+def rig(spec):
+    """Parse `serial[,upload_port[,scope_sn]]` rig specification."""
+    fields = spec.split(",")
+    if len(fields) > 3:
+        raise argparse.ArgumentTypeError(f"invalid rig {spec}")
+    return fields + [None] * (3 - len(fields))
+
+
+def acquire_rigs(opt, algo, process, dest):
+    """Shard acquisitions of one algorithm across all rigs."""
+    with contextlib.ExitStack() as stack:
+        measure_cycles(opt, algo)
+        rigs = []
+        for port, upload_port, sn in opt.rig:
+            # PlatformIO runs one at a time, so flash boards in turn
             abby.firmware.pio_run(
                 opt.board,
                 algo,
                 upload=True,
                 debug=opt.debug,
+                upload_port=upload_port,
             )
+            scope = stack.enter_context(abby.oscilloscope.PS3000a(raw=opt.raw, sn=sn))
+            scope.set_blockcipher(algo)
+            ser = stack.enter_context(Serial(port, baudrate=115200, timeout=1))
+            rigs.append(abby.acquisition.Rig(port, scope, ser))
 
-            # Open serial port after flashing
-            with Serial("/dev/ttyUSB0", baudrate=115200, timeout=1) as ser:
-
-                # Repeat acquisition with different input texts
-                for _ in tqdm(range(opt.num)):
-                    # Input text contains all input data for selected algorithm
-                    if opt.input is not None:
-                        # Read input text from file
-                        input_text = bytes.fromhex(opt.input.readline())
-                        input_size = algo.get_input_length() + 1
-                        if len(input_text) != input_size:
-                            raise IndexError(
-                                f"\nInput text {input_text.hex()} does not "
-                                f"match size {input_size}"
-                            )
-                    else:
-                        # Random input text
-                        input_text = b"\xAE"  # start byte
-                        input_text += secrets.token_bytes(algo.get_input_length())
+        # All rigs write to the same destination and index
+        store = stack.enter_context(abby.acquisition.TraceStore(dest))
+        orchestrator = abby.acquisition.Orchestrator(
+            rigs, store, process=process, average=opt.average
+        )
+        output_len = 1 + algo.msg_length  # +1 for header
+        orchestrator.run(
+            (input_text, output_len, f"{opt.board}_{algo}_{input_text.hex()}.npy")
+            for input_text in input_texts(opt, algo)
+        )
+        log.info(f"Acquisition of {algo}:\n{orchestrator.report()}")
+
+
+def clock_path(path):
+    """Get path of the clock saved with a raw acquisition."""
+    return path.with_name(f"{path.stem}_clock.npy")
+
+
+def reprocess(opt, dest, process):
+    """Process again raw acquisitions saved with their clock."""
+    source = pathlib.Path(opt.reprocess)
+    for path in tqdm(sorted(source.glob("*_clock.np[yz]"))):
+        name = f"{path.name.split('_clock.')[0]}.npy"
+        trace = abby.acquisition.load_numpy(source / name)
+        clock = abby.acquisition.load_numpy(clock_path(source / name))
+        abby.acquisition.save_numpy(dest / name, process(trace, clock))
+
+
+def main(opt):
+    # Create destination folder if missing
+    dest = pathlib.Path(opt.output).absolute()
+    os.makedirs(dest, exist_ok=True)
+
+    # Processing functions, cached on disk if requested. Fresh acquisitions
+    # are never the same, so only reprocessing saved ones can hit the cache.
+    find_cycles = abby.processing.find_cycles
+    downsample_cycles = abby.processing.downsample_cycles
+    crop_cycles = abby.processing.crop_cycles
+    if opt.cache is not None:
+        cache = abby.processing.ProcessingCache(opt.cache)
+        find_cycles = cache.wrap(find_cycles)
+        downsample_cycles = cache.wrap(downsample_cycles)
+        crop_cycles = cache.wrap(crop_cycles)
+
+    def process(trace, clock):
+        """Process trace in worker threads while next one is acquired."""
+        if not opt.no_downsample:
+            # Get the max of each cycle
+            cycles_indexes = find_cycles(clock)
+            trace = downsample_cycles(trace, cycles_indexes)
+            trace -= np.mean(trace)
+
+        if not opt.no_crop:
+            # Crop NOP cycles from power trace
+            trace = crop_cycles(trace, threshold=0.005)
+
+        return trace
 
+    if opt.reprocess is not None:
+        reprocess(opt, dest, process)
+        return
+
+    def keep_clock(trace, clock):
+        """Keep clock of raw acquisitions to reprocess them later."""
+        return trace, clock
+
+    def save_with_clock(destination, result):
+        """Save raw acquisition and its clock next to it."""
+        trace, clock = result
+        abby.acquisition.save_numpy(destination, trace)
+        if clock is not None:
+            abby.acquisition.save_numpy(clock_path(destination), clock)
+
+    if opt.rig is not None:
+        for algo in tqdm(opt.algorithm):
+            acquire_rigs(opt, algo, process, dest)
+        return
+
+    if opt.simulate is None:
+        scope = abby.oscilloscope.PS3000a(raw=opt.raw)
+    else:
+        # Synthesize traces from emulated executions, without any hardware
+        scope = abby.oscilloscope.SimulatedScope(opt.simulate)
+
+    with scope as ps:
+        for algo in tqdm(opt.algorithm):
+            # Capture only around the execution when its length is known
+            measure_cycles(opt, algo)
+            ps.set_blockcipher(algo)
+
+            def jobs():
+                """Yield acquisitions to do, reflashing firmware if needed."""
+                for input_text in input_texts(opt, algo):
                     # If file already exist, skip
                     output = dest / f"{opt.board}_{algo}_{input_text.hex()}.npy"
-                    if output.is_file():
+                    if abby.acquisition.is_saved(output):
                         continue
 
                     # Regenerate random code if necessary
                     if algo.name == "generated-code":
                         algo.seed = input_text
-                        abby.firmware.pio_run(
-                            opt.board,
-                            algo,
-                            upload=True,
-                            debug=opt.debug,
-                        )
-
-                    # Acquire trace
-                    output_len = 1 + algo.msg_length  # +1 for header
-                    _, trace, clock = ps.run_and_acquire(
-                        input_text, output_len, ser, average=opt.average
-                    )
-
-                    if not opt.no_downsample:
-                        # Get the max of each cycle
-                        cycles_indexes = abby.processing.find_cycles(clock)
-                        downsampled_trace = np.zeros(len(cycles_indexes) - 1)
-                        for i, c_index in enumerate(cycles_indexes[:-1]):
-                            c_end = cycles_indexes[i + 1]
-                            downsampled_trace[i] = np.max(trace[c_index:c_end])
-                        downsampled_trace -= np.mean(downsampled_trace)
-                        trace = downsampled_trace
+                        ps.disarm()
+                        if opt.simulate is None:
+                            abby.firmware.pio_run(
+                                opt.board,
+                                algo,
+                                upload=True,
+                                debug=opt.debug,
+                            )
+                        else:
+                            # Stop previous QEMU before starting next one
+                            ser.emulator = None
+                            fw_path = abby.firmware.pio_run(
+                                opt.board,
+                                algo,
+                                qemu=True,
+                                debug=opt.debug,
+                            )
+                            ser.emulator = abby.emulator.QEMUEmulator(
+                                fw_path, opt.board
+                            )
 
-                    if not opt.no_crop:
-                        # Crop NOP cycles from power trace
-                        trace = abby.processing.crop_cycles(trace, threshold=0.005)
+                    output_len = 1 + algo.msg_length  # +1 for header
+                    yield input_text, output_len, output
 
-                    # Save trace
-                    np.save(output, trace)
+            # Build and upload firmware, open serial port after flashing
+            with connect(opt, algo, ps) as ser:
+                # Acquire next trace while previous ones are processed and
+                # saved, rearm while processing unless firmware is reflashed
+                raw = opt.no_downsample and opt.no_crop
+                pipeline = abby.acquisition.AcquisitionPipeline(
+                    ps,
+                    ser,
+                    process=keep_clock if raw else process,
+                    save=save_with_clock if raw else abby.acquisition.save_numpy,
+                    average=opt.average,
+                    pipelined=algo.name != "generated-code",
+                )
+                pipeline.run(jobs())
+                log.info(f"Acquisition of {algo}:\n{pipeline.report()}")
 
 
 if __name__ == "__main__":
@@ -150,6 +300,44 @@ if __name__ == "__main__":
         default=False,
         help="disable cropping of NOP instructions",
     )
+    parser.add_argument(
+        "--raw",
+        action="store_true",
+        default=False,
+        help="keep ADC counts instead of volts, requires --average 1",
+    )
+    parser.add_argument(
+        "--simulate",
+        metavar="MODEL",
+        type=abby.model.get_model,
+        help="emulate target and synthesize traces with model, format "
+        "`type,path`, default to real oscilloscope",
+    )
+    parser.add_argument(
+        "--rig",
+        action="append",
+        type=rig,
+        help="acquire in parallel on several boards, format "
+        "`serial[,upload_port[,scope_sn]]`, repeat for each board",
+    )
+    parser.add_argument(
+        "--no_emulate_cycles",
+        action="store_true",
+        default=False,
+        help="do not measure unknown cycle counts by emulating ELMO firmware, "
+        "capture then the whole acquisition window",
+    )
+    parser.add_argument(
+        "--reprocess",
+        metavar="FOLDER",
+        help="downsample and crop raw acquisitions saved in folder with "
+        "--no_downsample --no_crop instead of acquiring",
+    )
+    parser.add_argument(
+        "--cache",
+        help="folder to cache processing results in when reprocessing, "
+        "default to no cache",
+    )
     parser.add_argument(
         "-i",
         "--input",
@@ -164,5 +352,22 @@ if __name__ == "__main__":
         help="destination folder for saved traces",
     )
     options = parser.parse_args()
+    if options.raw and options.average != 1:
+        parser.error("--raw keeps ADC counts only without averaging")
+    if options.cache is not None and options.reprocess is None:
+        parser.error("--cache only applies with --reprocess")
+    if options.reprocess is not None:
+        if options.no_downsample:
+            parser.error("--reprocess needs downsampling")
+        if (
+            pathlib.Path(options.reprocess).absolute()
+            == pathlib.Path(options.output).absolute()
+        ):
+            parser.error("--reprocess cannot overwrite raw acquisitions")
+    if options.rig is not None:
+        if options.simulate is not None:
+            parser.error("--rig cannot be used with --simulate")
+        if any(algo.name == "generated-code" for algo in options.algorithm):
+            parser.error("--rig cannot reflash generated code for each input")
     abby.logger.setup_logger("abby", options.quiet, options.debug)
     main(options)
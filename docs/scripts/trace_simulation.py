@@ -5,6 +5,7 @@ Emulate target to output features and estimated trace.
 """
 
 import argparse
+import functools
 import os
 import pathlib
 import secrets
@@ -15,11 +16,103 @@ from tqdm import tqdm
 import abby
 
 
+def input_texts(opt, algo):
+    """Yield input texts for selected algorithm, from file or random."""
+    for _ in range(opt.num):
+        # Input text contains all input data for selected algorithm
+        if opt.input is not None:
+            # Read input text from file
+            input_text = bytes.fromhex(opt.input.readline())
+            input_size = algo.get_input_length() + 1
+            if len(input_text) != input_size:
+                raise IndexError(
+                    f"\nInput text {input_text.hex()} does not "
+                    f"match size {input_size}"
+                )
+        else:
+            # Random input text
+            input_text = b"\xAE"  # start byte
+            input_text += secrets.token_bytes(algo.get_input_length())
+        yield input_text
+
+
+def output_path(opt, dest, algo, input_text):
+    """Get destination file of a simulated trace."""
+    suffix = "npy" if opt.only_power else "csv"
+    return dest / f"{opt.board}_{algo}_{input_text.hex()}.{suffix}"
+
+
+def dataframes(chunks):
+    """Convert execution trace records to DataFrames with emulators columns."""
+    for chunk in chunks:
+        if isinstance(chunk, np.ndarray) and chunk.dtype.names:
+            chunk = abby.emulator.trace.to_dataframe(chunk)
+        yield chunk
+
+
+def save_power(opt, chunks, output):
+    """Predict power from execution trace chunks and save it as numpy array.
+
+    Predictions are appended to a raw file, then copied to the numpy file
+    from a memory map, so that power is never whole in memory either.
+    """
+    raw = output.with_suffix(".raw")
+    count = 0
+    dtype = np.float64
+    with open(raw, "wb") as f:
+        for power in opt.model.predict_stream(chunks):
+            power = np.asarray(power)
+            f.write(power.tobytes())
+            count += len(power)
+            dtype = power.dtype
+    power = np.zeros(0, dtype=dtype)
+    if count:
+        power = np.memmap(raw, dtype=dtype, mode="r", shape=(count,))
+    np.save(output, power)
+    del power
+    os.remove(raw)
+
+
+def save(opt, chunks, output):
+    """Predict power from execution trace chunks and save them one by one.
+
+    Chunks are cropped, predicted and written as they come, so a streamed
+    execution trace is never whole in memory.
+    """
+    if not opt.no_crop:
+        chunks = abby.emulator.Emulator.crop_nop_chunks(chunks)
+    chunks = dataframes(chunks)
+    if not opt.no_crop:
+        chunks = (chunk.drop("opcode", axis=1) for chunk in chunks)
+
+    # Predict using model and save
+    if opt.only_power:
+        save_power(opt, chunks, output)
+        return
+    for i, execution_trace in enumerate(chunks):
+        power = opt.model.predict(execution_trace)
+        execution_trace = execution_trace.assign(power=power)
+        mode = "a" if i else "w"
+        execution_trace.to_csv(output, mode=mode, header=i == 0, index=False)
+
+
 def main(opt):
     # Create destination folder if missing
     dest = pathlib.Path(opt.output).absolute()
     os.makedirs(dest, exist_ok=True)
 
+    # Execution traces, cached on disk if requested
+    cache = None
+    if opt.cache is not None:
+        cache = abby.processing.ProcessingCache(opt.cache)
+
+    def emulator(fw_path):
+        """Start QEMU on firmware, reusing cached execution traces."""
+        qemu = abby.emulator.QEMUEmulator(fw_path, opt.board)
+        if cache is None:
+            return qemu
+        return abby.emulator.CachedEmulator(qemu, cache)
+
     for algo in tqdm(opt.algorithm):
         # Build firmware for simulation
         # `qemu` parameter remove RCC initialization as emulation does not
@@ -30,60 +123,41 @@ def main(opt):
             qemu=True,
             debug=opt.debug,
         )
+        output_len = 1 + algo.msg_length  # +1 for header
 
-        # Initiate QEMU
-        emulator = abby.emulator.QEMUEmulator(fw_path, opt.board)
-
-        # Repeat acquisition with different input texts
-        for _ in tqdm(range(opt.num)):
-            # Input text contains all input data for selected algorithm
-            if opt.input is not None:
-                # Read input text from file
-                input_text = bytes.fromhex(opt.input.readline())
-                input_size = algo.get_input_length() + 1
-                if len(input_text) != input_size:
-                    raise IndexError(
-                        f"\nInput text {input_text.hex()} does not "
-                        f"match size {input_size}"
-                    )
-            else:
-                # Random input text
-                input_text = b"\xAE"  # start byte
-                input_text += secrets.token_bytes(algo.get_input_length())
-
-            # If file already exist, skip
-            if opt.only_power:
-                output = dest / f"{opt.board}_{algo}_{input_text.hex()}.npy"
-            else:
-                output = dest / f"{opt.board}_{algo}_{input_text.hex()}.csv"
-            if output.is_file():
-                continue
-
-            # Regenerate random code if necessary
-            if algo.name == "generated-code":
-                algo.seed = input_text
-                fw_path = abby.firmware.pio_run(
-                    opt.board,
-                    algo,
-                    elmo=True,
-                    debug=opt.debug,
-                )
-                emulator = abby.emulator.QEMUEmulator(fw_path)
-
-            # Emulate target
-            output_len = 1 + algo.msg_length  # +1 for header
-            _, execution_trace = emulator.run(input_text, output_len)
-            if not opt.no_crop:
-                execution_trace = emulator.crop_nop(execution_trace).drop(
-                    "opcode", axis=1
-                )
+        # Skip existing files
+        inputs = [
+            input_text
+            for input_text in input_texts(opt, algo)
+            if not output_path(opt, dest, algo, input_text).is_file()
+        ]
 
-            # Predict using model and save
-            execution_trace["power"] = opt.model.predict(execution_trace)
-            if opt.only_power:
-                np.save(output, execution_trace["power"])
-            else:
-                execution_trace.to_csv(output, index=False)
+        # Same firmware for all inputs, emulate them in parallel
+        if algo.name != "generated-code":
+            factory = functools.partial(emulator, fw_path)
+            with abby.emulator.EmulatorPool(factory, opt.workers) as pool:
+                results = pool.imap(inputs, output_len, chunksize=opt.chunksize)
+                for input_text, (_, execution_trace) in zip(
+                    inputs, tqdm(results, total=len(inputs))
+                ):
+                    output = output_path(opt, dest, algo, input_text)
+                    save(opt, [execution_trace], output)
+            continue
+
+        # Regenerate random code for each input text
+        for input_text in tqdm(inputs):
+            algo.seed = input_text
+            fw_path = abby.firmware.pio_run(
+                opt.board,
+                algo,
+                qemu=True,
+                debug=opt.debug,
+            )
+            # QEMU streams long executions, cached ones are loaded whole
+            emu = emulator(fw_path)
+            chunks = emu.run_chunks(input_text, output_len)
+            save(opt, chunks, output_path(opt, dest, algo, input_text))
+            emu.close()
 
 
 if __name__ == "__main__":
@@ -134,6 +208,22 @@ if __name__ == "__main__":
         type=abby.model.get_model,
         help="model to use to estimate trace, format `type,path`",
     )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        help="amount of QEMU instances emulating in parallel, default to CPU count",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=16,
+        help="amount of inputs sent at once to each QEMU instance, default to 16",
+    )
+    parser.add_argument(
+        "--cache",
+        help="folder to cache execution traces in, default to no cache",
+    )
     parser.add_argument(
         "--no_crop",
         action="store_true",
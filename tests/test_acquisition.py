@@ -0,0 +1,100 @@
+# Copyright (C) 2020-2021 
+# SPDX-License-Identifier: Apache-2.0
+
+"""Test abby.acquisition
+"""
+
+import csv
+
+import numpy as np
+import pytest
+
+from abby.acquisition import (
+    AcquisitionPipeline,
+    Orchestrator,
+    Rig,
+    TraceStore,
+    is_saved,
+    load_numpy,
+    save_numpy,
+)
+from abby.oscilloscope import Oscilloscope
+from abby.processing import RawTrace
+
+
+class FakeOscilloscope(Oscilloscope):
+    """Oscilloscope returning a trace equal to the first input byte."""
+
+    def run_and_acquire(self, input_txt, output_len, serial, **kwargs):
+        trace = np.full(10, input_txt[0], dtype=float)
+        return b"", trace, np.zeros(10)
+
+
+def test_save_numpy(tmp_path):
+    """Test that traces are loaded as saved, raw or not."""
+    save_numpy(tmp_path / "trace.npy", np.arange(3.0))
+    assert np.all(load_numpy(tmp_path / "trace.npy") == [0, 1, 2])
+    save_numpy(tmp_path / "raw.npy", RawTrace(np.arange(3, dtype=np.int16), 0.5))
+    raw = load_numpy(tmp_path / "raw.npy")
+    assert isinstance(raw, RawTrace) and np.all(np.asarray(raw) == [0, 0.5, 1])
+    assert is_saved(tmp_path / "raw.npy") and not is_saved(tmp_path / "none.npy")
+    with TraceStore(tmp_path) as store:
+        assert "raw.npy" in store and "none.npy" not in store
+
+
+def test_pipeline():
+    """Test that every trace is processed and saved."""
+    saved = {}
+
+    def save(destination, trace):
+        saved[destination] = trace
+
+    pipeline = AcquisitionPipeline(
+        FakeOscilloscope(), None, process=lambda t, c: t * 2, save=save, queue_size=1
+    )
+    jobs = [(bytes([i]), 0, i) for i in range(20)]
+    assert pipeline.run(jobs) == 20
+    assert all(np.all(saved[i] == 2 * i) for i in range(20))
+    assert pipeline.stats["write"].count == 20
+    assert "capture" in pipeline.report()
+
+
+def test_pipeline_error():
+    """Test that processing errors stop acquisition and are raised."""
+
+    def process(trace, clock):
+        raise ValueError("processing failed")
+
+    pipeline = AcquisitionPipeline(FakeOscilloscope(), None, process=process)
+    with pytest.raises(ValueError):
+        pipeline.run((bytes([i]), 0, i) for i in range(100))
+
+
+class BrokenOscilloscope(Oscilloscope):
+    """Oscilloscope always timing out."""
+
+    def run_and_acquire(self, input_txt, output_len, serial, **kwargs):
+        raise IndexError("Timeout")
+
+
+def test_orchestrator(tmp_path):
+    """Test that jobs of a failing rig are acquired by others."""
+    rigs = [
+        Rig("good", FakeOscilloscope(), None),
+        Rig("broken", BrokenOscilloscope(), None),
+    ]
+    with TraceStore(tmp_path) as store:
+        orchestrator = Orchestrator(rigs, store, max_failures=2, max_attempts=5)
+        jobs = [(bytes([i]), 0, f"{i}.npy") for i in range(20)]
+        assert orchestrator.run(jobs) == 20
+        assert orchestrator.run(jobs) == 0  # already in store
+    assert rigs[0].count == 20 and not rigs[0].dropped
+    assert np.all(np.load(tmp_path / "7.npy") == 7)
+    with open(tmp_path / "index.csv") as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 20 and {row["rig"] for row in rows} == {"good"}
+
+    with TraceStore(tmp_path / "none") as store:
+        with pytest.raises(RuntimeError):
+            Orchestrator(rigs[1:], store).run(jobs)
+    assert rigs[1].dropped
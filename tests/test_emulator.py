@@ -4,10 +4,30 @@
 """Test abby.emulator
 """
 
+import functools
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import types
+
+import numpy as np
 import pandas as pd
 import pytest
 
-from abby.emulator import Emulator, ThumbulatorEmulator
+from abby.emulator import (
+    CachedEmulator,
+    Emulator,
+    EmulatorPool,
+    QEMUEmulator,
+    ThumbulatorEmulator,
+    ThumbulatorSession,
+    UnicornEmulator,
+    qemu,
+    trace,
+)
+from abby.firmware.blockcipher import BlockCipher
 
 
 def test_base_class():
@@ -27,3 +47,580 @@ def test_crop_nop_thumbulator():
     )
     df = ThumbulatorEmulator.crop_nop(df)
     assert len(df) == 1
+
+    records = np.zeros(5, dtype=trace.record_dtype)
+    records["opcode"] = [0, 0x46C0, 1, 2, 0x46C0]
+    cropped = ThumbulatorEmulator.crop_nop(records)
+    assert list(cropped["opcode"]) == [1, 2] and cropped.base is records
+
+
+def test_thumbulator_records(monkeypatch):
+    """Test Thumbulator execution traces read from elmotrace buffer."""
+    records = np.zeros(3, dtype=ThumbulatorEmulator.record_dtype)
+    records["instr_stage3"] = trace.encode_instructions(["NOP", "EORS", "NOP"])
+    records["power"] = [0.0, 0.5, 1.0]
+
+    def run_buffer(fw_path, model_path, input_data, output_data_length):
+        return input_data[:output_data_length], records.tobytes()
+
+    elmotrace = types.SimpleNamespace(run_buffer=run_buffer)
+    monkeypatch.setitem(sys.modules, "elmotrace", elmotrace)
+
+    output, result = ThumbulatorEmulator("fw.bin", as_dataframe=False).run(b"ab", 1)
+    assert output == b"a" and np.array_equal(result, records[1:])
+    _, df = ThumbulatorEmulator("fw.bin").run(b"ab", 1)
+    assert list(df["instr_stage3"]) == ["EORS", "NOP"]
+    assert list(df["power"]) == [0.5, 1.0]
+
+
+class FakeELMOSession:
+    """ELMO session counting firmware loads and runs."""
+
+    loads = 0
+
+    def __init__(self, fw_path, model_path):
+        FakeELMOSession.loads += 1
+        self.closed = False
+
+    def run(self, input_data, output_data_length):
+        records = np.zeros(1 + len(input_data), dtype=ThumbulatorEmulator.record_dtype)
+        records["op1_value_current"][1:] = list(input_data)
+        return input_data[:output_data_length], records.tobytes()
+
+    def close(self):
+        self.closed = True
+
+
+def test_thumbulator_session(monkeypatch):
+    """Test that Thumbulator session loads firmware once for all runs."""
+    elmotrace = types.SimpleNamespace(Session=FakeELMOSession)
+    monkeypatch.setitem(sys.modules, "elmotrace", elmotrace)
+
+    with ThumbulatorSession("fw.bin", as_dataframe=False) as session:
+        results = session.run_many([b"\x01\x02", b"\x03"], 1)
+    assert FakeELMOSession.loads == 1 and session.session.closed
+    assert [output for output, _ in results] == [b"\x01", b"\x03"]
+    assert list(results[0][1]["op1_value_current"]) == [1, 2]
+
+
+class FakeQEMUSocket:
+    """QEMU serial port echoing input one byte per receive.
+
+    Execution trace gets one row per input byte, with instructions named
+    like ``ADDS#imm``, and an end marker. When delayed, the end of each run
+    is only flushed on next input or when flushed explicitly.
+    """
+
+    def __init__(self, trace_path, events):
+        self.trace_path = trace_path
+        self.events = events
+        self.pending = b""
+        self.delayed = False
+        self.unflushed = ""
+
+    def sendall(self, data):
+        self.flush()
+        rows = "".join(f"i#{b},{b}\n" for b in data) + "#end\n"
+        split = -8 if self.delayed else len(rows)
+        with open(self.trace_path, "a") as f:
+            f.write(rows[:split])
+        self.unflushed = rows[split:]
+        self.events.append(f"send {data.hex()}")
+        self.pending += data
+
+    def flush(self):
+        with open(self.trace_path, "a") as f:
+            f.write(self.unflushed)
+        self.unflushed = ""
+
+    def recv(self, n):
+        data, self.pending = self.pending[:1], self.pending[1:]
+        return data
+
+    def close(self):
+        pass
+
+
+class FakeQEMUMonitor:
+    """QEMU monitor recording commands with serial port inputs."""
+
+    def __init__(self, events):
+        self.commands = events
+        self.pending = b"(qemu) "
+
+    def sendall(self, data):
+        self.commands.append(data.decode().strip())
+        self.pending = b"(qemu) "
+
+    def recv(self, n):
+        data, self.pending = self.pending, b""
+        return data
+
+    def close(self):
+        pass
+
+
+class FakeQEMUProcess:
+    """QEMU process whose plugin only wrote the CSV header."""
+
+    def __init__(self, cmd, **kwargs):
+        self.cmd = cmd
+        plugin_args = cmd[cmd.index("-plugin") + 1].split(",arg=")
+        self.trace_path = plugin_args[1]
+        with open(self.trace_path, "w") as f:
+            if plugin_args[-1] != "binary":
+                f.write("instruction,opcode\n")
+        events = []
+        self.socket = FakeQEMUSocket(self.trace_path, events)
+        self.monitor = FakeQEMUMonitor(events)
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        self.returncode = -15
+
+
+class FakeUnixSocket:
+    """Unix socket connecting to QEMU serial port or monitor by path."""
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.peer = None
+
+    def settimeout(self, timeout):
+        pass
+
+    def connect(self, path):
+        serial = self.proc.cmd[self.proc.cmd.index("-serial") + 1]
+        if serial.startswith(f"unix:{path},"):
+            self.peer = self.proc.socket
+        else:
+            self.peer = self.proc.monitor
+
+    def __getattr__(self, name):
+        return getattr(self.peer, name)
+
+
+def start_qemu(monkeypatch, tmp_path, **kwargs):
+    """Start QEMUEmulator on a fake QEMU process."""
+    processes = []
+
+    def popen(cmd, **kwargs):
+        processes.append(FakeQEMUProcess(cmd))
+        return processes[-1]
+
+    monkeypatch.setattr(subprocess, "Popen", popen)
+    monkeypatch.setattr(subprocess, "run", lambda cmd, **kwargs: None)
+    monkeypatch.setattr(
+        socket, "create_connection", lambda address, timeout: processes[-1].socket
+    )
+    monkeypatch.setattr(socket, "socket", lambda *args: FakeUnixSocket(processes[-1]))
+    monkeypatch.setattr(tempfile, "mkdtemp", lambda: str(tmp_path))
+    return QEMUEmulator("firmware.elf", "microbit", **kwargs)
+
+
+def test_qemu_run_many(monkeypatch, tmp_path):
+    """Test that QEMU runs parse only their own trace segment."""
+    emu = start_qemu(monkeypatch, tmp_path)
+    assert emu.proc.cmd[emu.proc.cmd.index("-kernel") + 1] == "firmware.elf"
+    assert emu.proc.cmd[emu.proc.cmd.index("-serial") + 1].startswith("unix:")
+
+    results = emu.run_many([b"\x01\x02", b"\x03\x04\x05"], 2)
+    assert [output for output, _ in results] == [b"\x01\x02", b"\x03\x04"]
+    assert list(results[1][1]["opcode"]) == [3, 4, 5]
+
+    # Remaining output byte is received by next run
+    output, df = emu.run(b"\x06", 2)
+    assert output == b"\x05\x06" and list(df["instruction"]) == ["i#6"]
+
+    # Rows flushed after output is received stay in their run
+    emu.proc.socket.delayed = True
+    monkeypatch.setattr(qemu, "sleep", lambda delay: emu.proc.socket.flush())
+    results = emu.run_many([b"\x07", b"\x08"], 1)
+    assert [output for output, _ in results] == [b"\x07", b"\x08"]
+    assert [list(df["opcode"]) for _, df in results] == [[7], [8]]
+
+    # Streamed execution trace is parsed in chunks
+    stream = emu.run_chunks(b"\x09\x0a\x0b", 3, chunk_size=2)
+    chunks, output = collect_chunks(stream)
+    assert output == b"\x09\x0a\x0b" and [len(chunk) for chunk in chunks] == [2, 1]
+    assert list(chunks[1]["opcode"]) == [11]
+
+    # Rows of a stream closed early are not parsed with next run
+    stream = emu.run_chunks(b"\x0c\x0d\x0e", 3, chunk_size=1)
+    assert list(next(stream)["opcode"]) == [12]
+    stream.close()
+    assert list(emu.run(b"\x0f", 1)[1]["opcode"]) == [15]
+    emu.close()
+    assert emu.proc.poll() is not None
+
+
+def test_qemu_snapshot(monkeypatch, tmp_path):
+    """Test that QEMU snapshot is taken after a warm-up run, then restored."""
+    emu = start_qemu(monkeypatch, tmp_path, snapshot=True, port=1234)
+    assert "tcp:127.0.0.1:1234,server=on,wait=off" in emu.proc.cmd
+    assert emu._qemu_img() == os.path.join(os.path.dirname(emu.qemu_path), "qemu-img")
+    assert emu.monitor.commands == []
+
+    results = emu.run_many([b"\x01", b"\x02", b"\x03"], 1)
+    assert emu.monitor.commands == [
+        "send 01",
+        "savevm abby",
+        "loadvm abby",
+        "send 01",
+        "loadvm abby",
+        "send 02",
+        "loadvm abby",
+        "send 03",
+    ]
+    assert [output for output, _ in results] == [b"\x01", b"\x02", b"\x03"]
+    assert [list(df["opcode"]) for _, df in results] == [[1], [2], [3]]
+
+
+# Instructions of ELMO power model
+ELMO_INSTRUCTIONS = (
+    "ADC ADD ADD#imm ADDS ADDS#imm ANDS ASRS BICS BL BX CMNS CMP#imm CMPS CPY EORS "
+    "LDR LDRB LDRH LSLS LSLS#imm LSRS LSRS#imm MOV MOVS#imm MULS MVNS NEGS ORRS POP "
+    "PUSH REV REV16 REVSH RORS SBC STR STRB STRH SUBS SUBS#imm SXTB SXTH TST UXTB UXTH"
+).split()
+
+
+def test_binary_trace(monkeypatch, tmp_path):
+    """Test binary execution trace conversions and QEMU segments."""
+    df = pd.DataFrame(
+        {
+            "instr_stage3": ["LDR", "MULS", None],
+            "opcode": [0x46C0, 1, 2],
+            "op1_value_current": [0xFFFFFFFF, 0, 1],
+        }
+    )
+    records = trace.from_dataframe(df)
+    assert records.dtype.itemsize == 40
+    assert list(records["instr_stage3"]) == [18, 27, 0]
+    result = trace.to_dataframe(records)
+    assert list(result["instr_stage3"]) == ["LDR", "MULS", ""]
+    assert result["op1_value_current"][0] == 0xFFFFFFFF
+    assert np.shares_memory(result["opcode"].to_numpy(), records)
+    with pytest.raises(ValueError):
+        trace.encode_instructions(["LDR", "unknown"])
+
+    # Every ELMO instruction has its own code
+    codes = trace.encode_instructions(ELMO_INSTRUCTIONS)
+    assert 0 not in codes and len(set(codes)) == len(ELMO_INSTRUCTIONS)
+    assert list(trace.decode_instructions(codes)) == ELMO_INSTRUCTIONS
+
+    # QEMU maps records of each run up to its end record
+    emu = start_qemu(monkeypatch, tmp_path, binary=True)
+    end = np.zeros(1, dtype=trace.record_dtype)
+    end["instr_stage3"] = trace.end_code
+    path = tmp_path / "execution.bin"
+    path.write_bytes(b"".join(r.tobytes() for r in [records[:1], end, records[1:]]))
+    monkeypatch.setattr(
+        qemu, "sleep", lambda delay: path.write_bytes(path.read_bytes() + end.tobytes())
+    )
+    first, second = emu._read_segments(2)
+    assert len(first) == 1 and np.array_equal(second, records[1:])
+    assert np.array_equal(trace.load(path, offset=80, count=1), records[1:2])
+
+
+class EchoEmulator(Emulator):
+    """Emulator echoing input, failing on its first run if unstable."""
+
+    def __init__(self, unstable=False):
+        self.unstable = unstable
+
+    def run(self, input_data, output_data_length):
+        if self.unstable:
+            raise ConnectionError("crashed")
+        return input_data[:output_data_length], list(input_data)
+
+
+def test_emulator_pool():
+    """Test that pool results are ordered and crashed emulators restarted."""
+    emulators = iter([EchoEmulator(unstable=True)])
+
+    def factory():
+        return next(emulators, EchoEmulator())
+
+    inputs = [bytes([i, i]) for i in range(50)]
+    with EmulatorPool(factory, workers=3) as pool:
+        results = pool.run_many(inputs, 1, chunksize=4)
+    assert [output for output, _ in results] == [bytes([i]) for i in range(50)]
+    assert results[7][1] == [7, 7]
+    assert pool.restarts == 1
+
+    unstable = functools.partial(EchoEmulator, unstable=True)
+    with EmulatorPool(unstable, workers=2, max_restarts=1) as pool:
+        with pytest.raises(ConnectionError):
+            pool.run_many(inputs, 1)
+
+    # Emulators failing every restart are not reused, nor is a failed start
+    emulators = iter([EchoEmulator(unstable=True), None, EchoEmulator()])
+
+    def factory():
+        emulator = next(emulators)
+        if emulator is None:
+            raise ConnectionError("cannot start")
+        return emulator
+
+    with EmulatorPool(factory, workers=1, max_restarts=1) as pool:
+        with pytest.raises(ConnectionError):
+            pool.run_many([b"\x01"], 1)
+        assert pool.run_many([b"\x02"], 1) == [(b"\x02", [2])]
+
+    # Emulators started before a failing one are closed
+    started = []
+    closed = []
+
+    def factory():
+        if len(started) == 2:
+            raise ConnectionError("cannot start")
+        started.append(EchoEmulator())
+        started[-1].close = functools.partial(closed.append, started[-1])
+        return started[-1]
+
+    with pytest.raises(ConnectionError):
+        EmulatorPool(factory, workers=3)
+    assert len(started) == 2 and closed == started
+
+
+# ELMO style firmware: read input, add 1 and xor 1 between triggers, output
+ELMO_PROGRAM = [
+    0x24E1,  # movs r4, #0xE1
+    0x0624,  # lsls r4, r4, #24
+    0x3404,  # adds r4, #4
+    0x6820,  # ldr r0, [r4]
+    0x25E0,  # movs r5, #0xE0
+    0x062D,  # lsls r5, r5, #24
+    0x2101,  # movs r1, #1
+    0x6069,  # str r1, [r5, #4]
+    0x3001,  # adds r0, #1
+    0x4048,  # eors r0, r1
+    0x2100,  # movs r1, #0
+    0x6069,  # str r1, [r5, #4]
+    0x6028,  # str r0, [r5]
+    0x26F0,  # movs r6, #0xF0
+    0x0636,  # lsls r6, r6, #24
+    0x6031,  # str r1, [r6]
+    0xE7FE,  # b .
+]
+
+
+def test_unicorn(monkeypatch, tmp_path):
+    """Test Unicorn emulator records instructions between triggers."""
+    pytest.importorskip("unicorn")
+    fw_path = tmp_path / "firmware.bin"
+    vectors = np.array([0x20001000, 0x9], dtype="<u4").tobytes()
+    fw_path.write_bytes(vectors + np.array(ELMO_PROGRAM, dtype="<u2").tobytes())
+
+    emu = UnicornEmulator(fw_path)
+    for value in [0x41, 0x10]:
+        output, records = emu.run(bytes([value]), 1)
+        assert output == bytes([(value + 1) ^ 1])
+        df = trace.to_dataframe(records)
+        assert list(df["instr_stage3"]) == ["ADDS#imm", "EORS", "MOVS#imm", "STR"]
+        assert list(df["instr_stage2"][:3]) == ["EORS", "MOVS#imm", "STR"]
+        assert list(df["op1_value_current"][:2]) == [value, value + 1]
+        assert df["op2_value_previous"][1] == 1
+        assert (df["readbus_value_current"] == value).all()
+        assert list(df["writebus_value_current"]) == [1, 1, 1, 0]
+        assert trace.cycle_count(records) == trace.cycle_count(df) == 5
+
+    # Pad computation with NOP instructions, then crop them while recording.
+    # A lone NOP instruction is part of the code.
+    nops = [0x46C0] * 3
+    padded = ELMO_PROGRAM[:8] + nops + ELMO_PROGRAM[8:9] + [0x46C0]
+    padded += ELMO_PROGRAM[9:10] + nops + ELMO_PROGRAM[10:]
+    fw_path.write_bytes(vectors + np.array(padded, "<u2").tobytes())
+    emu = UnicornEmulator(fw_path, crop_nop=True, padding=3)
+    output, records = emu.run(b"\x41", 1)
+    assert output == b"\x43"
+    instructions = trace.decode_instructions(records["instr_stage3"])
+    assert list(instructions) == ["ADDS#imm", "NOP", "EORS"]
+    chunks, _ = collect_chunks(emu.run_chunks(b"\x41", 1, chunk_size=1))
+    assert np.array_equal(np.concatenate(chunks), records)
+
+    # Cycle count of a block cipher is measured on cropped executions, the
+    # same with Unicorn records and QEMU CSV rows of the same executions
+    cipher = BlockCipher()
+    emu = UnicornEmulator(fw_path)
+    assert cipher.measure_cycle_count(emu, padding=3) == 3
+    assert cipher.get_cycle_count() == 3
+
+    qemu_emu = start_qemu(monkeypatch, tmp_path)
+    with open(qemu_emu.trace_path, "w") as f:
+        f.write(",".join(trace.record_dtype.names) + "\n")
+
+    def sendall(data):
+        output, records = emu.run(data, 1)
+        trace.to_dataframe(records).to_csv(
+            qemu_emu.trace_path, mode="a", header=False, index=False
+        )
+        with open(qemu_emu.trace_path, "a") as f:
+            f.write("#end\n")
+        qemu_emu.proc.socket.pending += output
+
+    monkeypatch.setattr(qemu_emu.proc.socket, "sendall", sendall)
+    assert BlockCipher().measure_cycle_count(qemu_emu, padding=3) == 3
+
+
+def test_run_many_workers(tmp_path):
+    """Test that worker processes return results in input order."""
+    pytest.importorskip("unicorn")
+    fw_path = tmp_path / "firmware.bin"
+    vectors = np.array([0x20001000, 0x9], dtype="<u4").tobytes()
+    fw_path.write_bytes(vectors + np.array(ELMO_PROGRAM, dtype="<u2").tobytes())
+
+    emu = UnicornEmulator(fw_path)
+    inputs = [bytes([i]) for i in range(10)]
+    results = emu.run_many(inputs, 1, workers=2, chunksize=3)
+    expected = [bytes([(i + 1) ^ 1]) for i in range(10)]
+    assert [output for output, _ in results] == expected
+    assert np.array_equal(results[4][1], emu.run(inputs[4], 1)[1])
+
+
+class ClosingEmulator(EchoEmulator):
+    """Emulator writing a file named after its process when closed."""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def close(self):
+        (self.path / str(os.getpid())).touch()
+
+
+def test_run_many_close(tmp_path):
+    """Test that emulators of worker processes are closed on exit."""
+    emu = Emulator()
+    factory = functools.partial(ClosingEmulator, tmp_path)
+    results = emu.run_many([b"\x01"] * 4, 1, workers=2, factory=factory)
+    assert [output for output, _ in results] == [b"\x01"] * 4
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def collect_chunks(stream):
+    """Get chunks and output data of an execution trace stream."""
+    chunks = []
+    while True:
+        try:
+            chunks.append(next(stream))
+        except StopIteration as e:
+            return chunks, e.value
+
+
+def test_run_chunks(tmp_path):
+    """Test that streamed chunks make the whole execution trace."""
+    fw_path = tmp_path / "firmware.bin"
+    fw_path.write_bytes(b"firmware")
+    stream = CountingEmulator(fw_path).run_chunks(b"abcde", 2, chunk_size=2)
+    chunks, output = collect_chunks(stream)
+    assert output == b"ab" and [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert list(chunks[2]["opcode"]) == [ord("e")]
+
+    pytest.importorskip("unicorn")
+    vectors = np.array([0x20001000, 0x9], dtype="<u4").tobytes()
+    fw_path.write_bytes(vectors + np.array(ELMO_PROGRAM, dtype="<u2").tobytes())
+    emu = UnicornEmulator(fw_path)
+    chunks, output = collect_chunks(emu.run_chunks(b"\x41", 1, chunk_size=1))
+    assert output == b"\x43" and len(chunks) > 1
+    assert np.array_equal(np.concatenate(chunks), emu.run(b"\x41", 1)[1])
+
+
+def test_crop_nop_chunks():
+    """Test that NOP paddings are cropped from streamed chunks."""
+    nop = 0x46C0
+    opcodes = [1, nop, 2] + [nop] * 4 + [3, nop, nop, 4] + [nop] * 4 + [5]
+    df = pd.DataFrame({"opcode": opcodes})
+    for chunk_size in [1, 3, 100]:
+        chunks = [df.iloc[i : i + chunk_size] for i in range(0, len(df), chunk_size)]
+        cropped = list(Emulator.crop_nop_chunks(chunks, padding=3))
+        assert list(pd.concat(cropped)["opcode"]) == [3, nop, nop, 4]
+
+    records = np.zeros(len(opcodes), dtype=trace.record_dtype)
+    records["opcode"] = opcodes
+    cropped = list(Emulator.crop_nop_chunks([records[:9], records[9:]], padding=3))
+    assert list(np.concatenate(cropped)["opcode"]) == [3, nop, nop, 4]
+
+
+class CountingEmulator(Emulator):
+    """Emulator counting runs, with execution trace as a DataFrame."""
+
+    def __init__(self, fw_path, crop_nop=False):
+        self.fw_path = fw_path
+        self.crop_nop = crop_nop
+        self.runs = 0
+
+    def _factory(self):
+        return functools.partial(type(self), self.fw_path, crop_nop=self.crop_nop)
+
+    def run(self, input_data, output_data_length):
+        self.runs += 1
+        df = pd.DataFrame({"instruction": ["EORS"] * len(input_data)})
+        df["opcode"] = list(input_data)
+        return input_data[:output_data_length], df
+
+
+def test_cached_emulator(tmp_path):
+    """Test that cached emulator only runs inputs once for each firmware."""
+    fw_path = tmp_path / "firmware.bin"
+    fw_path.write_bytes(b"firmware")
+    emulator = CountingEmulator(fw_path)
+    cached = CachedEmulator(emulator, tmp_path / "cache")
+
+    first = cached.run_many([b"\x01\x02", b"\x03"], 1)
+    second = cached.run_many([b"\x03", b"\x01\x02", b"\x04"], 1)
+    assert emulator.runs == 3 and cached.cache.hits == 2
+    output, df = second[1]
+    assert output == first[0][0] == b"\x01"
+    pd.testing.assert_frame_equal(df, first[0][1])
+
+    # Another firmware does not share traces
+    fw_path.write_bytes(b"other firmware")
+    CachedEmulator(emulator, cached.cache).run(b"\x03", 1)
+    assert emulator.runs == 4
+
+    # Nor does another emulator configuration
+    emulator.crop_nop = True
+    CachedEmulator(emulator, cached.cache).run(b"\x03", 1)
+    assert emulator.runs == 5
+
+
+def test_unicorn_instructions():
+    """Test that every Cortex-M0 instruction decoded by Capstone has a code."""
+    capstone = pytest.importorskip("capstone")
+    from capstone.arm import ARM_OP_IMM
+
+    from abby.emulator.unicorn import _instruction_name
+
+    cs = capstone.Cs(
+        capstone.CS_ARCH_ARM, capstone.CS_MODE_THUMB | capstone.CS_MODE_MCLASS
+    )
+    cs.detail = True
+
+    # All 16-bit encodings, then 32-bit BL and system instructions
+    prefixes = (0b11101, 0b11110, 0b11111)  # first halfword of 32-bit encodings
+    halfwords = [h for h in range(0x10000) if h >> 11 not in prefixes]
+    code = np.array(halfwords, dtype="<u2").tobytes()
+    code += np.array([0xF000, 0xF800, 0xF3BF, 0x8F4F, 0xF3BF, 0x8F5F], "<u2").tobytes()
+    code += np.array([0xF3BF, 0x8F6F, 0xF3EF, 0x8008, 0xF388, 0x8808], "<u2").tobytes()
+
+    # Armv7-M instructions not implemented by Cortex-M0
+    armv7m = ("cbz", "cbnz", "it", "hint", "trap", "blxns", "bxns")
+    names = set()
+    offset = 0
+    while offset < len(code):
+        insn = next(cs.disasm(code[offset:], offset, 1), None)
+        if insn is None:
+            offset += 2
+            continue
+        offset += insn.size
+        if insn.mnemonic.startswith(armv7m):
+            continue
+        immediate = bool(insn.operands) and insn.operands[-1].type == ARM_OP_IMM
+        names.add(_instruction_name(insn.mnemonic, immediate))
+    codes = trace.encode_instructions(sorted(names))
+    assert 0 not in codes
+    assert {"ADDS#imm", "CMP#imm", "MOVS#imm", "SUBS#imm", "TST", "RORS"} <= names
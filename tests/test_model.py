@@ -8,6 +8,7 @@ import numpy as np
 import pandas as pd
 import pytest
 
+from abby.emulator import trace
 from abby.model import CatBoostModel, ELMOModel, HammingWeightModel, Model
 
 test_dataset = {
@@ -53,6 +54,22 @@ def test_encode_categorical_features():
     assert np.all(r["instruction_ADD"] == [0, 0, 1])
 
 
+class SumModel(Model):
+    """Model summing operands."""
+
+    def predict(self, features):
+        return np.asarray(features["op1_value_current"] + features["op2_value_current"])
+
+
+def test_predict_stream():
+    """Test prediction of execution trace chunks, records or DataFrames."""
+    records = np.zeros(3, dtype=trace.record_dtype)
+    records["op1_value_current"] = [1, 2, 3]
+    chunks = [records[:2], trace.to_dataframe(records[2:])]
+    predictions = list(SumModel("no_path").predict_stream(iter(chunks)))
+    assert [list(p) for p in predictions] == [[1, 2], [3]]
+
+
 @pytest.mark.parametrize("modelCls", [CatBoostModel])
 def test_fitting_model(modelCls):
     """Test model fitting.
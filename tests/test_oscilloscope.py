@@ -0,0 +1,306 @@
+# Copyright (C) 2020-2021 
+# SPDX-License-Identifier: Apache-2.0
+
+"""Test abby.oscilloscope
+"""
+
+import itertools
+import sys
+import threading
+import types
+
+import numpy as np
+import pytest
+
+from abby.firmware.blockcipher import GeneratedCode, TinyAES
+from abby.oscilloscope import (
+    Chipwhisperer,
+    LoopbackSerial,
+    Oscilloscope,
+    PS3000a,
+    RingBuffer,
+    SimulatedScope,
+    frame_checksum,
+    trigger_window,
+)
+from abby.processing import downsample_cycles, find_cycles
+
+
+class FakeSerial:
+    """Serial device returning preloaded bytes, at most 3 per read."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, n):
+        data, self.data = self.data[: min(n, 3)], self.data[min(n, 3) :]
+        return data
+
+    def write(self, data):
+        pass
+
+
+def test_receive():
+    """Test that serial reception concatenates partial reads."""
+    osc = Oscilloscope()
+    assert osc._receive(FakeSerial(b"abcdefgh"), 7) == b"abcdefg"
+    with pytest.raises(IndexError):
+        osc.receive_timeout = 0
+        osc._receive(FakeSerial(b"abcd"), 7)
+
+
+def test_receive_framed():
+    """Test that framed reception checks length and checksum."""
+    osc = Oscilloscope()
+    osc.framed = True
+    payload = b"\xae\x01\x02"
+    frame = len(payload).to_bytes(2, "little") + payload
+    data = frame + bytes([frame_checksum(payload)])
+    assert osc._receive(FakeSerial(data), 3) == payload
+    with pytest.raises(ValueError):
+        osc._receive(FakeSerial(frame + b"\x00"), 3)
+
+
+class FakeOscilloscope(Oscilloscope):
+    """Oscilloscope returning a constant trace with a little noise."""
+
+    def __init__(self, noise):
+        super().__init__()
+        self.noise = noise
+        self.rng = np.random.default_rng(0)
+
+    def arm(self):
+        pass
+
+    def get_trace(self):
+        trace = 1 + self.rng.normal(scale=self.noise, size=100)
+        return trace, np.zeros(100)
+
+
+def test_run_and_acquire_adaptive():
+    """Test that averaging stops early once precise enough."""
+    osc = FakeOscilloscope(noise=0.01)
+    _, trace, clock = osc.run_and_acquire(
+        b"", 0, FakeSerial(b""), average=50, target_stderr=0.01
+    )
+    assert osc.averaged < 50
+    assert np.allclose(trace, 1, atol=0.05)
+    assert len(clock) == 100
+
+    osc.noise = 1.0
+    osc.run_and_acquire(b"", 0, FakeSerial(b""), average=50, target_stderr=0.01)
+    assert osc.averaged == 50
+
+
+def test_trigger_window():
+    """Test acquisition window derived from block cipher cycle count."""
+    # 31.25 samples per cycle at 8 MHz and 4 ns
+    assert trigger_window(1000, margin=0) == (250, 62500)
+
+    windows = []
+    osc = Oscilloscope()
+    osc.set_trigger_window = lambda cycles, freq, margin: windows.append(cycles)
+    osc.set_blockcipher(GeneratedCode())
+    tiny_aes = TinyAES()
+    osc.set_blockcipher(tiny_aes)  # unknown cycle count
+    tiny_aes.cycle_count = 1234  # as measured by emulation
+    osc.set_blockcipher(tiny_aes)
+    assert windows == [2 * GeneratedCode.count, 1234]
+
+
+class FakeEmulator:
+    """Emulator echoing input and returning it as execution trace."""
+
+    def run(self, input_data, output_data_length):
+        return input_data[:output_data_length], list(input_data)
+
+
+class FakeModel:
+    """Model predicting power as the byte value."""
+
+    def predict(self, features):
+        return np.array(features) / 255
+
+
+def test_simulated_scope():
+    """Test trace synthesis from emulator execution."""
+    serial = LoopbackSerial(FakeEmulator(), output_len=4)
+    scope = SimulatedScope(FakeModel(), noise=0, jitter=0, seed=0)
+    scope.attach(serial)
+    input_txt = bytes(range(0, 250, 5))
+    output_txt, trace, clock = scope.run_and_acquire(input_txt, 4, serial)
+    assert output_txt == input_txt[:4]
+    assert len(trace) == len(clock) == 1563  # 50 cycles of 31.25 samples
+
+    cycles = find_cycles(clock)
+    power = downsample_cycles(trace, cycles)
+    assert len(power) >= 48
+    assert np.allclose(power, np.array(list(input_txt[: len(power)])) / 255)
+
+    scope.arm()
+    with pytest.raises(TimeoutError):
+        scope.get_trace()
+
+
+def test_run_and_reduce():
+    """Test streamed reduction of a simulated acquisition."""
+    serial = LoopbackSerial(FakeEmulator(), output_len=4)
+    scope = SimulatedScope(FakeModel(), noise=0, jitter=0, seed=0)
+    scope.attach(serial)
+    input_txt = bytes(range(0, 250, 5))
+    output_txt, power = scope.run_and_reduce(input_txt, 4, serial, chunk_size=100)
+    assert output_txt == input_txt[:4]
+    assert len(power) >= 48
+    assert np.allclose(power, np.array(list(input_txt[: len(power)])) / 255)
+
+    scope.ready_timeout = 0
+    with pytest.raises(TimeoutError):
+        scope.run_and_reduce(b"", 0, FakeSerial(b""))
+
+
+def test_ring_buffer_stop():
+    """Test that the producer of an abandoned ring buffer returns."""
+    ring = RingBuffer(2, 4)
+    chunks = ((np.zeros(4), np.zeros(4)) for _ in itertools.count())
+    producer = threading.Thread(target=ring.fill, args=(chunks,))
+    producer.start()
+    next(iter(ring))
+    ring.stop()
+    producer.join(timeout=1)
+    assert not producer.is_alive()
+
+
+class FakeChipwhispererScope:
+    """Chipwhisperer scope returning increasing traces."""
+
+    class adc:
+        presamples = 2
+
+    class clock:
+        adc_freq = 29.538e6
+        clkgen_freq = 7.3845e6
+
+    def __init__(self, type=None, sn=None):
+        self.count = 0
+
+    def default_setup(self):
+        pass
+
+    def dis(self):
+        pass
+
+    def arm(self):
+        self.count += 1
+
+    def capture(self):
+        return False
+
+    def get_last_trace(self, as_int=False):
+        return np.arange(10.0) + self.count
+
+
+class FakeCWNanoScope(FakeChipwhispererScope):
+    """CW-Nano scope without pre-trigger samples nor ADC clock settings."""
+
+    class adc:
+        clk_freq = 7.5e6
+        samples = 5000
+
+    class clock:
+        clkgen_freq = 7.5e6
+
+
+def test_chipwhisperer_nano(monkeypatch):
+    """Test trigger window on CW-Nano."""
+    module = types.ModuleType("chipwhisperer")
+    module.scope = FakeCWNanoScope
+    monkeypatch.setitem(sys.modules, "chipwhisperer", module)
+    osc = Chipwhisperer()
+    assert osc.samples_per_cycle == 1
+    osc.set_trigger_window(1000, freq=7.5e6, margin=0)
+    assert osc.scope.adc.samples == 2000  # one sample per cycle
+    trace, _ = osc.get_trace()
+    assert len(trace) == 10
+
+
+def test_chipwhisperer_batch(monkeypatch):
+    """Test that batches are captured into a reused buffer."""
+    module = types.ModuleType("chipwhisperer")
+    module.scope = FakeChipwhispererScope
+    monkeypatch.setitem(sys.modules, "chipwhisperer", module)
+    osc = Chipwhisperer()
+    assert osc.samples_per_cycle == pytest.approx(4)
+
+    trace, clock = osc.get_trace()
+    assert clock is None and len(trace) == 8
+
+    serial = FakeSerial(b"xyz")
+    outputs, traces, clock = osc.run_and_acquire_batch([b"ab"] * 3, 1, serial)
+    assert outputs == [b"x", b"y", b"z"] and clock is None
+    assert np.all(traces[:, 0] == [3, 4, 5])
+    buffer = osc._batch
+    _, traces, _ = osc.run_and_acquire_batch([b""] * 2, 0, FakeSerial(b""))
+    assert osc._batch is buffer and traces.shape == (2, 8)
+    outputs, traces, _ = osc.run_and_acquire_batch([], 1, FakeSerial(b""))
+    assert outputs == [] and traces.shape == (0, 0)
+
+    # Traces shorter than the first one do not fit in the batch buffer
+    lengths = iter([10, 9])
+    osc.scope.get_last_trace = lambda as_int: np.zeros(next(lengths))
+    with pytest.raises(ValueError):
+        osc.run_and_acquire_batch([b""] * 2, 0, FakeSerial(b""))
+
+
+class FakePS3000aDriver:
+    """Picoscope driver capturing 100 zero samples and recording arming."""
+
+    def __init__(self, serialNumber=None):
+        self.calls = []
+
+    def setChannel(self, **kwargs):
+        pass
+
+    def setSimpleTrigger(self, *args, **kwargs):
+        pass
+
+    def memorySegments(self, segments):
+        pass
+
+    def setNoOfCaptures(self, segments):
+        pass
+
+    def setSamplingInterval(self, sample_interval, duration):
+        return sample_interval, 100, 1000
+
+    def runBlock(self, pretrig=0.0):
+        self.calls.append("run")
+
+    def stop(self):
+        self.calls.append("stop")
+
+    def isReady(self):
+        return True
+
+    def getDataV(self, channel, numSamples, startIndex=0):
+        return np.zeros(numSamples)
+
+
+def test_ps3000a_disarm(monkeypatch):
+    """Test that reconfiguring stops the capture armed by pipelining."""
+    module = types.ModuleType("picoscope.ps3000a")
+    module.PS3000a = FakePS3000aDriver
+    monkeypatch.setitem(sys.modules, "picoscope", types.ModuleType("picoscope"))
+    monkeypatch.setitem(sys.modules, "picoscope.ps3000a", module)
+    osc = PS3000a()
+    serial = FakeSerial(b"")
+
+    osc.run_and_acquire(b"", 0, serial, pipelined=True)
+    assert osc.ps.calls == ["run", "run"]
+    osc.set_segments(4)
+    assert osc.ps.calls == ["run", "run", "stop"]
+
+    # Next acquisition arms again with new settings
+    osc.run_and_acquire(b"", 0, serial)
+    assert osc.ps.calls == ["run", "run", "stop", "run"]
+    osc.set_segments(1)
+    assert osc.ps.calls[-1] == "run"
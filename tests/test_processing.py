@@ -5,8 +5,23 @@
 """
 
 import numpy as np
+from scipy import signal
 
-from abby.processing import crop_cycles, find_clock_freq_phase
+from abby.processing import (
+    CycleReducer,
+    FilterBank,
+    ProcessingCache,
+    RawTrace,
+    RunningAverage,
+    StreamingResampler,
+    butter_sos,
+    crop_cycles,
+    downsample_cycles,
+    find_clock_freq_phase,
+    find_cycles,
+    regular_cycles,
+    resampling_factors,
+)
 
 
 def test_crop_cycles():
@@ -34,3 +49,146 @@ def test_find_clock_freq_phase():
     )
     assert round(found_freq) == freq
     assert round(found_angle) == -90
+
+
+def test_filter_bank():
+    """Test that threaded filter bank matches SciPy and reuses coefficients."""
+    rng = np.random.default_rng(0)
+    traces = rng.normal(size=(10, 1000))
+    bank = FilterBank(sample_rate=250e6, chunk_size=3, workers=2)
+    bank.add_lowpass("lp", 20e6)
+    bank.add_notch("notch", 50e6)
+    bank.add_clock_harmonics(8e6, harmonics=2)
+    assert bank.names == ["lp", "notch", "clock_1", "clock_2"]
+    assert bank.filters["lp"] is butter_sos(2, 20e6, "lowpass", 250e6)
+
+    filtered = bank.apply(traces, "lp")
+    expected = signal.sosfiltfilt(bank.filters["lp"], traces, axis=1)
+    assert np.allclose(filtered, expected)
+
+
+def test_streaming_resampler():
+    """Test that chunked resampling matches resampling whole traces."""
+    assert resampling_factors(4e-9, 8e6, 1) == (4, 125)
+
+    rng = np.random.default_rng(0)
+    traces = rng.normal(size=(3, 1000))
+    up, down = 3, 7
+    resampler = StreamingResampler(up, down)
+    chunks = [resampler.push(traces[:, i : i + 97]) for i in range(0, 1000, 97)]
+    chunks.append(resampler.flush())
+    result = np.concatenate(chunks, axis=1)
+    expected = signal.resample_poly(traces, up, down, axis=1)
+    assert result.shape == expected.shape
+    assert np.allclose(result, expected)
+
+
+def test_downsample_cycles():
+    """Test that downsampling keeps the maximum of each cycle."""
+    trace = [0, 3, 1, 2, 5, 4, 9]
+    result = downsample_cycles(trace, [0, 2, 4, 6])
+    assert np.all(result == [3, 2, 5])
+
+    # Without clock, cycles of 2.5 samples starting at 1
+    assert np.all(regular_cycles(10, 2.5, offset=1) == [1, 4, 6, 8])
+    assert np.all(downsample_cycles(trace, regular_cycles(7, 2)) == [3, 2, 5])
+
+
+def test_cycle_reducer():
+    """Test that chunked reduction matches reduction of whole trace."""
+    rng = np.random.default_rng(0)
+    t = np.arange(10000)
+    clock = np.sin(2 * np.pi * t / 31.25) + 0.05 * rng.standard_normal(len(t))
+    trace = rng.standard_normal(len(t))
+    expected = downsample_cycles(trace, find_cycles(clock))
+
+    for chunk_size in [1, 100, 4096]:
+        reducer = CycleReducer()
+        result = np.concatenate(
+            [
+                reducer.push(trace[i : i + chunk_size], clock[i : i + chunk_size])
+                for i in range(0, len(t), chunk_size)
+            ]
+        )
+        assert np.array_equal(result, expected)
+        assert reducer.cycles == len(expected)
+
+
+def test_processing_cache(tmp_path):
+    """Test cache hits, misses and LRU eviction."""
+    cache = ProcessingCache(tmp_path, max_size=10**6)
+    trace = np.arange(100, dtype=float)
+    cycles = np.arange(0, 100, 10)
+    first = cache(downsample_cycles, trace, cycles)
+    second = cache(downsample_cycles, trace, cycles)
+    assert np.all(first == second)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Keyword arguments and defaults do not change key
+    padded = np.concatenate([np.zeros(500), np.ones(10), np.zeros(500)])
+    cache(downsample_cycles, trace, cycles_indexes=cycles)
+    cache(crop_cycles, padded, 0.5)
+    cache(crop_cycles, padded, threshold=0.5, samples_per_cycle=1)
+    assert (cache.hits, cache.misses) == (3, 2)
+
+    # Changing content or parameters misses
+    cache(downsample_cycles, trace + 1, cycles)
+    cache(crop_cycles, padded, 0.5, samples_per_cycle=2)
+    raw = RawTrace(np.arange(100, dtype=np.int16), 0.5)
+    cache(downsample_cycles, raw, cycles)
+    cache(downsample_cycles, RawTrace(raw.data, 0.25), cycles)
+    cache(downsample_cycles, RawTrace(raw.data.copy(), 0.5), cycles)
+    assert (cache.hits, cache.misses) == (4, 6)
+
+    # Raw traces are stored as ADC counts with their conversion
+    def crop_raw(raw, stop):
+        return raw[:stop], raw.data[:stop]
+
+    for _ in range(2):
+        cropped, counts = cache(crop_raw, RawTrace(raw.data, 0.5, 1.0), 10)
+        assert isinstance(cropped, RawTrace) and cropped.data.dtype == np.int16
+        assert (cropped.scale, cropped.offset) == (0.5, 1.0)
+        assert np.array_equal(cropped.data, counts)
+    assert (cache.hits, cache.misses) == (5, 7)
+
+    # Shrinking the cache evicts results
+    cache.max_size = 0
+    cache.evict()
+    assert list(tmp_path.glob("*.npz")) == []
+
+
+def test_running_average():
+    """Test online mean and variance against NumPy."""
+    rng = np.random.default_rng(0)
+    traces = rng.normal(size=(20, 100))
+    avg = RunningAverage()
+    for t in traces:
+        avg.add(t)
+    avg.add(traces[0][:50])  # shorter trace crops statistics
+    expected = np.concatenate([traces, traces[:1]])[:, :50]
+    assert avg.count == 21
+    assert np.allclose(avg.mean, expected.mean(axis=0), atol=1e-5)
+    assert np.allclose(avg.variance, expected.var(axis=0, ddof=1), atol=1e-4)
+
+    # Buffers are reused after reset
+    avg.reset()
+    avg.add(np.ones(10))
+    assert np.all(avg.mean == 1)
+
+
+def test_raw_trace(tmp_path):
+    """Test lazy conversion of ADC counts to volts."""
+    raw = RawTrace(np.array([0, 10, -10, 20], dtype=np.int16), 0.5, 1.0)
+    assert np.all(np.asarray(raw) == [-1, 4, -6, 9])
+    assert len(raw[1:]) == 3
+
+    # Reduction on counts equals reduction on volts
+    cycles = [0, 2, 4]
+    assert np.all(
+        downsample_cycles(raw, cycles) == downsample_cycles(np.asarray(raw), cycles)
+    )
+
+    raw.save(tmp_path / "raw.npz")
+    loaded = RawTrace.load(tmp_path / "raw.npz")
+    assert loaded.data.dtype == np.int16
+    assert np.all(np.asarray(loaded) == np.asarray(raw))